@@ -0,0 +1,328 @@
+"""
+    Benchmarks of the stages of an analysis.
+
+    The stages run on a synthetic corpus and on subreddits and redditors
+    served in-process by fakereddit, so the results only depend on the code
+    and the machine. For each stage, the texts and tokens
+    processed per second (best of --repeat runs) and the peak memory
+    allocated by Python are reported.
+
+    Save the results of a known good version with --save, then compare
+    another version to them with --compare: the benchmark fails when a stage
+    is more than --max-regression slower, or uses that much more memory.
+
+        python benchmark.py --save baseline.json
+        python benchmark.py --compare baseline.json
+"""
+
+from __future__ import print_function
+
+import gc
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+import redditanalysis as wf
+from redditanalysis.dumps import DumpFilter, open_dump, read_records
+from redditanalysis.mdstrip import strip_markdown
+
+from fakereddit import FakeReddit, SyntheticCorpus
+
+MAX_THRESHOLD = 0.34
+
+
+class Workload(object):
+
+    """The synthetic inputs of the stages."""
+
+    def __init__(self, options):
+        self.options = options
+        corpus = SyntheticCorpus(options.seed)
+        self.texts = corpus.texts(options.texts)
+        self.stripped = [strip_markdown(text) for text in self.texts]
+        self.tokens = sum(len(list(wf.tokenize(text))) for text in self.stripped)
+        self.reddit = FakeReddit(options.seed, submissions=options.submissions,
+                                 comments=options.comments,
+                                 latency=options.latency, corpus=corpus)
+
+        # a gzipped dump of the texts as comments, half of them in the
+        # subreddit analyzed
+        self.directory = tempfile.mkdtemp()
+        self.dump = os.path.join(self.directory, "RC_benchmark.gz")
+        with gzip.open(self.dump, "wb") as out_file:
+            for i, text in enumerate(self.texts):
+                record = {"subreddit": "benchmark" if i % 2 else "other",
+                          "author": "author{0}".format(i % 100), "body": text,
+                          "created_utc": 1451606400 + i}
+                out_file.write(json.dumps(record).encode("utf-8") + b"\n")
+
+    def close(self):
+        shutil.rmtree(self.directory)
+
+
+class CountingParse(object):
+
+    """parse callable counting the text blocks passed to another one."""
+
+    def __init__(self, parse):
+        self.parse = parse
+        self.texts = 0
+
+    def __call__(self, **kwargs):
+        self.texts += 1
+        self.parse(**kwargs)
+
+
+def bench_strip_markdown(workload, _):
+    for text in workload.texts:
+        strip_markdown(text)
+    return len(workload.texts), workload.tokens
+
+
+def bench_tokenize(workload, _):
+    for text in workload.stripped:
+        list(wf.tokenize(text))
+    return len(workload.stripped), workload.tokens
+
+
+def bench_tokenize_many(workload, _):
+    wf.tokenize_many(workload.stripped)
+    return len(workload.stripped), workload.tokens
+
+
+def bench_parse_text(workload, _):
+    counts = wf.WordCounts()
+    for text in workload.texts:
+        wf.parse_text(text, counts, True, MAX_THRESHOLD)
+    return len(workload.texts), sum(counts.all_words.values())
+
+
+def bench_parse_phrases(workload, _):
+    counts = wf.WordCounts(ngrams=3, min_count=2)
+    for text in workload.texts:
+        wf.parse_text(text, counts, True, MAX_THRESHOLD)
+    return len(workload.texts), sum(counts.all_words.values())
+
+
+def bench_parse_pool(workload, _):
+    counts = wf.WordCounts()
+    pool = wf.ParsePool(workload.options.jobs)
+    try:
+        for text in workload.texts:
+            pool.parse_text(text, counts, True, MAX_THRESHOLD)
+        pool.finish()
+    finally:
+        pool.terminate()
+    return len(workload.texts), sum(counts.all_words.values())
+
+
+def bench_read_dump(workload, _):
+    counts = wf.WordCounts()
+    parse = CountingParse(wf.parse_text)
+    stream = open_dump(workload.dump)
+    try:
+        wf.parse_records(read_records(stream, DumpFilter(["benchmark"])),
+                         {("r", "benchmark"): counts}, True, MAX_THRESHOLD,
+                         parse=parse)
+    finally:
+        stream.close()
+    return parse.texts, sum(counts.all_words.values())
+
+
+def prepare_subreddit(workload):
+    return workload.reddit.get_subreddit("benchmark")
+
+
+def bench_process_subreddit(workload, subreddit):
+    counts = wf.WordCounts()
+    parse = CountingParse(wf.parse_text)
+    wf.process_subreddit(subreddit, counts, "all", None, True, MAX_THRESHOLD,
+                         parse=parse,
+                         fetch_threads=workload.options.fetch_threads,
+                         more_limit=None)
+    return parse.texts, sum(counts.all_words.values())
+
+
+def prepare_redditor(workload):
+    return workload.reddit.get_redditor("benchmark")
+
+
+def bench_process_redditor(workload, redditor):
+    counts = wf.WordCounts()
+    parse = CountingParse(wf.parse_text)
+    wf.process_redditor(redditor, counts, None, True, MAX_THRESHOLD,
+                        parse=parse)
+    return parse.texts, sum(counts.all_words.values())
+
+
+# name, function preparing the input of a run (not timed), timed function
+STAGES = [
+    ("strip_markdown", None, bench_strip_markdown),
+    ("tokenize", None, bench_tokenize),
+    ("tokenize_many", None, bench_tokenize_many),
+    ("parse_text", None, bench_parse_text),
+    ("parse_phrases", None, bench_parse_phrases),
+    ("parse_pool", None, bench_parse_pool),
+    ("read_dump", None, bench_read_dump),
+    ("process_subreddit", prepare_subreddit, bench_process_subreddit),
+    ("process_redditor", prepare_redditor, bench_process_redditor),
+]
+
+
+def run_stage(workload, prepare, bench, repeat):
+    """Return the results of a stage: its best throughput and peak memory."""
+    stderr, sys.stderr = sys.stderr, open(os.devnull, "w")  # progress dots
+    try:
+        best = None
+        for _ in range(repeat):
+            arg = prepare(workload) if prepare else None
+            wf.TEXT_MEMO.clear()
+            gc.collect()
+            start = time.time()
+            texts, tokens = bench(workload, arg)
+            elapsed = max(time.time() - start, 1e-9)
+            if best is None or elapsed < best:
+                best = elapsed
+
+        peak_mb = None
+        if tracemalloc is not None:
+            arg = prepare(workload) if prepare else None
+            wf.TEXT_MEMO.clear()
+            gc.collect()
+            tracemalloc.start()
+            try:
+                bench(workload, arg)
+                peak_mb = tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0)
+            finally:
+                tracemalloc.stop()
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+
+    return {"seconds": best, "texts": texts, "tokens": tokens,
+            "texts_per_sec": texts / best, "tokens_per_sec": tokens / best,
+            "peak_mb": peak_mb}
+
+
+def regressions(results, baseline, max_regression):
+    """Return the descriptions of the stages that regressed past the baseline."""
+    found = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        if result["tokens_per_sec"] < expected["tokens_per_sec"] * (1 - max_regression):
+            found.append("{0}: {1:.0f} tokens/s, baseline {2:.0f} tokens/s".format(
+                name, result["tokens_per_sec"], expected["tokens_per_sec"]))
+        if (result["peak_mb"] is not None and expected["peak_mb"] is not None and
+                result["peak_mb"] > expected["peak_mb"] * (1 + max_regression)):
+            found.append("{0}: {1:.1f} MB peak, baseline {2:.1f} MB".format(
+                name, result["peak_mb"], expected["peak_mb"]))
+    return found
+
+
+def parse_cmd_line():
+    parser = OptionParser(usage="usage: %prog [options]")
+
+    parser.add_option("--seed", type="int", default=0,
+                      help="seed of the synthetic corpus [default: 0]")
+
+    parser.add_option("--texts", type="int", default=5000,
+                      help=("number of comments parsed by the text stages"
+                            " [default: 5000]"))
+
+    parser.add_option("--submissions", type="int", default=25,
+                      help=("number of submissions of the fake subreddit"
+                            " [default: 25]"))
+
+    parser.add_option("--comments", type="int", default=40,
+                      help=("average number of comments of a submission"
+                            " [default: 40]"))
+
+    parser.add_option("--latency", type="float", default=0,
+                      help=("seconds each MoreComments replacement takes in the"
+                            " fake backend [default: 0]"))
+
+    parser.add_option("-f", "--fetch-threads", type="int", default=1,
+                      help=("threads fetching comment trees in"
+                            " process_subreddit [default: 1]"))
+
+    parser.add_option("-j", "--jobs", type="int", default=2,
+                      help="worker processes of parse_pool [default: 2]")
+
+    parser.add_option("--stage", action="append", default=[],
+                      help=("only run this stage (can be given several times)"
+                            " [default: all]"))
+
+    parser.add_option("--repeat", type="int", default=3,
+                      help="runs of each stage, the best is kept [default: 3]")
+
+    parser.add_option("--save", metavar="FILE",
+                      help="save the results as a baseline to FILE")
+
+    parser.add_option("--compare", metavar="FILE",
+                      help="fail if a stage regressed from the baseline in FILE")
+
+    parser.add_option("--max-regression", type="float", default=0.25,
+                      help=("relative slowdown or memory increase allowed by"
+                            " --compare [default: 0.25]"))
+
+    options, args = parser.parse_args()
+    if args:
+        parser.error("No arguments expected.")
+
+    names = [name for name, _, _ in STAGES]
+    for name in options.stage:
+        if name not in names:
+            parser.error("Unknown stage {0}, expected one of {1}.".format(
+                name, ", ".join(names)))
+    return options
+
+
+def main():
+    options = parse_cmd_line()
+    workload = Workload(options)
+
+    results = {}
+    print("{0:<20}{1:>12}{2:>14}{3:>10}".format("stage", "texts/s", "tokens/s",
+                                                "peak MB"))
+    try:
+        for name, prepare, bench in STAGES:
+            if options.stage and name not in options.stage:
+                continue
+            result = results[name] = run_stage(workload, prepare, bench,
+                                               options.repeat)
+            peak = "n/a" if result["peak_mb"] is None else "{0:.1f}".format(
+                result["peak_mb"])
+            print("{0:<20}{1:>12.0f}{2:>14.0f}{3:>10}".format(
+                name, result["texts_per_sec"], result["tokens_per_sec"], peak))
+    finally:
+        workload.close()
+
+    if options.save:
+        with open(options.save, "w") as out_file:
+            json.dump(results, out_file, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as in_file:
+            baseline = json.load(in_file)
+        found = regressions(results, baseline, options.max_regression)
+        for regression in found:
+            print("REGRESSION {0}".format(regression))
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,558 @@
+"""
+    Synthetic reddit content for benchmarks and tests.
+
+    This module is test support, kept next to tests.py and benchmark.py and
+    not installed with the package.
+
+    SyntheticCorpus generates reproducible comment-like texts: words drawn
+    from a Zipf distribution over the common words and the dictionary, with
+    markdown, URLs, /r/ and /u/ links, unicode, the occasional spam and
+    repeated bot replies.
+
+    FakeReddit serves that content through stand-ins for the few PRAW objects
+    the process_* functions use (Subreddit.get_top, Redditor.get_overview,
+    Submission.comments and MoreComments.comments),
+    entirely in-process.
+
+    FakeRedditServer serves the same content over HTTP on localhost, as the
+    JSON API of reddit the asyncfetch module requests.
+"""
+
+import bisect
+import json
+import math
+import os
+import re
+import socket
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+from random import Random
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlsplit
+
+from redditanalysis import walk_comments
+from redditanalysis.cache import CachedComment
+from redditanalysis.wordindex import read_word_list
+
+WORDS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "redditanalysis", "words")
+
+# 2016-01-01, the first created_utc of the generated items
+START_UTC = 1451606400
+
+UNICODE_WORDS = [u"café", u"naïve", u"jalapeño", u"über",
+                 u"señor", u"日本語", u"\U0001f602",
+                 u"—", u"¿", u"спасибо"]
+
+DOMAINS = ["i.imgur.com", "www.youtube.com", "en.wikipedia.org",
+           "www.reddit.com", "github.com", "np.reddit.com"]
+
+
+class SyntheticCorpus(object):
+
+    """Reproducible generator of reddit-like texts.
+
+    :param seed: the seed of the generator, the same seed generates the same
+        texts
+
+    :param vocabulary_size: the number of distinct dictionary words used
+        besides the common words
+
+    """
+
+    def __init__(self, seed=0, vocabulary_size=20000):
+        self.random = Random(seed)
+        common = sorted(read_word_list(os.path.join(WORDS_DIR, "common-words.txt")))
+        dictionary = sorted(read_word_list(os.path.join(WORDS_DIR, "dict-words.txt")))
+        self.random.shuffle(common)
+        words = [word for word in self.random.sample(dictionary, vocabulary_size)
+                 if word.isalpha()]
+        # the common words take the most frequent ranks, as in real comments
+        self.vocabulary = common + words
+        self.cumulative = []
+        total = 0.0
+        for rank in range(1, len(self.vocabulary) + 1):
+            total += 1.0 / rank
+            self.cumulative.append(total)
+        # the replies of bots, repeated word for word
+        self.bot_replies = [u"\n\n".join(self.paragraph() for _ in range(4))
+                            for _ in range(5)]
+
+    def word(self):
+        """Return a word drawn from the Zipf distribution of the vocabulary."""
+        index = bisect.bisect(self.cumulative,
+                              self.random.random() * self.cumulative[-1])
+        return self.vocabulary[min(index, len(self.vocabulary) - 1)]
+
+    def _decorated_word(self):
+        random = self.random
+        roll = random.random()
+        if roll < 0.90:
+            return self.word()
+        if roll < 0.92:
+            return u"**{0}**".format(self.word())
+        if roll < 0.94:
+            return random.choice([u"*{0}*", u"_{0}_", u"`{0}`"]).format(self.word())
+        if roll < 0.95:
+            return u"[{0} {1}](https://{2}/{3}_{4})".format(
+                self.word(), self.word(), random.choice(DOMAINS), self.word(),
+                random.randint(1, 99999))
+        if roll < 0.96:
+            return u"https://{0}/{1}{2}".format(random.choice(DOMAINS),
+                                                self.word(),
+                                                random.randint(1, 99999))
+        if roll < 0.97:
+            return u"/r/{0}".format(self.word())
+        if roll < 0.98:
+            return u"/u/{0}_{1}".format(self.word(), random.randint(1, 999))
+        if roll < 0.99:
+            return random.choice(UNICODE_WORDS)
+        return random.choice([u"&amp;", u"&gt;", u"<3", u"I'm", u"don't",
+                              u"1,000", u"2016."])
+
+    def sentence(self):
+        words = [self._decorated_word()
+                 for _ in range(self.random.randint(3, 18))]
+        return u"{0}{1}".format(u" ".join(words),
+                                self.random.choice([u".", u".", u"!", u"?", u""]))
+
+    def title(self):
+        return u" ".join(self.word() for _ in range(self.random.randint(3, 12)))
+
+    def paragraph(self):
+        random = self.random
+        sentences = u" ".join(self.sentence()
+                              for _ in range(random.randint(1, 4)))
+        roll = random.random()
+        if roll < 0.08:
+            return u"> {0}".format(sentences)
+        if roll < 0.12:
+            return u"\n".join(u"* {0}".format(self.sentence())
+                              for _ in range(random.randint(2, 5)))
+        if roll < 0.14:
+            return u"# {0}".format(self.title())
+        if roll < 0.16:
+            return u"    {0} = {1}({2})".format(self.word(), self.word(),
+                                                random.randint(0, 9))
+        return sentences
+
+    def comment(self):
+        """Return the markdown body of a comment."""
+        random = self.random
+        roll = random.random()
+        if roll < 0.02:  # spam
+            return u" ".join([self.word()] * random.randint(20, 60))
+        if roll < 0.05:
+            return random.choice(self.bot_replies)
+        return u"\n\n".join(self.paragraph()
+                            for _ in range(random.choice([1, 1, 1, 2, 2, 3, 4])))
+
+    def texts(self, count):
+        """Return a list of count comment bodies."""
+        return [self.comment() for _ in range(count)]
+
+
+class FakeComment(CachedComment):
+
+    """Stand-in for a praw Comment, with its replies."""
+
+    __slots__ = ()
+
+    def __init__(self, id, body, created_utc=None, replies=()):
+        CachedComment.__init__(self, id, body, created_utc)
+        self.replies = list(replies)
+
+
+class FakeMoreComments(object):
+
+    """Stand-in for a praw MoreComments, hiding comments until replaced.
+
+    :param latency: the seconds fetching the comments takes, like the request
+        praw makes for them
+
+    """
+
+    def __init__(self, children, latency=0):
+        self.children = children
+        self.count = len(children)
+        self.latency = latency
+
+    def comments(self, update=True):
+        """Return the hidden comments, like praw's MoreComments.comments."""
+        if self.latency:
+            time.sleep(self.latency)
+        return self.children
+
+
+class FakeSubmission(object):
+
+    """Stand-in for a praw Submission and its comment tree.
+
+    :param error: the error raised reading the comments, like a failed
+        request
+
+    """
+
+    def __init__(self, id, subreddit, title, selftext="", comments=(),
+                 created_utc=None, error=None):
+        self.id = id
+        self.title = title
+        self.selftext = selftext
+        self.is_self = bool(selftext)
+        self.permalink = u"/r/{0}/comments/{1}/".format(subreddit, id)
+        self.created_utc = created_utc
+        self.comments = list(comments)
+        self.error = error
+        # the more_limit of each iter_comments call
+        self.more_limits = []
+
+    def iter_comments(self, more_limit=32):
+        """Walk the comment tree, or raise ``error``."""
+        self.more_limits.append(more_limit)
+        if self.error is not None:
+            raise self.error
+        return walk_comments(self.comments, more_limit)
+
+
+class FakeSubreddit(object):
+
+    def __init__(self, name, submissions):
+        self.display_name = name
+        self.submissions = submissions
+
+    def get_top(self, limit=None, params=None):
+        return iter(self.submissions[:limit])
+
+
+class FakeRedditor(object):
+
+    def __init__(self, name, overview):
+        self.name = name
+        self.overview = overview
+
+    def get_overview(self, limit=None):
+        return iter(self.overview[:limit])
+
+
+class FakeReddit(object):
+
+    """Stand-in for praw.Reddit serving synthetic subreddits and redditors.
+
+    The content of a subreddit or redditor only depends on the seed and its
+    name.
+
+    :param submissions: the number of submissions of a subreddit
+
+    :param comments: the average number of comments of a submission
+
+    :param latency: the seconds each expanded FakeMoreComments takes
+
+    """
+
+    def __init__(self, seed=0, submissions=25, comments=40, latency=0,
+                 corpus=None):
+        self.seed = seed
+        self.submissions = submissions
+        self.comments = comments
+        self.latency = latency
+        self.corpus = corpus or SyntheticCorpus(seed)
+
+    def _random(self, key):
+        """Return the generator of the corpus, seeded for the given key."""
+        random = self.corpus.random
+        random.seed(u"{0}:{1}".format(self.seed, key))
+        return random
+
+    @staticmethod
+    def _next(random, created_utc):
+        """Return a new id and a created_utc a little after the given one."""
+        return ("{0:x}".format(random.getrandbits(40)),
+                created_utc + random.randint(1, 3600))
+
+    def _comment_tree(self, random, count, created_utc, depth=0):
+        """Return count comments, some of them hidden behind FakeMoreComments."""
+        comments = []
+        while len(comments) < count:
+            id, created_utc = self._next(random, created_utc)
+            replies = []
+            if depth < 6 and random.random() < 0.3:
+                replies = self._comment_tree(random, random.randint(1, 4),
+                                             created_utc, depth + 1)
+            comments.append(FakeComment(id, self.corpus.comment(), created_utc,
+                                        replies))
+        # like reddit, only show the first comments of long threads
+        shown = 10 if depth == 0 else 2
+        if len(comments) > shown:
+            comments[shown:] = [FakeMoreComments(comments[shown:], self.latency)]
+        return comments
+
+    def _submission(self, random, subreddit, created_utc, with_comments=True):
+        id, created_utc = self._next(random, created_utc)
+        selftext = self.corpus.comment() if random.random() < 0.4 else ""
+        comments = []
+        if with_comments:
+            count = int(random.expovariate(1.0 / self.comments)) if self.comments else 0
+            comments = self._comment_tree(random, count, created_utc)
+        return FakeSubmission(id, subreddit, self.corpus.title(), selftext,
+                              comments, created_utc)
+
+    def get_subreddit(self, name):
+        random = self._random(u"/r/{0}".format(name))
+        submissions = [self._submission(random, name, START_UTC + i * 86400)
+                       for i in range(self.submissions)]
+        return FakeSubreddit(name, submissions)
+
+    def get_redditor(self, name):
+        random = self._random(u"/u/{0}".format(name))
+        overview = []
+        created_utc = START_UTC
+        for _ in range(self.submissions * 4):
+            if random.random() < 0.2:
+                entry = self._submission(random, self.corpus.word(), created_utc,
+                                         with_comments=False)
+            else:
+                id, created_utc = self._next(random, created_utc)
+                entry = FakeComment(id, self.corpus.comment(), created_utc)
+            created_utc = entry.created_utc
+            overview.append(entry)
+        return FakeRedditor(name, overview)
+
+
+def _flatten(comments):
+    """Return every FakeComment of a tree, including the hidden ones."""
+    flattened = []
+    pending = deque([comments])
+    while pending:
+        for item in pending.popleft():
+            if isinstance(item, FakeMoreComments):
+                pending.append(item.children)
+            else:
+                flattened.append(item)
+                pending.append(item.replies)
+    return flattened
+
+
+def _listing(things, after=None):
+    return {"kind": "Listing",
+            "data": {"children": things, "after": after, "before": None}}
+
+
+def _comment_json(comment, replies=True):
+    """Return the JSON thing of a FakeComment, or of a FakeMoreComments."""
+    if isinstance(comment, FakeMoreComments):
+        ids = [hidden.id for hidden in _flatten(comment.children)]
+        return {"kind": "more", "data": {"count": len(ids), "children": ids}}
+    data = {"id": comment.id, "name": "t1_{0}".format(comment.id),
+            "body": comment.body, "created_utc": comment.created_utc,
+            "replies": ""}
+    if replies and comment.replies:
+        data["replies"] = _listing([_comment_json(reply)
+                                    for reply in comment.replies])
+    return {"kind": "t1", "data": data}
+
+
+def _submission_json(submission):
+    return {"kind": "t3",
+            "data": {"id": submission.id, "name": "t3_{0}".format(submission.id),
+                     "title": submission.title,
+                     "selftext": submission.selftext,
+                     "is_self": submission.is_self,
+                     "permalink": submission.permalink,
+                     "created_utc": submission.created_utc}}
+
+
+def _page(things, query, fullname):
+    """Return the page of a listing selected by its limit and after parameters."""
+    names = [fullname(thing) for thing in things]
+    start = names.index(query["after"]) + 1 if query.get("after") in names else 0
+    end = start + min(int(query.get("limit", 25)), 100)
+    page = things[start:end]
+    return _listing(page, names[end - 1] if end < len(things) else None)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients closing their connections, e.g. when a listing is closed
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class FakeRedditServer(object):
+
+    """HTTP server serving the content of a FakeReddit as the reddit JSON API.
+
+    Answers the requests asyncfetch makes: subreddit top listings, redditor
+    overviews, comment trees and /api/morechildren expansions. Responses are
+    gzipped when the client accepts it, and report the rate limit budget in
+    X-Ratelimit headers; the requests past it get a 429 status.
+
+    :param ratelimit: the number of requests allowed per window
+
+    :param window: the seconds of a rate limit window
+
+    Add paths to ``broken`` to answer them with truncated JSON, like the
+    empty responses reddit sometimes sends.
+
+        with FakeRedditServer(FakeReddit()) as server:
+            reddit = AsyncReddit("test", url=server.url)
+
+    """
+
+    def __init__(self, reddit=None, ratelimit=600, window=600):
+        self.reddit = reddit or FakeReddit()
+        self.ratelimit = ratelimit
+        self.window = window
+        self.lock = threading.Lock()
+        self.subreddits = {}
+        self.redditors = {}
+        self.submissions = {}
+        self.comments = {}
+        self.requests = 0
+        self.rejected = 0
+        self.broken = set()
+        self.window_start = time.time()
+        self.used = 0
+        self.server = _ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = "http://127.0.0.1:{0}".format(self.server.server_address[1])
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def subreddit(self, name):
+        with self.lock:
+            if name not in self.subreddits:
+                subreddit = self.subreddits[name] = self.reddit.get_subreddit(name)
+                for submission in subreddit.submissions:
+                    self.submissions[submission.id] = submission
+                    for comment in _flatten(submission.comments):
+                        self.comments[comment.id] = comment
+            return self.subreddits[name]
+
+    def redditor(self, name):
+        with self.lock:
+            if name not in self.redditors:
+                self.redditors[name] = self.reddit.get_redditor(name)
+            return self.redditors[name]
+
+    def _ratelimit(self):
+        """Count a request, returning its headers and whether it is allowed."""
+        with self.lock:
+            self.requests += 1
+            now = time.time()
+            if now - self.window_start >= self.window:
+                self.window_start = now
+                self.used = 0
+            self.used += 1
+            remaining = max(self.ratelimit - self.used, 0)
+            reset = int(math.ceil(self.window_start + self.window - now))
+            if self.used > self.ratelimit:
+                self.rejected += 1
+            headers = {"X-Ratelimit-Used": str(self.used),
+                       "X-Ratelimit-Remaining": "{0:.1f}".format(remaining),
+                       "X-Ratelimit-Reset": str(reset)}
+            return headers, self.used <= self.ratelimit
+
+    def respond(self, path, query):
+        """Return the JSON of an API path, or None when it does not exist."""
+        match = re.match(r"^/r/([^/]+)/top\.json$", path)
+        if match:
+            return _page([_submission_json(submission) for submission in
+                          self.subreddit(match.group(1)).submissions],
+                         query, lambda thing: thing["data"]["name"])
+
+        match = re.match(r"^/user/([^/]+)/overview\.json$", path)
+        if match:
+            things = []
+            for entry in self.redditor(match.group(1)).overview:
+                if isinstance(entry, FakeComment):
+                    things.append(_comment_json(entry, replies=False))
+                else:
+                    things.append(_submission_json(entry))
+            return _page(things, query, lambda thing: thing["data"]["name"])
+
+        match = re.match(r"^/comments/([^/]+)\.json$", path)
+        if match:
+            submission = self.submissions.get(match.group(1))
+            if submission is None:
+                return None
+            return [_listing([_submission_json(submission)]),
+                    _listing([_comment_json(comment)
+                              for comment in submission.comments])]
+
+        if path == "/api/morechildren.json":
+            ids = query.get("children", "").split(",")
+            things = [_comment_json(self.comments[id], replies=False)
+                      for id in ids if id in self.comments]
+            return {"json": {"errors": [], "data": {"things": things}}}
+        return None
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                query = dict((name, values[-1]) for name, values
+                             in parse_qs(url.query).items())
+                headers, allowed = server._ratelimit()
+                data = server.respond(url.path, query) if allowed else None
+                if not allowed:
+                    status, data = 429, {"message": "Too Many Requests",
+                                         "error": 429}
+                elif data is None:
+                    status, data = 404, {"message": "Not Found", "error": 404}
+                else:
+                    status = 200
+
+                body = json.dumps(data).encode("utf-8")
+                if url.path in server.broken:
+                    body = body[:len(body) // 2]
+                if "gzip" in self.headers.get("Accept-Encoding", ""):
+                    compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                                  16 + zlib.MAX_WBITS)
+                    body = compressor.compress(body) + compressor.flush()
+                    headers["Content-Encoding"] = "gzip"
+                headers["Content-Type"] = "application/json; charset=UTF-8"
+                headers["Content-Length"] = str(len(body))
+
+                self.send_response(status)
+                for name, value in sorted(headers.items()):
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -17,30 +17,65 @@
     this program.  If not, see http://www.gnu.org/licenses/.
 """
 
+import calendar
+import hashlib
+import heapq
+import io
 import os
-import praw
+import pickle
 import re
 import sys
-from bs4 import BeautifulSoup
-from collections import defaultdict
-from markdown import markdown
+import threading
+import time
+import traceback
+from collections import Counter, OrderedDict, deque
+from datetime import datetime
+from functools import partial
+from operator import itemgetter
 from optparse import OptionParser
-from requests.exceptions import HTTPError
-from update_checker import update_check
+
+try:
+    from os import replace as replace_file
+except ImportError:  # Python 2, where rename replaces files on POSIX
+    from os import rename as replace_file
+
+from .cache import CacheMiss, CachedComment, ResponseCache
+from .mdstrip import strip_markdown
+from .plurals import merge_plurals
+from .spacesaving import SpaceSaving, capacity_for_error
+from .stats import Stats, clock
+from .timeline import DayCounts, Timeline
+from .vocabulary import (CountTable, PhraseTable, Vocabulary, count_ids, phrase_counts,
+                         phrases_without, word_phrase_counts)
+from .wordindex import StopWords, WordIndex
 
 __version__ = "1.0.5"
 
+# praw, requests, update_checker and multiprocessing take longer to import than
+# the rest of the program takes to start, so they are only imported by the code
+# that needs them, and never for --help
+
+# seconds to wait at exit for the update check to complete
+UPDATE_CHECK_TIMEOUT = 1.0
+
 PACKAGE_DIR = os.path.dirname(__file__)
 
-all_words = defaultdict(int)
-popular_words = defaultdict(int)
-COMMON_WORDS = set()
+COMMON_WORDS = StopWords()
 
 # load a list of common words to ignore
 with open(os.path.join(PACKAGE_DIR, "words", "common-words.txt"), "r") as in_file:
     for line in in_file:
         COMMON_WORDS.add(line.strip().lower())
 
+# the dictionary is only looked up through its memory-mapped index
+DICTIONARY_FILE = os.path.join(PACKAGE_DIR, "words", "dict-words.txt")
+
+# timers and counters of the stages of the analysis
+STATS = Stats()
+
+# number of distinct texts whose token counts are remembered by default
+MEMO_SIZE = 4096
+
 # Tokens that match this regular expression are immediately discared
 # This should be used pretty much to just discard links
 URL_RE = re.compile(
@@ -51,16 +86,35 @@ URL_RE = re.compile(
 # A valid token regular expression
 TOKEN_RE = re.compile(r"[\w]+(?:\'(?:d|ll|m|re|s|t|ve))?", flags=re.UNICODE)
 
+# The two expressions above in a single scan of a whole lower-cased text: the
+# whitespace-separated tokens URL_RE matches are skipped (the group captures
+# nothing), and the valid tokens of the others are captured
+SCAN_RE = re.compile(
+    r"(?<!\S)(?:https?://|www\.)\S*"  # begins with
+    r"|(?<!\S)\S*?\.(?:com|it|net|org)(?:/|(?!\S))\S*"  # tld then end or /
+    r"|(\w+(?:'(?:d|ll|m|re|t|ve))?)(?:'s)?",  # without the possessive form
+    flags=re.UNICODE)
+
 
 def parse_cmd_line():
     """Command-line argument parsing."""
 
-    usage = ("usage: %prog [options] USERNAME TARGET\n\n"
+    usage = ("usage: %prog [options] USERNAME TARGET [TARGET ...]\n\n"
              "USERNAME sets your Reddit username for the bot\n"
              "TARGET sets the subreddit or user to count word frequencies for."
-             "\nenter /r/TARGET for subreddits or /u/TARGET for users.")
+             "\nenter /r/TARGET for subreddits or /u/TARGET for users.\n\n"
+             "word_freqs_merge [options] SHARD [SHARD ...] merges the shard"
+             " files of --partial analyses.")
     parser = OptionParser(usage=usage)
 
+    parser.add_option("-b", "--batch",
+                      action="store",
+                      type="string",
+                      dest="batch",
+                      help=("also analyze the targets listed in BATCH, one"
+                            " per line (- for stdin), in the same session"
+                            " [default: none]"))
+
     parser.add_option("-p", "--period",
                       action="store",
                       type="string",
@@ -78,6 +132,35 @@ def parse_cmd_line():
                             " word frequencies for"
                             " [default: no limit]"))
 
+    parser.add_option("-f", "--fetch-threads",
+                      action="store",
+                      type="int",
+                      dest="fetch_threads",
+                      default=1,
+                      help=("number of submissions to fetch the comments of"
+                            " at the same time"
+                            " [default: 1]"))
+
+    parser.add_option("-n", "--connections",
+                      action="store",
+                      type="int",
+                      dest="connections",
+                      default=0,
+                      help=("fetch with asyncio over N persistent HTTP"
+                            " connections instead of PRAW, spreading the"
+                            " requests over the rate limit of Reddit"
+                            " (requires Python 3.5+)"
+                            " [default: 0, use PRAW]"))
+
+    parser.add_option("--more-limit",
+                      action="store",
+                      type="int",
+                      dest="more_limit",
+                      default=32,
+                      help=("maximum number of \"load more comments\" links"
+                            " to expand per submission, -1 for no limit"
+                            " [default: 32]"))
+
     parser.add_option("-m", "--maxthresh",
                       action="store",
                       type="float",
@@ -103,6 +186,26 @@ def parse_cmd_line():
                       help=("enable PRAW multiprocess support"
                             " [default: false]"))
 
+    parser.add_option("-j", "--jobs",
+                      action="store",
+                      type="int",
+                      dest="jobs",
+                      default=0,
+                      help=("parse the fetched text in JOBS worker processes"
+                            " while the main process keeps fetching from"
+                            " Reddit (0 parses in the main process)"
+                            " [default: 0]"))
+
+    parser.add_option("--memo-size",
+                      action="store",
+                      type="int",
+                      dest="memo_size",
+                      default=MEMO_SIZE,
+                      help=("number of distinct texts whose token counts are"
+                            " remembered, so repeated texts (bot replies,"
+                            " copypasta) are only tokenized once, 0 to"
+                            " disable [default: {0}]".format(MEMO_SIZE)))
+
     parser.add_option("-i", "--include-dictionary",
                       action="store_true",
                       default=False,
@@ -110,12 +213,189 @@ def parse_cmd_line():
                             " word cloud"
                             " [default: false]"))
 
+    parser.add_option("-w", "--stopwords",
+                      action="append",
+                      default=[],
+                      metavar="FILE",
+                      help=("also exclude the words listed in FILE, one per"
+                            " line (can be given several times)"))
+
+    parser.add_option("-t", "--top",
+                      action="store",
+                      type="int",
+                      dest="top",
+                      default=None,
+                      metavar="N",
+                      help=("only output the N most used words"
+                            " [default: all]"))
+
+    parser.add_option("-a", "--approximate",
+                      action="store",
+                      type="float",
+                      dest="approximate",
+                      default=None,
+                      metavar="EPSILON",
+                      help=("count the words approximately in bounded memory:"
+                            " only the 1/EPSILON most used words are kept, and"
+                            " each count may be up to EPSILON times the number"
+                            " of words counted too high [default: exact]"))
+
+    parser.add_option("-g", "--ngrams",
+                      action="store",
+                      type="int",
+                      dest="ngrams",
+                      default=1,
+                      metavar="N",
+                      help=("also count the phrases of 2 to N words (up to 3)"
+                            " that do not start or end with a common word, in"
+                            " a phrases- output file [default: 1]"))
+
+    parser.add_option("--min-count",
+                      action="store",
+                      type="int",
+                      dest="min_count",
+                      default=2,
+                      metavar="M",
+                      help=("with -g, drop the phrases used fewer than M times"
+                            " whenever the phrase counts outgrow their memory"
+                            " budget [default: 2]"))
+
+    parser.add_option("--timeline",
+                      action="store",
+                      type="string",
+                      dest="timeline",
+                      metavar="DIR",
+                      help=("also keep the popular word counts per day in DIR,"
+                            " to compare time windows with python -m"
+                            " redditanalysis.timeline [default: off]"))
+
     parser.add_option("-r", "--no-raw-data",
                       action="store_true",
                       default=False,
                       help=("disable raw word count output file"
                             " [default: false]"))
 
+    parser.add_option("--binary",
+                      action="store_true",
+                      default=False,
+                      help=("also write each output file as a memory-mappable"
+                            " .counts file, with the settings and totals of"
+                            " the analysis [default: false]"))
+
+    parser.add_option("-c", "--cache-dir",
+                      action="store",
+                      type="string",
+                      dest="cache_dir",
+                      help=("keep the text fetched from Reddit in a cache in"
+                            " CACHE_DIR and reuse it on the next runs"
+                            " [default: no cache]"))
+
+    parser.add_option("--cache-ttl",
+                      action="store",
+                      type="float",
+                      dest="cache_ttl",
+                      default=24,
+                      help=("number of hours after which cached text is"
+                            " fetched again"
+                            " [default: 24]"))
+
+    parser.add_option("--cache-size",
+                      action="store",
+                      type="float",
+                      dest="cache_size",
+                      default=1024,
+                      help=("maximum size of the cached text in MB, the"
+                            " oldest text is evicted past it"
+                            " [default: 1024]"))
+
+    parser.add_option("--offline",
+                      action="store_true",
+                      default=False,
+                      help=("replay the analysis from the cache only, without"
+                            " connecting to Reddit (requires --cache-dir)"
+                            " [default: false]"))
+
+    parser.add_option("-d", "--dump",
+                      action="append",
+                      dest="dumps",
+                      default=[],
+                      metavar="FILE",
+                      help=("count the words of the targets in FILE, a local"
+                            " dump of reddit submissions and comments (one JSON"
+                            " object per line, optionally .gz, .bz2, .xz or .zst"
+                            " compressed), instead of fetching them; can be"
+                            " given several times"))
+
+    parser.add_option("--after",
+                      action="store",
+                      type="string",
+                      dest="after",
+                      help=("only count the items (or the submissions and"
+                            " their comments) created at or after this"
+                            " YYYY-MM-DD date or UTC timestamp"
+                            " [default: no limit]"))
+
+    parser.add_option("--before",
+                      action="store",
+                      type="string",
+                      dest="before",
+                      help=("only count the items (or the submissions and"
+                            " their comments) created before this YYYY-MM-DD"
+                            " date or UTC timestamp [default: no limit]"))
+
+    parser.add_option("--shard",
+                      action="store",
+                      type="string",
+                      dest="shard",
+                      metavar="I/N",
+                      help=("only count the submissions (with their comments)"
+                            " of the I-th of N shards, split by id, e.g. to"
+                            " crawl a target on N machines [default: 1/1]"))
+
+    parser.add_option("--partial",
+                      action="store",
+                      type="string",
+                      dest="partial",
+                      metavar="DIR",
+                      help=("write the counts to a shard file in DIR instead"
+                            " of the output files, to merge them later with"
+                            " word_freqs_merge [default: off]"))
+
+    parser.add_option("-s", "--state-dir",
+                      action="store",
+                      type="string",
+                      dest="state_dir",
+                      help=("keep the word counts and the ids of the processed"
+                            " submissions and comments in STATE_DIR, so the"
+                            " next runs only count new items"
+                            " [default: start from scratch]"))
+
+    parser.add_option("--checkpoint",
+                      action="store",
+                      type="float",
+                      dest="checkpoint",
+                      default=60,
+                      help=("number of seconds between two saves of the state"
+                            " during a run (see --state-dir)"
+                            " [default: 60]"))
+
+    parser.add_option("--no-update-check",
+                      action="store_true",
+                      default=False,
+                      help=("do not check PyPI for a newer release"
+                            " [default: false]"))
+
+    parser.add_option("--stats",
+                      metavar="FILE",
+                      help=("write the time spent in each stage and the"
+                            " numbers of items and tokens processed as JSON"
+                            " to FILE"))
+
+    parser.add_option("--profile",
+                      metavar="FILE",
+                      help=("profile the analysis with cProfile and save the"
+                            " profile to FILE (read it with python -m pstats)"))
+
     parser.add_option("-v", "--verbose",
                       action="store_true",
                       default=False,
@@ -124,48 +404,429 @@ def parse_cmd_line():
 
     options, args = parser.parse_args()
 
-    if len(args) != 2:
+    if not args:
         parser.error("Invalid number of arguments provided.")
-    user, target = args
+    user, targets = args[0], args[1:]
 
-    if target.startswith("/r/"):
-        options.is_subreddit = True
-    elif target.startswith("/u/"):
-        options.is_subreddit = False
-    else:
-        parser.error("Invalid target.")
+    if options.batch:
+        try:
+            targets.extend(read_targets(options.batch))
+        except (IOError, OSError) as error:
+            parser.error("Cannot read the targets from {0}: {1}".format(
+                options.batch, error))
+
+    if not targets:
+        parser.error("Invalid number of arguments provided.")
+
+    for target in targets:
+        if not target.startswith(("/r/", "/u/")):
+            parser.error("Invalid target {0}.".format(target))
+
+    # analyze each target once, in the order given
+    seen = set()
+    targets = [target for target in targets
+               if not (target in seen or seen.add(target))]
 
     if options.period not in ["day", "week", "month", "year", "all"]:
         parser.error("Invalid period.")
 
+    if options.jobs < 0:
+        parser.error("Invalid number of jobs.")
+
+    if options.fetch_threads < 1:
+        parser.error("Invalid number of fetch threads.")
+
+    if options.connections < 0:
+        parser.error("Invalid number of connections.")
+
+    if options.connections and sys.version_info < (3, 5):
+        parser.error("--connections requires Python 3.5 or later.")
+
+    if options.more_limit < 0:
+        options.more_limit = None
+
+    if options.top is not None and options.top < 1:
+        parser.error("Invalid number of top words.")
+
+    if options.approximate is not None and not 0 < options.approximate < 1:
+        parser.error("Invalid approximation error.")
+
+    if not 1 <= options.ngrams <= 3:
+        parser.error("Invalid number of words per phrase.")
+
+    if options.min_count < 1:
+        parser.error("Invalid minimum phrase count.")
+
+    if options.memo_size < 0:
+        parser.error("Invalid memo size.")
+    TEXT_MEMO.resize(options.memo_size)
+
+    if options.offline and not options.cache_dir:
+        parser.error("--offline requires --cache-dir.")
+
+    if options.dumps and (options.offline or options.state_dir):
+        parser.error("--dump cannot be used with --offline or --state-dir.")
+
+    for name in ("after", "before"):
+        value = getattr(options, name)
+        if value is not None:
+            try:
+                setattr(options, name, parse_time(value))
+            except ValueError:
+                parser.error("Invalid date {0}.".format(value))
+
+    if options.dumps and options.shard:
+        parser.error("--dump cannot be used with --shard, give each shard"
+                     " its own dumps instead.")
+
+    # the items crawled are selected by a Shard, dumps by a DumpFilter
+    if options.shard or ((options.after or options.before) and not options.dumps):
+        from .shards import Shard
+
+        try:
+            options.shard = Shard.parse(options.shard or "1/1", options.after,
+                                        options.before)
+        except ValueError:
+            parser.error("Invalid shard {0}.".format(options.shard))
+
+    word_lists = options.stopwords[:]
     if options.include_dictionary:
-        with open(os.path.join(PACKAGE_DIR, "words", "dict-words.txt"), "r") as in_file:
-            for line in in_file:
-                COMMON_WORDS.add(line.strip().lower())
+        word_lists.append(DICTIONARY_FILE)
+    for path in word_lists:
+        try:
+            COMMON_WORDS.add_index(WordIndex.open_word_list(path))
+        except (IOError, OSError, ValueError) as error:
+            parser.error("Cannot load word list {0}: {1}".format(path, error))
+
+    return user, targets, options
+
+
+def parse_time(value):
+    """Return the UTC timestamp of a YYYY-MM-DD date or of a timestamp."""
+    try:
+        return float(value)
+    except ValueError:
+        return float(calendar.timegm(
+            datetime.strptime(value, "%Y-%m-%d").timetuple()))
+
+
+def read_targets(path):
+    """Return the targets listed in a file, one per line.
+
+    Blank lines and lines starting with # are ignored.
+
+    :param path: the file, or "-" to read the targets from stdin
+
+    """
+    if path == "-":
+        lines = sys.stdin.readlines()
+    else:
+        with open(path, "r") as in_file:
+            lines = in_file.readlines()
+    return [line.strip() for line in lines
+            if line.strip() and not line.strip().startswith("#")]
+
+
+class WordCounts(object):
+
+    """Word counts accumulated over the text blocks of an analysis.
+
+    ``all_words`` holds the raw count of every token and ``popular_words`` the
+    counts of the uncommon words that passed the max_threshold test, both
+    CountTables over the ``vocabulary`` of these counts, or SpaceSaving tables
+    keyed by word (and ``vocabulary`` None) with a capacity. A
+    WordCounts is passed to parse_text and the process_* functions, so several
+    analyses can run side by side, and partial counts (e.g. from worker
+    processes) can be pickled and combined with ``merge``.
+
+    With ngrams above 1, ``phrases`` also holds the counts of the phrases of
+    up to ngrams words that passed the same tests as popular words, None
+    otherwise. With by_day, ``days`` also holds the popular word counts per
+    day of creation of the texts (see DayCounts), None otherwise.
+
+    :param capacity: None to count every word exactly, or the number of
+        words to keep approximate counts of in each table (see SpaceSaving)
+
+    :param ngrams: the number of words of the longest phrases counted, 1 to
+        only count single words
+
+    :param min_count: the minimum count of the phrases kept when the phrase
+        table of exact counts is pruned (see PhraseTable)
+
+    :param by_day: also count the popular words per day
 
-    return user, target, options
+    """
+
+    __slots__ = ("capacity", "ngrams", "vocabulary", "all_words", "popular_words",
+                 "phrases", "days")
+
+    def __init__(self, capacity=None, ngrams=1, min_count=1, by_day=False):
+        self.capacity = capacity
+        self.ngrams = ngrams
+        self.days = DayCounts() if by_day else None
+        if capacity is None:
+            self.vocabulary = Vocabulary()
+            self.all_words = CountTable(self.vocabulary)
+            self.popular_words = CountTable(self.vocabulary)
+            self.phrases = (PhraseTable(min_count, vocabulary=self.vocabulary)
+                            if ngrams > 1 else None)
+        else:
+            # interning every token would take more memory than the counters
+            self.vocabulary = None
+            self.all_words = SpaceSaving(capacity)
+            self.popular_words = SpaceSaving(capacity)
+            self.phrases = SpaceSaving(capacity) if ngrams > 1 else None
+
+    def __getstate__(self):
+        return (self.all_words, self.popular_words, self.ngrams, self.phrases,
+                self.days)
+
+    def __setstate__(self, state):
+        all_words, popular_words = state[:2]
+        # the states saved by earlier versions have fewer fields
+        self.ngrams, self.phrases, self.days = (tuple(state[2:]) +
+                                                (1, None, None)[len(state) - 2:])
+        if isinstance(all_words, (CountTable, SpaceSaving)):
+            self.capacity = getattr(all_words, "capacity", None)
+            self.vocabulary = getattr(all_words, "vocabulary", None)
+            self.all_words = all_words
+            # each table was unpickled into a vocabulary of its own
+            self.popular_words = self._adopt(popular_words)
+            self.phrases = self._adopt(self.phrases)
+        else:
+            # the plain dicts of the states saved by earlier versions
+            self.__init__()
+            self.all_words.update(all_words)
+            self.popular_words.update(popular_words)
+
+    def __eq__(self, other):
+        if not isinstance(other, WordCounts):
+            return NotImplemented
+        return (self.all_words == other.all_words and
+                self.popular_words == other.popular_words and
+                self.phrases == other.phrases and self.days == other.days)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def _adopt(self, table):
+        """Return a table with the counts of another one, over the vocabulary
+        of these counts."""
+        if table is None or getattr(table, "vocabulary", None) is self.vocabulary:
+            return table
+        if self.capacity is not None:
+            # the exact phrase counts of the states saved by earlier versions
+            adopted = SpaceSaving(self.capacity)
+        elif isinstance(table, PhraseTable):
+            adopted = PhraseTable(table.min_count, table.prune_size, self.vocabulary)
+        else:
+            adopted = CountTable(self.vocabulary)
+        adopted.update(table)
+        return adopted
+
+    def add_keys(self, key_counts, popular_counts, phrase_counts=()):
+        """Add the (key, count) pairs of a text.
+
+        The keys are the ids of the words in ``vocabulary`` and the packed
+        keys of the phrases (see PhraseTable), or the words and phrases
+        themselves for approximate counts.
+
+        """
+        if self.capacity is None:
+            self.all_words.add_ids(key_counts)
+            self.popular_words.add_ids(popular_counts)
+            if phrase_counts:
+                self.phrases.add_keys(phrase_counts)
+            return
+        for table, pairs in ((self.all_words, key_counts),
+                             (self.popular_words, popular_counts),
+                             (self.phrases, phrase_counts)):
+            for key, count in pairs:
+                table.add(key, count)
+
+    def merge(self, other):
+        """Add the counts of another WordCounts to these counts."""
+        if other is self:
+            other = WordCounts(self.capacity, self.ngrams,
+                               by_day=self.days is not None).merge(self)
+        if other.phrases is not None:
+            self.phrases.update(other.phrases)
+        if other.days is not None:
+            self.days.update(other.days)
+        self.all_words.update(other.all_words)
+        self.popular_words.update(other.popular_words)
+        return self
+
+
+class StateMismatch(ValueError):
+
+    """Raised when a state file was saved with different analysis settings."""
+
+
+class AnalysisState(object):
+
+    """The counts of an analysis and the ids of the items counted so far.
+
+    The state is saved to a file, so an analysis run again (e.g. daily) only
+    counts the submissions and comments it has not seen yet, and an analysis
+    that crashed resumes from its last checkpoint.
+
+    :param settings: the options the counts depend on; a state saved with
+        other settings cannot be resumed
+
+    :param interval: the minimum number of seconds between two checkpoints
+
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, settings=None, interval=60, counts=None):
+        self.path = path
+        self.settings = settings or {}
+        self.interval = interval
+        self.counts = WordCounts() if counts is None else counts
+        self.submissions = set()
+        self.comments = set()
+        self.last_saved = time.time()
+        # called before saving, e.g. to wait for pending counts
+        self.before_save = None
+
+    @classmethod
+    def load(cls, path, settings=None, interval=60, counts=None):
+        """Load the state saved in path, or start a new one with counts."""
+        state = cls(path, settings=settings, interval=interval, counts=counts)
+        if not os.path.exists(path):
+            return state
+
+        with open(path, "rb") as in_file:
+            saved = pickle.load(in_file)
+        if saved["version"] != cls.VERSION:
+            raise StateMismatch("{0} has an unknown version".format(path))
+        if saved["settings"] != state.settings:
+            raise StateMismatch("{0} was saved with other settings: {1}"
+                                .format(path, saved["settings"]))
+        state.counts = saved["counts"]
+        state.submissions = saved["submissions"]
+        state.comments = saved["comments"]
+        return state
+
+    def add_submission(self, submission_id):
+        """Record a submission, returning False if it was seen before."""
+        if submission_id in self.submissions:
+            return False
+        self.submissions.add(submission_id)
+        return True
+
+    def add_comment(self, comment_id):
+        """Record a comment, returning False if it was seen before."""
+        if comment_id in self.comments:
+            return False
+        self.comments.add(comment_id)
+        return True
+
+    def checkpoint(self):
+        """Save the state if the last save is older than the interval."""
+        if time.time() - self.last_saved >= self.interval:
+            self.save()
+
+    def save(self):
+        """Atomically replace the state file with the current state."""
+        if self.before_save is not None:
+            self.before_save()
+        saved = {"version": self.VERSION, "settings": self.settings,
+                 "counts": self.counts, "submissions": self.submissions,
+                 "comments": self.comments}
+        tmp_path = "{0}.tmp".format(self.path)
+        with open(tmp_path, "wb") as out_file:
+            pickle.dump(saved, out_file, protocol=pickle.HIGHEST_PROTOCOL)
+        replace_file(tmp_path, self.path)
+        self.last_saved = time.time()
 
 
 def tokenize(text):
-    """Return individual tokens from a block of text."""
-    def normalized_tokens(token):
-        """Yield lower-case tokens from the given token."""
-        for sub in TOKEN_RE.findall(token):
-            if sub:
-                yield sub.lower()
-
-    for token in text.split():  # first split on whitespace
-        if URL_RE.search(token):  # Ignore invalid tokens
-            continue
-        for sub_token in normalized_tokens(token):
-            if sub_token.endswith("'s"):  # Fix possessive form
-                sub_token = sub_token[:-2]
-            yield sub_token
+    """Return the list of the individual tokens of a block of text."""
+    return list(filter(None, SCAN_RE.findall(text.lower())))
+
+
+def tokenize_many(texts):
+    """Return the {token: count} Counter of the tokens of each text."""
+    findall = SCAN_RE.findall
+    return [Counter(filter(None, findall(text.lower()))) for text in texts]
+
+
+class TextMemo(object):
+
+    """Bounded LRU cache of the token counts of the texts parsed.
+
+    The tokens are counted by word, as the ids of the words depend on the
+    vocabulary of each analysis.
+
+    Entries are keyed by a SHA-1 digest of a text and whether it is markdown,
+    so repeated texts (bot replies, copypasta, reposted titles) are only
+    stripped and tokenized once, without keeping the texts themselves. Most
+    texts are never repeated, so the first time a text is seen only its key
+    is remembered, and its token counts are kept from its second time on.
+
+    :param size: the maximum number of texts remembered, 0 to remember none
+
+    """
+
+    def __init__(self, size=MEMO_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def key(text, is_markdown, ngrams=1):
+        if not isinstance(text, bytes):
+            text = text.encode("utf-8")
+        key = hashlib.sha1(text).digest() + (b"m" if is_markdown else b"t")
+        if ngrams > 1:
+            # the entries of an analysis of phrases also keep the tokens in order
+            key += str(ngrams).encode("ascii")
+        return key
+
+    def get(self, key):
+        """Return the entry of a key and mark it as recently used, or None."""
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+        return None if entry is _SEEN_ONCE else entry
+
+    def put(self, key, entry):
+        """Remember the entry of a key, or only the key the first time."""
+        self.entries[key] = entry if key in self.entries else _SEEN_ONCE
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
 
+    def __contains__(self, key):
+        """Whether a key was put, so its entry would be kept if put again."""
+        return key in self.entries
 
-def parse_text(text, count_word_freqs, max_threshold, is_markdown=True):
+    def clear(self):
+        self.entries.clear()
+
+    def resize(self, size):
+        self.size = size
+        while len(self.entries) > size:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+_SEEN_ONCE = object()
+
+# the token counts of the recently parsed texts
+TEXT_MEMO = TextMemo()
+
+
+def parse_text(text, counts, count_word_freqs, max_threshold, is_markdown=True,
+               created_utc=None):
     """Parse the passed in text and add words that are not common.
 
+    :param counts: the WordCounts to add the words to, and the phrases of up
+        to counts.ngrams words whose first and last words are not common
+
     :param count_word_freqs: if False, only count a word once per text block
         (title, selftext, comment body) rather than incrementing the total for
         each instance.
@@ -176,45 +837,260 @@ def parse_text(text, count_word_freqs, max_threshold, is_markdown=True):
 
     :param is_markdown: When True, parse as markdown and extract the text.
 
-    """
+    :param created_utc: the UTC timestamp of the submission or comment of the
+        text, to count its popular words in counts.days too
 
-    if is_markdown:
-        soup = BeautifulSoup(markdown(text), "lxml")
-        text = "".join(soup.findAll(text=True))
+    """
 
-    total = 0.0  # intentionally a float
-    text_words = defaultdict(int)
-    for token in tokenize(text):
-        total += 1
-        # add to the raw word list
-        all_words[token] += 1
-        if token not in COMMON_WORDS:
-            text_words[token] += 1
+    start = clock()
+    memo_key = memo = None
+    if TEXT_MEMO.size:
+        memo_key = TEXT_MEMO.key(text, is_markdown, counts.ngrams)
+        memo = TEXT_MEMO.get(memo_key)
+
+    # approximate counts are kept by word, exact ones by the ids of the words
+    # in the vocabulary of the counts
+    vocabulary = counts.vocabulary
+    words = None if vocabulary is None else vocabulary.words
+    token_ids = None
+    if memo is None:
+        if is_markdown:
+            text = strip_markdown(text)
+        markdown_done = clock()
+        tokens = list(tokenize(text))
+        tokenize_done = clock()
+
+        num_tokens = len(tokens)
+        if vocabulary is None:
+            key_counts = count_ids(tokens)
+        else:
+            token_ids = vocabulary.lookup(tokens)
+            key_counts = count_ids(token_ids)
+        if memo_key is not None:
+            # the counts are only kept from the second time a text is seen
+            entry = None
+            if memo_key in TEXT_MEMO:
+                word_counts = key_counts
+                if words is not None:
+                    word_counts = tuple((words[word_id], count)
+                                        for word_id, count in key_counts)
+                # the phrases are counted from the tokens in order
+                entry = (num_tokens, word_counts, tokens if counts.ngrams > 1 else ())
+            TEXT_MEMO.put(memo_key, entry)
+            STATS.counters["memo_misses"] += 1
+    else:
+        # a repeated text, only its counts are added
+        num_tokens, key_counts, tokens = memo
+        markdown_done = tokenize_done = start
+        STATS.counters["memo_hits"] += 1
+        if vocabulary is not None:
+            key_counts = list(zip(vocabulary.lookup([word for word, _ in key_counts]),
+                                  [count for _, count in key_counts]))
 
     # Count the popular words
-    for word, count in text_words.items():
-        if count / total <= max_threshold:
-            if count_word_freqs:
-                popular_words[word] += count
-            else:
-                popular_words[word] += 1
+    total = float(num_tokens)  # intentionally a float
+    if words is None:
+        popular_counts = [(word, count if count_word_freqs else 1)
+                          for word, count in key_counts
+                          if word not in COMMON_WORDS and count / total <= max_threshold]
+    else:
+        popular_counts = [(word_id, count if count_word_freqs else 1)
+                          for word_id, count in key_counts
+                          if words[word_id] not in COMMON_WORDS and
+                          count / total <= max_threshold]
+
+    # Count the phrases that neither start nor end with a common word
+    popular_phrases = ()
+    if counts.ngrams > 1:
+        if words is None:
+            common = set(word for word, _ in key_counts if word in COMMON_WORDS)
+            text_phrases = word_phrase_counts(tokens, counts.ngrams, common)
+        else:
+            common = [word_id for word_id, _ in key_counts if words[word_id] in COMMON_WORDS]
+            if token_ids is None:
+                token_ids = vocabulary.lookup(tokens)
+            text_phrases = phrases_without(phrase_counts(token_ids, counts.ngrams), common)
+        popular_phrases = [(key, count if count_word_freqs else 1)
+                           for key, count in text_phrases
+                           if count / total <= max_threshold]
+
+    # add to the raw word list, the popular words and phrases
+    counts.add_keys(key_counts, popular_counts, popular_phrases)
+    if counts.days is not None and created_utc is not None:
+        if words is not None:
+            popular_counts = [(words[key], count) for key, count in popular_counts]
+        counts.days.add(created_utc, popular_counts)
+
+    # parse_text only runs in one thread of a process, so this skips the
+    # lock of STATS
+    timers = STATS.timers
+    timers["markdown"] += markdown_done - start
+    timers["tokenize"] += tokenize_done - markdown_done
+    timers["count"] += clock() - tokenize_done
+    STATS.counters["texts"] += 1
+    STATS.counters["tokens"] += num_tokens
+
+
+def _init_parse_worker(common_words, memo_size):
+    """Set up a worker process of a ParsePool.
+
+    The word indexes of common_words are unpickled by reopening their files,
+    so every worker maps the same pages instead of copying the word lists.
+    Each worker remembers the token counts of the texts it parsed in its own
+    TextMemo.
+
+    """
+    global COMMON_WORDS, STATS, TEXT_MEMO
+    COMMON_WORDS = common_words
+    STATS = Stats()
+    TEXT_MEMO = TextMemo(memo_size)
+
+
+def _parse_batch(texts, count_word_freqs, max_threshold, ngrams=1, by_day=False):
+    """Parse a batch of (text, is_markdown, created_utc) in a worker process.
+
+    Returns the partial WordCounts of the batch and a snapshot of the stats
+    of its parsing.
+
+    """
+    STATS.reset()
+    counts = WordCounts(ngrams=ngrams, by_day=by_day)
+    for text, is_markdown, created_utc in texts:
+        parse_text(text=text, counts=counts, count_word_freqs=count_word_freqs,
+                   max_threshold=max_threshold, is_markdown=is_markdown,
+                   created_utc=created_utc)
+    return counts, STATS.snapshot()
 
 
-def with_status(iterable):
-    """Wrap an iterable outputting '.' for each item (up to 100 per line)."""
-    for i, item in enumerate(iterable):
-        sys.stderr.write(".")
-        sys.stderr.flush()
-        if i % 100 == 99:
-            sys.stderr.write("\n")
+class ParsePool(object):
+
+    """Parse text blocks in a pool of worker processes.
+
+    ``ParsePool.parse_text`` takes the same arguments as ``parse_text`` and can
+    be passed as the ``parse`` argument of the process_* functions. Text
+    blocks are sent to the workers in batches, and the partial WordCounts
+    returned by the workers are merged into the WordCounts the text blocks
+    were passed with, and their stats into STATS. As every text block is
+    counted independently, the result is the same as parsing serially.
+
+    """
+
+    def __init__(self, processes, batch_size=200):
+        import multiprocessing
+
+        self.processes = processes
+        self.batch_size = batch_size
+        self.batch = []
+        self.batch_counts = None
+        self.batch_args = None
+        self.pending = []
+        self.pool = multiprocessing.Pool(processes,
+                                         initializer=_init_parse_worker,
+                                         initargs=(COMMON_WORDS,
+                                                   TEXT_MEMO.size))
+
+    def parse_text(self, text, counts, count_word_freqs, max_threshold,
+                   is_markdown=True, created_utc=None):
+        """Queue a text block to be parsed by a worker."""
+        args = (count_word_freqs, max_threshold, counts.ngrams,
+                counts.days is not None)
+        if counts is not self.batch_counts or args != self.batch_args:
+            self.flush()
+            self.batch_counts = counts
+            self.batch_args = args
+        self.batch.append((text, is_markdown, created_utc))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Send the queued text blocks to a worker."""
+        if self.batch:
+            result = self.pool.apply_async(_parse_batch,
+                                           (self.batch,) + self.batch_args)
+            self.pending.append((self.batch_counts, result))
+            self.batch = []
+
+        # don't let the fetching get too far ahead of the parsing
+        while len(self.pending) > 2 * self.processes:
+            self._merge_oldest()
+
+    def drain(self):
+        """Wait for all the queued text blocks to be counted."""
+        self.flush()
+        while self.pending:
+            self._merge_oldest()
+
+    def finish(self):
+        """Wait for all the text blocks to be parsed and stop the workers."""
+        self.drain()
+        self.pool.close()
+        self.pool.join()
+
+    def imap_unordered(self, function, iterable):
+        """Call a function on each item in the workers, yielding the results
+        as they complete."""
+        return self.pool.imap_unordered(function, iterable)
+
+    def discard(self):
+        """Forget the queued text blocks, e.g. of an analysis that failed."""
+        self.batch = []
+        self.batch_counts = None
+        self.batch_args = None
+        self.pending = []
+
+    def terminate(self):
+        """Stop the workers, discarding the text blocks not yet counted."""
+        self.pool.terminate()
+        self.pool.join()
+
+    def _merge_oldest(self):
+        counts, result = self.pending.pop(0)
+        batch_counts, stats = result.get()
+        counts.merge(batch_counts)
+        STATS.merge(stats)
+
+
+def report_progress():
+    """Overwrite the progress line on stderr with the current rates."""
+    sys.stderr.write("\r{0} items ({1:.1f}/s), {2} texts, {3} tokens ({4:.0f}/s)"
+                     .format(STATS.counters["items"], STATS.rate("items"),
+                             STATS.counters["texts"], STATS.counters["tokens"],
+                             STATS.rate("tokens")))
+    sys.stderr.flush()
+
+
+def with_status(iterable, interval=1.0):
+    """Wrap an iterable reporting the progress every interval seconds.
+
+    The time waiting for the next item (e.g. the request of the next page of
+    a listing) is counted as fetching.
+
+    """
+    iterator = iter(iterable)
+    last_report = time.time()
+    while True:
+        start = clock()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            break
+        STATS.add_time("fetch", clock() - start)
+        STATS.count("items")
+        if time.time() - last_report >= interval:
+            report_progress()
+            last_report = time.time()
         yield item
 
+    report_progress()
     sys.stderr.write("\n")
 
 
-def process_redditor(redditor, limit, count_word_freqs, max_threshold):
+def process_redditor(redditor, counts, limit, count_word_freqs, max_threshold,
+                     parse=parse_text, state=None, shard=None):
     """Parse submissions and comments for the given Redditor.
 
+    :param counts: the WordCounts to add the words to
+
     :param limit: the maximum number of submissions to scrape from the
         subreddit
 
@@ -226,21 +1102,137 @@ def process_redditor(redditor, limit, count_word_freqs, max_threshold):
         appear to be considered in word counts. prevents word spamming in a
         single submission.
 
+    :param parse: the function the text blocks are passed to (parse_text,
+        or the parse_text method of a ParsePool)
+
+    :param state: the AnalysisState of an incremental analysis, whose
+        already seen items are skipped
+
+    :param shard: the Shard selecting the items to count, None to count
+        them all
+
     """
+    import praw
+
     for entry in with_status(iterable=redditor.get_overview(limit=limit)):
-        if isinstance(entry, praw.objects.Comment):  # Parse comment
-            parse_text(text=entry.body, count_word_freqs=count_word_freqs,
-                       max_threshold=max_threshold)
+        if shard is not None and not shard.selects(entry):
+            continue
+        if isinstance(entry, (praw.objects.Comment, CachedComment)):  # Parse comment
+            if state is None or state.add_comment(entry.id):
+                parse(text=entry.body, counts=counts,
+                      count_word_freqs=count_word_freqs,
+                      max_threshold=max_threshold,
+                      created_utc=getattr(entry, "created_utc", None))
         else:  # Parse submission
-            process_submission(submission=entry,
+            process_submission(submission=entry, counts=counts,
                                count_word_freqs=count_word_freqs,
                                max_threshold=max_threshold,
-                               include_comments=False)
+                               include_comments=False, parse=parse,
+                               state=state)
+        if state is not None:
+            state.checkpoint()
+
+
+def walk_comments(comments, more_limit=32):
+    """Yield the comments of a comment tree, expanding its MoreComments lazily.
 
+    The tree is walked depth first, each comment before its replies. A
+    MoreComments (anything with a ``comments`` method) is only expanded when
+    the walk reaches it, so the comments before it are parsed before it is
+    fetched and no list of all the comments is built. Unlike praw's
+    replace_more_comments, the tree is left as it is.
 
-def process_submission(submission, count_word_freqs, max_threshold, include_comments=True):
+    :param comments: the top-level comments of a submission
+
+    :param more_limit: the maximum number of MoreComments objects to expand
+        (each one requires a request), None for no limit; the ones reached
+        after the limit are skipped
+
+    """
+    remaining = more_limit
+    pending = [iter(comments)]
+    count = 0
+    try:
+        while pending:
+            item = next(pending[-1], None)
+            if item is None:
+                pending.pop()
+            elif hasattr(type(item), "comments"):
+                if remaining == 0 or not item.children:
+                    continue
+                with STATS.timer("expand"):
+                    expanded = item.comments(update=True)
+                if expanded is None:  # its comments are already in the tree
+                    continue
+                if remaining is not None:
+                    remaining -= 1
+                pending.append(iter(expanded))
+            else:
+                count += 1
+                yield item
+                if item.replies:
+                    pending.append(iter(item.replies))
+    finally:
+        STATS.count("comments", count)
+
+
+def iter_comments(submission, more_limit=32):
+    """Return an iterator over the comments of a submission.
+
+    Submissions that fetch or store their comments themselves (the stand-ins
+    of the cache and of asyncfetch) have an ``iter_comments(more_limit)``
+    method, the comment trees of the others are walked with walk_comments.
+
+    """
+    if hasattr(type(submission), "iter_comments"):
+        return submission.iter_comments(more_limit)
+    with STATS.timer("expand"):
+        comments = submission.comments
+    return walk_comments(comments, more_limit)
+
+
+def fetch_comments(submission, more_limit=32):
+    """Return the comments of a submission in a list.
+
+    :param more_limit: the maximum number of MoreComments objects to expand
+        (each one requires a request), None for no limit
+
+    """
+    return list(iter_comments(submission, more_limit))
+
+
+def prefetch_comments(submissions, threads, more_limit=32):
+    """Fetch the comments of several submissions at the same time.
+
+    Yields a ``(submission, result)`` pair for each submission, in order,
+    where ``result.get()`` returns the list of the submission's comments or
+    raises the error that occurred while fetching them. At most ``threads``
+    submissions are fetched ahead of the one being yielded.
+
+    """
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(threads)
+    pending = deque()
+    try:
+        for submission in submissions:
+            pending.append((submission, pool.apply_async(
+                fetch_comments, (submission, more_limit))))
+            if len(pending) > threads:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        pool.terminate()
+
+
+def process_submission(submission, counts, count_word_freqs, max_threshold,
+                       include_comments=True, parse=parse_text, more_limit=32,
+                       comments=None, state=None):
     """Parse a submission's text and body (if applicable).
 
+    :param counts: the WordCounts to add the words to
+
     :param count_word_freqs: if False, only count a word once per text block
         (title, selftext, comment body) rather than incrementing the total for
         for each instance.
@@ -251,26 +1243,54 @@ def process_submission(submission, count_word_freqs, max_threshold, include_comm
 
     :param include_comments: include the submission's comments when True
 
+    :param parse: the function the text blocks are passed to (parse_text,
+        or the parse_text method of a ParsePool)
+
+    :param more_limit: the maximum number of MoreComments objects to expand,
+        None for no limit
+
+    :param comments: the comments of the submission, when they were already
+        fetched; otherwise they are parsed while the comment tree is walked,
+        so an error expanding it leaves the comments before it counted
+
+    :param state: the AnalysisState of an incremental analysis, whose
+        already seen items are skipped
+
     """
     if include_comments:  # parse all the comments for the submission
-        submission.replace_more_comments()
-        for comment in praw.helpers.flatten_tree(submission.comments):
-            parse_text(text=comment.body, count_word_freqs=count_word_freqs,
-                       max_threshold=max_threshold)
+        if comments is None:
+            comments = iter_comments(submission, more_limit=more_limit)
+        for comment in comments:
+            if state is None or state.add_comment(comment.id):
+                parse(text=comment.body, counts=counts,
+                      count_word_freqs=count_word_freqs,
+                      max_threshold=max_threshold,
+                      created_utc=getattr(comment, "created_utc", None))
+
+    if state is not None and not state.add_submission(submission.id):
+        return  # the title and selftext were already counted
+
+    created_utc = getattr(submission, "created_utc", None)
 
     # parse the title of the submission
-    parse_text(text=submission.title, count_word_freqs=count_word_freqs,
-               max_threshold=max_threshold, is_markdown=False)
+    parse(text=submission.title, counts=counts,
+          count_word_freqs=count_word_freqs, max_threshold=max_threshold,
+          is_markdown=False, created_utc=created_utc)
 
     # parse the selftext of the submission (if applicable)
     if submission.is_self:
-        parse_text(text=submission.selftext, count_word_freqs=count_word_freqs,
-                   max_threshold=max_threshold)
+        parse(text=submission.selftext, counts=counts,
+              count_word_freqs=count_word_freqs, max_threshold=max_threshold,
+              created_utc=created_utc)
 
 
-def process_subreddit(subreddit, period, limit, count_word_freqs, max_threshold):
+def process_subreddit(subreddit, counts, period, limit, count_word_freqs, max_threshold,
+                      parse=parse_text, fetch_threads=1, more_limit=32,
+                      state=None, shard=None):
     """Parse comments, title text, and selftext in a given subreddit.
 
+    :param counts: the WordCounts to add the words to
+
     :param period: the time period to scrape the subreddit over (day, week,
     month, etc.)
 
@@ -285,15 +1305,46 @@ def process_subreddit(subreddit, period, limit, count_word_freqs, max_threshold)
         appear to be considered in word counts. prevents word spamming in a
         single submission.
 
+    :param parse: the function the text blocks are passed to (parse_text,
+        or the parse_text method of a ParsePool)
+
+    :param fetch_threads: the number of submissions to fetch the comments of
+        at the same time
+
+    :param more_limit: the maximum number of MoreComments objects to expand
+        per submission, None for no limit
+
+    :param state: the AnalysisState of an incremental analysis, whose
+        already seen items are skipped
+
+    :param shard: the Shard selecting the submissions to count (with their
+        comments), None to count them all
+
     """
 
     # determine period to count the words over
     params = {"t": period}
-    for submission in with_status(iterable=subreddit.get_top(limit=limit, params=params)):
+    from requests.exceptions import HTTPError
+
+    submissions = subreddit.get_top(limit=limit, params=params)
+    if shard is not None:
+        # before their comments are fetched
+        submissions = (submission for submission in submissions
+                       if shard.selects(submission))
+    if fetch_threads > 1:
+        fetched = prefetch_comments(submissions, threads=fetch_threads,
+                                    more_limit=more_limit)
+    else:
+        fetched = ((submission, None) for submission in submissions)
+
+    for submission, result in with_status(iterable=fetched):
         try:
-            process_submission(submission=submission,
+            process_submission(submission=submission, counts=counts,
                                count_word_freqs=count_word_freqs,
-                               max_threshold=max_threshold)
+                               max_threshold=max_threshold, parse=parse,
+                               more_limit=more_limit,
+                               comments=result.get() if result else None,
+                               state=state)
         except HTTPError as exc:
             sys.stderr.write("\nSkipping submission {0} due to HTTP status {1}"
                              " error. Continuing...\n"
@@ -303,118 +1354,600 @@ def process_subreddit(subreddit, period, limit, count_word_freqs, max_threshold)
             sys.stderr.write("\nSkipping submission {0} due to ValueError.\n"
                              .format(submission.permalink.encode("UTF-8")))
 
+        if state is not None:
+            state.checkpoint()
 
-def main():
-    # parse the command-line options and arguments
-    user, target, options = parse_cmd_line()
 
-    # Check for package updates
-    update_check(__name__, __version__)
+def most_common(word_counts, n=None):
+    """Return (word, count) pairs with the highest counts first.
 
-    # open connection to Reddit
-    handler = None
+    :param word_counts: an iterable of (word, count) pairs
 
-    if options.multiprocess:
-        from praw.handlers import MultiprocessHandler
-        handler = MultiprocessHandler()
+    :param n: the number of pairs to keep, None to keep them all. The top n
+        pairs are selected with a heap of n pairs instead of sorting them all.
 
-    reddit = praw.Reddit(
-        user_agent="/u/{0} reddit analyzer".format(user), handler=handler)
+    """
+    if n is None:
+        return sorted(word_counts, key=itemgetter(1), reverse=True)
+    return heapq.nlargest(n, word_counts, key=itemgetter(1))
 
-    reddit.config.decode_html_entities = True
 
-    # run analysis
-    sys.stderr.write("Analyzing {0}\n".format(target))
-    sys.stderr.flush()
+def write_word_counts(path, word_counts, echo=False, header=None):
+    """Write (word, count) pairs to a UTF-8 file, one ``word:count`` per line.
 
-    target = target[3:]
+    :param echo: also print the lines to the terminal
 
-    if options.is_subreddit:
-        process_subreddit(subreddit=reddit.get_subreddit(target),
-                          period=options.period, limit=options.limit,
-                          count_word_freqs=options.count_word_freqs,
-                          max_threshold=options.max_threshold)
-    else:
-        process_redditor(redditor=reddit.get_redditor(target), limit=options.limit,
-                         count_word_freqs=options.count_word_freqs,
-                         max_threshold=options.max_threshold)
+    :param header: a line written first as a ``#`` comment
+
+    """
+    with io.open(path, "w", encoding="utf-8") as out_file:
+        if header is not None:
+            out_file.write(u"# {0}\n".format(header))
+        for word, count in word_counts:
+            line = u"{0}:{1}\n".format(word, count)
+            out_file.write(line)
+            if echo:
+                sys.stdout.write(line)
 
-    # build a string containing all the words for the word cloud software
-    output = ""
 
-    # open output file to store the output string
-    out_file_name = "{0}.csv".format(target)
+def error_guarantees(table, kind="word"):
+    """Describe the error bounds of a SpaceSaving table of approximate counts.
 
-    if options.is_subreddit:
-        out_file_name = "subreddit-{0}".format(out_file_name)
-    else:
-        out_file_name = "user-{0}".format(out_file_name)
+    :param kind: what the table counts, "word" or "phrase"
+
+    """
+    return ("approximate counts of {0} {3}s with {1} counters: every count is"
+            " at most {2} too high, and every {3} used more than {2} times is"
+            " listed".format(table.total, table.capacity, table.max_error(), kind))
+
+
+def phrase_guarantees(table):
+    """Describe the error bounds of a PhraseTable that was pruned."""
+    return ("phrases used fewer than {0} times were dropped {1} times: every"
+            " count is at most {2} too low".format(table.min_count, table.prunes,
+                                                   table.max_error()))
+
+
+def write_output(counts, out_file_name, options, metadata=None):
+    """Write the word cloud file and the raw word counts of an analysis.
+
+    :param counts: the WordCounts of the analysis
+
+    :param out_file_name: the word cloud file, the raw counts are written to
+        the same name prefixed with "raw-", and the phrase counts prefixed
+        with "phrases-"
+
+    :param options: the parsed command-line options; with ``binary`` set,
+        each file is also written as a count file (see countfile.py)
+
+    :param metadata: the description of the analysis saved in the count
+        files, e.g. from run_metadata
+
+    """
+    all_words = counts.all_words
+
+    binary = getattr(options, "binary", False)
+    if binary:
+        metadata = dict(metadata or {}, distinct_words=len(all_words),
+                        words=sum(count for word, count in all_words.items()))
 
-    out_file = open(out_file_name, "w")
+    def write_binary(path, word_counts, **extra):
+        if not binary:
+            return
+        from .countfile import COUNTS_SUFFIX, write_count_file
+
+        extra.update(metadata)
+        write_count_file(os.path.splitext(path)[0] + COUNTS_SUFFIX, word_counts,
+                         extra)
 
     # combine singular and plural forms of words into single count
-    for word in list(popular_words.keys()):
-        count = popular_words[word]
-
-        # e.g.: "picture" and "pictures"
-        if word.endswith("s"):
-            # if the singular form of the word was used
-            singular = word[:-1]
-            if popular_words[singular] > 0:
-
-                # combine the count into the most-used form of the word
-                if popular_words[singular] > count:
-                    popular_words[singular] += popular_words[word]
-                    del popular_words[word]
-                else:
-                    popular_words[word] += popular_words[singular]
-                    del popular_words[singular]
-
-        # e.g.: "furry" and "furries"
-        if word.endswith("ies"):
-            # if the singular form of the word was used
-            singular = "{0}y".format(word[:-3])
-            if popular_words[singular] > 0:
-                # combine the count into the most-used form of the word
-                if popular_words[singular] > count:
-                    popular_words[singular] += popular_words[word]
-                    del popular_words[word]
-                else:
-                    popular_words[word] += popular_words[singular]
-                    del popular_words[singular]
-
-    for word in sorted(popular_words, key=popular_words.get, reverse=True):
-        # tweak this number depending on the subreddit
-        # some subreddits end up having TONS of words and it seems to overflow
-        # the Python string buffer
-        if popular_words[word] > 5:
-            pri = True
-
-            # don't print the word if it's just a number
-            if word.isdigit():
-                pri = False
-
-            # add as many copies of the word as it was mentioned in the
-            # subreddit
-            if pri:
-                out_text = str("{0}:{1}\n".format(word.encode('utf-8'), popular_words[word]))
-                output += out_text
-                out_file.write(out_text)
-
-    out_file.close()
+    # e.g.: "picture" and "pictures", "furry" and "furries"
+    popular_words = merge_plurals(counts.popular_words)
+
+    # only output the words used more than 5 times that are not just numbers
+    # tweak this number depending on the subreddit
+    popular_words = ((word, count) for word, count in popular_words.items()
+                     if count > 5 and not word.isdigit())
 
     # print the series of words for the word cloud software
     # place this text into wordle.net
-    if options.verbose:
-        print(output)
+    popular_words = most_common(popular_words, options.top)
+    write_word_counts(out_file_name, popular_words, echo=options.verbose)
+    write_binary(out_file_name, popular_words)
 
     # save the raw word counts to a file
     if not options.no_raw_data:
-        out_file = open("raw-{0}".format(out_file_name), "w")
-        for word in sorted(all_words, key=all_words.get, reverse=True):
-            out_text = str("{0}:{1}\n".format(word.encode('utf-8'), all_words[word]))
-            out_file.write(out_text)
-        out_file.close()
+        header = None
+        if counts.capacity is not None:
+            header = error_guarantees(all_words)
+            sys.stderr.write("{0}\n".format(header))
+        raw_words = most_common(all_words.items(), options.top)
+        write_word_counts("raw-{0}".format(out_file_name), raw_words,
+                          header=header)
+        write_binary("raw-{0}".format(out_file_name), raw_words,
+                     guarantees=header)
+
+    # save the phrases used more than 5 times too
+    if counts.phrases is not None:
+        header = None
+        if counts.capacity is not None:
+            header = error_guarantees(counts.phrases, "phrase")
+        elif counts.phrases.prunes:
+            header = phrase_guarantees(counts.phrases)
+        if header is not None:
+            sys.stderr.write("{0}\n".format(header))
+        phrases = most_common(((phrase, count) for phrase, count
+                               in counts.phrases.items() if count > 5),
+                              options.top)
+        write_word_counts("phrases-{0}".format(out_file_name), phrases,
+                          header=header)
+        write_binary("phrases-{0}".format(out_file_name), phrases,
+                     guarantees=header)
+
+
+def write_partial(counts, target_name, label, items, options):
+    """Write the counts of an analysis with --partial to a shard file.
+
+    :param label: the part of the name of the shard file naming the items
+        counted
+
+    :param items: describes the items counted, as a JSON object
+
+    """
+    from .shards import shard_path, write_shard
+
+    if not os.path.isdir(options.partial):
+        os.makedirs(options.partial)
+    path = shard_path(options.partial, target_name, label)
+    settings = analysis_settings(options)
+    if not options.dumps:
+        # the shards of a crawl must list the same submissions
+        settings.update(period=options.period, limit=options.limit)
+    write_shard(path, target_name, settings, counts, items)
+    sys.stderr.write("Wrote {0}\n".format(path))
+
+
+def write_timeline(counts, target_name, options):
+    """Write the popular word counts per day of an analysis with --timeline.
+
+    :param counts: the WordCounts of the analysis
+
+    :param target_name: the name of the directory of the target in the
+        timeline directory
+
+    :param options: the parsed command-line options
+
+    """
+    if options.timeline is None or counts.days is None:
+        return
+    Timeline(os.path.join(options.timeline, target_name)).write(counts.days)
+
+
+def check_for_update():
+    """Start checking PyPI for a newer release in a background thread.
+
+    Returns the thread, whose ``result`` attribute is set to the
+    UpdateResult to print once a newer release was found. update_checker
+    caches the answer of PyPI for an hour, so runs in a row do not query it.
+
+    """
+    def check():
+        try:
+            from update_checker import UpdateChecker
+            thread.result = UpdateChecker().check(__name__, __version__)
+        except Exception:  # the update check must never break an analysis
+            pass
+
+    thread = threading.Thread(target=check)
+    thread.daemon = True
+    thread.result = None
+    thread.start()
+    return thread
+
+
+def main():
+    # parse the command-line options and arguments
+    user, targets, options = parse_cmd_line()
+
+    STATS.reset()
+    profiler = None
+    if options.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        return analyze(user, targets, options)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(options.profile)
+        if options.stats:
+            STATS.dump(options.stats)
+        if options.verbose:
+            STATS.report()
+
+
+def analyze(user, targets, options):
+    """Run the analyses of subreddits and redditors and write their output.
+
+    The targets are analyzed one after the other in the same session, sharing
+    the connection to Reddit, the cache and the worker processes. A target
+    that fails is reported and skipped. Returns 1 if any target failed.
+
+    :param user: the reddit username used in the user agent
+
+    :param targets: the /r/subreddits and /u/redditors to analyze
+
+    :param options: the parsed command-line options
+
+    """
+    update = None
+    reddit = None
+    if not options.offline:
+        # Check for package updates while the analysis runs
+        if not options.no_update_check:
+            update = check_for_update()
+
+    cache = None
+    if options.cache_dir:
+        # cached text never expires while replaying it
+        cache = ResponseCache.open_dir(
+            options.cache_dir,
+            ttl=None if options.offline else options.cache_ttl * 60 * 60,
+            max_size=int(options.cache_size * 1024 * 1024))
+
+    if not (options.offline or options.dumps):
+        # open connection to Reddit
+        user_agent = "/u/{0} reddit analyzer".format(user)
+        if options.connections:
+            from .asyncfetch import AsyncReddit
+
+            reddit = AsyncReddit(user_agent, connections=options.connections,
+                                 more_limit=options.more_limit, stats=STATS,
+                                 cache=cache)
+        else:
+            import praw
+
+            handler = None
+
+            if options.multiprocess:
+                from praw.handlers import MultiprocessHandler
+                handler = MultiprocessHandler()
+
+            reddit = praw.Reddit(user_agent=user_agent, handler=handler)
+
+            reddit.config.decode_html_entities = True
+
+    # parse the text in worker processes while the main process fetches
+    pool = None
+    if options.jobs:
+        pool = ParsePool(processes=options.jobs)
+
+    failed = []
+    start = time.time()
+    try:
+        if options.dumps:
+            failed = analyze_dumps(targets, pool, options)
+        else:
+            for number, target in enumerate(targets, 1):
+                if len(targets) > 1:
+                    sys.stderr.write("[{0}/{1}] ".format(number, len(targets)))
+                error = None
+                try:
+                    analyze_target(target, reddit, cache, pool, options)
+                except StateMismatch as exc:
+                    error = "Cannot resume the analysis: {0}".format(exc)
+                except CacheMiss as exc:
+                    error = "Cannot replay offline: {0}".format(exc)
+                except Exception as exc:  # one failed target must not stop a batch
+                    error = "{0}: {1}".format(type(exc).__name__, exc)
+                    if options.verbose:
+                        traceback.print_exc()
+                if error is not None:
+                    if pool is not None:
+                        pool.discard()
+                    sys.stderr.write("Skipping {0}. {1}\n".format(target, error))
+                    failed.append(target)
+        if pool is not None:
+            pool.finish()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if cache is not None:
+            cache.close()
+        if options.connections and reddit is not None:
+            reddit.close()
+
+    if len(targets) > 1 and not options.dumps:
+        sys.stderr.write("Analyzed {0} of {1} targets in {2:.1f}s\n".format(
+            len(targets) - len(failed), len(targets), time.time() - start))
+        if failed:
+            sys.stderr.write("Failed: {0}\n".format(" ".join(failed)))
+
+    if update is not None:
+        update.join(UPDATE_CHECK_TIMEOUT)
+        if update.result:
+            print(update.result)
+
+    return 1 if failed else 0
+
+
+def parse_records(records, routes, count_word_freqs, max_threshold,
+                  parse=parse_text):
+    """Parse the texts of dump records into the WordCounts of their targets.
+
+    :param routes: maps ("r", subreddit) and ("u", author) pairs, with
+        lower-case names, to the WordCounts of the targets
+
+    :param parse: the function the text blocks are passed to (parse_text,
+        or the parse_text method of a ParsePool)
+
+    """
+    from .dumps import record_texts
+
+    for record in records:
+        keys = (("r", (record.get("subreddit") or "").lower()),
+                ("u", (record.get("author") or "").lower()))
+        for key in keys:
+            counts = routes.get(key)
+            if counts is None:
+                continue
+            for text, is_markdown in record_texts(record):
+                parse(text=text, counts=counts,
+                      count_word_freqs=count_word_freqs,
+                      max_threshold=max_threshold, is_markdown=is_markdown,
+                      created_utc=record.get("created_utc"))
+
+
+def _ingest_dump(path, keys, dump_filter, count_word_freqs, max_threshold,
+                 capacity, ngrams=1, min_count=1, by_day=False):
+    """Parse a whole dump file in a worker process of a ParsePool.
+
+    Returns the path, the WordCounts of each route key and a snapshot of the
+    stats of the parsing, or the path and the error raised reading the file.
+
+    """
+    from .dumps import dump_errors, open_dump, read_records
+
+    STATS.reset()
+    routes = dict((key, WordCounts(capacity, ngrams, min_count, by_day))
+                  for key in keys)
+    try:
+        stream = open_dump(path)
+        try:
+            parse_records(read_records(stream, dump_filter), routes,
+                          count_word_freqs, max_threshold)
+        finally:
+            stream.close()
+    except dump_errors() as exc:
+        return path, exc
+    return path, (routes, STATS.snapshot())
+
+
+def analyze_dumps(targets, pool, options):
+    """Count the words of the targets in local dump files and write their output.
+
+    The dumps are read in a single pass for all the targets. With a ParsePool
+    and several dumps, each dump is read and parsed by a worker process, so
+    the decompression is spread across the cores too. Returns the dumps that
+    could not be read.
+
+    :param targets: the /r/subreddits and /u/redditors to count the words of
+
+    :param pool: the ParsePool parsing the text, None to parse it in this
+        process
+
+    :param options: the parsed command-line options
+
+    """
+    from .dumps import DumpFilter, dump_errors, open_dump, read_records
+
+    capacity = None
+    if options.approximate is not None:
+        capacity = capacity_for_error(options.approximate)
+    keys = [(target[1], target[3:].lower()) for target in targets]
+    by_day = options.timeline is not None
+    routes = OrderedDict((key, WordCounts(capacity, options.ngrams,
+                                          options.min_count, by_day))
+                         for key in keys)
+    dump_filter = DumpFilter(
+        subreddits=[name for kind, name in routes if kind == "r"],
+        authors=[name for kind, name in routes if kind == "u"],
+        after=options.after, before=options.before)
+
+    failed = []
+    if pool is not None and len(options.dumps) > 1:
+        ingest = partial(_ingest_dump, keys=list(routes),
+                         dump_filter=dump_filter,
+                         count_word_freqs=options.count_word_freqs,
+                         max_threshold=options.max_threshold,
+                         capacity=capacity, ngrams=options.ngrams,
+                         min_count=options.min_count, by_day=by_day)
+        sys.stderr.write("Reading {0} dumps\n".format(len(options.dumps)))
+        for path, result in with_status(
+                pool.imap_unordered(ingest, options.dumps)):
+            if isinstance(result, Exception):
+                sys.stderr.write("\nSkipping {0}. {1}\n".format(path, result))
+                failed.append(path)
+                continue
+            dump_routes, stats = result
+            for key, counts in dump_routes.items():
+                routes[key].merge(counts)
+            STATS.merge(stats)
+    else:
+        parse = parse_text if pool is None else pool.parse_text
+        for path in options.dumps:
+            sys.stderr.write("Reading {0}\n".format(path))
+            try:
+                stream = open_dump(path)
+                try:
+                    parse_records(with_status(read_records(stream, dump_filter)),
+                                  routes, options.count_word_freqs,
+                                  options.max_threshold, parse=parse)
+                finally:
+                    stream.close()
+            except dump_errors() as exc:
+                sys.stderr.write("\nSkipping {0}. {1}\n".format(path, exc))
+                failed.append(path)
+        if pool is not None:
+            pool.drain()
+
+    for target, key in zip(targets, keys):
+        if target.startswith("/r/"):
+            target_name = "subreddit-{0}".format(target[3:])
+        else:
+            target_name = "user-{0}".format(target[3:])
+        with STATS.timer("output"):
+            if options.partial:
+                # the dumps of each machine are different
+                names = sorted(os.path.basename(path) for path in options.dumps
+                               if path not in failed)
+                label = "dumps-{0}".format(hashlib.sha1(
+                    "\n".join(names).encode("utf-8")).hexdigest()[:8])
+                write_partial(routes[key], target_name, label,
+                              {"dumps": names, "after": options.after,
+                               "before": options.before}, options)
+                continue
+            # the dumps are read once for all the targets
+            write_output(routes[key], "{0}.csv".format(target_name), options,
+                         run_metadata(target_name, options, STATS.counters))
+            write_timeline(routes[key], target_name, options)
+    return failed
+
+
+def analysis_settings(options):
+    """Return the options the counts of an analysis depend on.
+
+    The counts of a state or of shards can only be added to counts made
+    with the same settings.
+
+    """
+    settings = {"count_word_freqs": options.count_word_freqs,
+                "max_threshold": options.max_threshold,
+                "include_dictionary": options.include_dictionary}
+    # only set when used, so the states saved before these options resume
+    if options.approximate is not None:
+        settings["approximate"] = options.approximate
+    if options.ngrams > 1:
+        settings["ngrams"] = options.ngrams
+        settings["min_count"] = options.min_count
+    if options.timeline is not None:
+        settings["by_day"] = True
+    return settings
+
+
+def run_metadata(target_name, options, counters):
+    """Return the description of an analysis saved in its count files.
+
+    :param counters: the STATS counters of the items of the analysis
+
+    """
+    metadata = analysis_settings(options)
+    metadata.update(target=target_name, version=__version__,
+                    created_utc=int(time.time()), period=options.period,
+                    limit=options.limit, after=options.after,
+                    before=options.before,
+                    dumps=[os.path.basename(path) for path in options.dumps])
+    for name in ("items", "comments", "texts", "tokens"):
+        metadata[name] = counters.get(name, 0)
+    return metadata
+
+
+def analyze_target(target, reddit, cache, pool, options):
+    """Run the analysis of a subreddit or redditor and write its output.
+
+    :param target: the /r/subreddit or /u/redditor to analyze
+
+    :param reddit: the praw.Reddit (or AsyncReddit) to fetch from, None to
+        replay the analysis from the cache
+
+    :param cache: the ResponseCache to go through, or None
+
+    :param pool: the ParsePool parsing the text, None to parse it in this
+        process
+
+    :param options: the parsed command-line options
+
+    """
+    # run analysis
+    sys.stderr.write("Analyzing {0}\n".format(target))
+    sys.stderr.flush()
+    counters = dict(STATS.counters)
+
+    is_subreddit = target.startswith("/r/")
+    target = target[3:]
+
+    if is_subreddit:
+        target_name = "subreddit-{0}".format(target)
+    else:
+        target_name = "user-{0}".format(target)
+
+    # resume the counts of the previous runs
+    state = None
+    capacity = None
+    if options.approximate is not None:
+        capacity = capacity_for_error(options.approximate)
+    counts = WordCounts(capacity, options.ngrams, options.min_count,
+                        options.timeline is not None)
+    if options.state_dir:
+        if not os.path.isdir(options.state_dir):
+            os.makedirs(options.state_dir)
+        state = AnalysisState.load(
+            os.path.join(options.state_dir, "{0}.state".format(target_name)),
+            settings=analysis_settings(options), interval=options.checkpoint,
+            counts=counts)
+        counts = state.counts
+
+    if is_subreddit:
+        subreddit = None if reddit is None else reddit.get_subreddit(target)
+        if cache is not None:
+            subreddit = cache.subreddit(target, subreddit,
+                                        more_limit=options.more_limit)
+    else:
+        redditor = None if reddit is None else reddit.get_redditor(target)
+        if cache is not None:
+            redditor = cache.redditor(target, redditor)
+
+    parse = parse_text
+    if pool is not None:
+        parse = pool.parse_text
+        if state is not None:
+            state.before_save = pool.drain
+
+    if is_subreddit:
+        process_subreddit(subreddit=subreddit,
+                          counts=counts, period=options.period,
+                          limit=options.limit,
+                          count_word_freqs=options.count_word_freqs,
+                          max_threshold=options.max_threshold, parse=parse,
+                          fetch_threads=options.fetch_threads,
+                          more_limit=options.more_limit, state=state,
+                          shard=options.shard)
+    else:
+        process_redditor(redditor=redditor,
+                         counts=counts, limit=options.limit,
+                         count_word_freqs=options.count_word_freqs,
+                         max_threshold=options.max_threshold, parse=parse,
+                         state=state, shard=options.shard)
+    if pool is not None:
+        pool.drain()
+    if state is not None:
+        state.save()
+
+    with STATS.timer("output"):
+        if options.partial:
+            shard = options.shard
+            write_partial(counts, target_name,
+                          "all" if shard is None else shard.label(),
+                          {} if shard is None else shard.to_json(), options)
+            return
+        # the counters of this target alone, in a batch
+        counters = dict((name, count - counters.get(name, 0))
+                        for name, count in STATS.counters.items())
+        write_output(counts, "{0}.csv".format(target_name), options,
+                     run_metadata(target_name, options, counters))
+        write_timeline(counts, target_name, options)
 
 
 if __name__ == "__main__":
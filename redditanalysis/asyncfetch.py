@@ -0,0 +1,613 @@
+"""
+    Asynchronous fetching of subreddits and redditors through the JSON API of
+    reddit.
+
+    AsyncReddit stands in for praw.Reddit: it fetches the listings, comment
+    trees and "load more comments" expansions with asyncio, over a pool of
+    persistent HTTP connections, so many requests are in flight at once. The
+    requests are spread over the rate limit budget reddit reports in the
+    X-Ratelimit headers of its responses by a TokenBucket.
+
+    The event loop runs in a background thread. The submissions and comments
+    are handed to the main thread as CachedSubmission and CachedComment
+    objects, in listing order, with their comments already expanded, so the
+    process_* functions parse them like any other.
+
+    This module requires Python 3.5 or later, and is only imported with
+    --connections.
+"""
+
+import asyncio
+import json
+import queue
+import ssl
+import threading
+import time
+import zlib
+from collections import deque
+from urllib.parse import urlencode, urlsplit
+
+from .cache import CachedComment, CachedSubmission
+
+REDDIT_URL = "https://www.reddit.com"
+
+# requests per second until reddit reports its budget (PRAW waits 2 seconds
+# between requests)
+DEFAULT_RATE = 0.5
+
+# items of a listing page, comments of a submission requested at once, and
+# hidden comments expanded by each /api/morechildren request
+LISTING_PAGE = 100
+COMMENT_LIMIT = 500
+MORE_CHILDREN = 100
+
+# retries of the requests failing with a 429 or 5xx status
+MAX_RETRIES = 3
+
+# items fetched ahead of the main thread
+PREFETCH = 64
+
+
+def http_error(url, status):
+    """Return the requests HTTPError PRAW raises for an error status."""
+    from requests.exceptions import HTTPError
+    from requests.models import Response
+
+    response = Response()
+    response.status_code = status
+    response.url = url
+    return HTTPError("{0} error fetching {1}".format(status, url),
+                     response=response)
+
+
+class TokenBucket(object):
+
+    """Spreads requests over a rate limit.
+
+    Tokens accumulate at ``rate`` per second up to ``burst``, and each request
+    takes one, waiting for it when there is none left. ``update`` sets the
+    rate from the budget reddit reports: the requests remaining in the
+    current window, less the ones in flight, spread evenly over the seconds
+    until the window resets. The waiting requests check the bucket again
+    when they wake up, so they follow the rate changes.
+
+    :param clock: the function returning the current time in seconds
+
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=1, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+        self.pending = 0
+        # no request is sent before this time once the budget is used up
+        self.resume = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """Take a token if there is one, else return the seconds to wait."""
+        now = self.clock()
+        self._refill(now)
+        if now < self.resume:
+            return self.resume - now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.pending += 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while True:
+            wait = self.take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def done(self):
+        """Mark the request of a token as answered."""
+        self.pending -= 1
+
+    def update(self, remaining, reset):
+        """Set the rate from the budget reported in a response.
+
+        :param remaining: the requests remaining in the current window
+
+        :param reset: the seconds until the window resets
+
+        """
+        now = self.clock()
+        self._refill(now)
+        reset = max(reset, 1.0)
+        budget = remaining - self.pending
+        if budget < 1:
+            self.tokens = min(self.tokens, 0)
+            self.resume = now + reset
+        else:
+            self.rate = budget / reset
+            self.resume = 0
+
+
+class Response(object):
+
+    def __init__(self, status, headers, body, keep_alive=True):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.keep_alive = keep_alive
+
+    def json(self):
+        return json.loads(self.body.decode("utf-8"))
+
+
+async def read_response(reader):
+    """Read an HTTP/1.1 response from an asyncio StreamReader."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError("connection closed by the server")
+    version, status = status_line.split(None, 2)[:2]
+    status = int(status)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    keep_alive = (version == b"HTTP/1.1" and
+                  headers.get("connection", "").lower() != "close")
+    if status in (204, 304):
+        body = b""
+    elif headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        # skip the trailers
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        body = b"".join(chunks)
+    elif "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+    else:  # the body ends with the connection
+        body = await reader.read()
+        keep_alive = False
+
+    if headers.get("content-encoding", "").lower() == "gzip":
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    return Response(status, headers, body, keep_alive)
+
+
+class ConnectionPool(object):
+
+    """Persistent HTTP connections to a server, reused between requests.
+
+    :param base_url: the scheme, host and port of the server, and the path
+        prefixed to the requested paths
+
+    :param size: the maximum number of connections, i.e. of requests in
+        flight
+
+    :param headers: the headers sent with every request
+
+    :param timeout: the seconds to wait for a response
+
+    """
+
+    def __init__(self, base_url, size=8, headers=None, timeout=30):
+        url = urlsplit(base_url)
+        self.host = url.hostname
+        self.secure = url.scheme == "https"
+        self.port = url.port or (443 if self.secure else 80)
+        self.prefix = url.path.rstrip("/")
+        self.ssl = ssl.create_default_context() if self.secure else None
+        self.size = size
+        self.headers = dict(headers or {})
+        self.timeout = timeout
+        self.idle = []
+        self.opened = 0
+        # created in the event loop by the first request
+        self.slots = None
+
+    def _request(self, target):
+        lines = ["GET {0} HTTP/1.1".format(target),
+                 "Host: {0}".format(self.host),
+                 "Accept-Encoding: gzip",
+                 "Connection: keep-alive"]
+        lines.extend("{0}: {1}".format(name, value)
+                     for name, value in self.headers.items())
+        return "\r\n".join(lines + ["", ""]).encode("latin-1")
+
+    async def get(self, path, params=None):
+        """Return the Response to a GET request."""
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.size)
+        target = self.prefix + path
+        if params:
+            target = "{0}?{1}".format(target, urlencode(sorted(params.items())))
+
+        async with self.slots:
+            while True:
+                reused = bool(self.idle)
+                if reused:
+                    reader, writer = self.idle.pop()
+                else:
+                    reader, writer = await asyncio.open_connection(
+                        self.host, self.port, ssl=self.ssl)
+                    self.opened += 1
+                try:
+                    writer.write(self._request(target))
+                    response = await asyncio.wait_for(read_response(reader),
+                                                      self.timeout)
+                except BaseException as exc:
+                    writer.close()
+                    # the server may have closed an idle connection
+                    if reused and isinstance(exc, (ConnectionError,
+                                                   asyncio.IncompleteReadError)):
+                        continue
+                    raise
+                if response.keep_alive:
+                    self.idle.append((reader, writer))
+                else:
+                    writer.close()
+                return response
+
+    def close(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+
+class FetchedSubmission(CachedSubmission):
+
+    """A submission fetched by AsyncReddit, with its expanded comments.
+
+    :param error: the error raised fetching the comments, raised again by
+        ``iter_comments``
+
+    """
+
+    def __init__(self, id, title, selftext, permalink, created_utc=None,
+                 comments=(), error=None):
+        CachedSubmission.__init__(self, id, title, selftext, permalink,
+                                  created_utc, comments)
+        self.error = error
+
+    def iter_comments(self, more_limit=32):
+        from . import walk_comments
+
+        if self.error is not None:
+            raise self.error
+        return walk_comments(self.comments, more_limit)
+
+
+def _walk_comments(things, comments, more):
+    """Collect the comments of a tree of things, breadth first like PRAW.
+
+    The comments are appended to ``comments`` and the ids of the hidden
+    comments of "more" things to ``more``.
+
+    """
+    pending = deque([things])
+    while pending:
+        for thing in pending.popleft():
+            data = thing["data"]
+            if thing["kind"] == "t1":
+                comments.append(CachedComment(data["id"], data["body"],
+                                              data.get("created_utc")))
+                if data.get("replies"):
+                    pending.append(data["replies"]["data"]["children"])
+            elif thing["kind"] == "more":
+                more.extend(data["children"])
+
+
+class _Channel(object):
+
+    """Bounded channel from a coroutine of the event loop to another thread."""
+
+    def __init__(self, loop, size):
+        self.loop = loop
+        self.size = size
+        self.items = queue.Queue()
+        self.space = None
+
+    async def put(self, item):
+        if self.space is None:
+            self.space = asyncio.Semaphore(self.size)
+        await self.space.acquire()
+        self.items.put(item)
+
+    def get(self):
+        item = self.items.get()
+        self.loop.call_soon_threadsafe(self.space.release)
+        return item
+
+
+class _Failure(object):
+
+    def __init__(self, error):
+        self.error = error
+
+
+_DONE = object()
+
+
+async def _start_task(coroutine):
+    return asyncio.ensure_future(coroutine)
+
+
+async def _cancel_task(task):
+    """Cancel a task and wait for it to finish."""
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+class AsyncReddit(object):
+
+    """Stand-in for praw.Reddit fetching with asyncio.
+
+    :param user_agent: the User-Agent header of the requests
+
+    :param connections: the number of persistent HTTP connections, i.e. of
+        requests in flight
+
+    :param more_limit: the maximum number of /api/morechildren requests per
+        submission, each expanding up to MORE_CHILDREN hidden comments, None
+        for no limit
+
+    :param url: the URL of reddit, or of a stand-in server
+
+    :param stats: a Stats counting the requests
+
+    :param rate: the requests per second until reddit reports its budget
+
+    :param cache: the ResponseCache the listings go through, whose cached
+        comment trees are not fetched again
+
+    """
+
+    def __init__(self, user_agent, connections=8, more_limit=32,
+                 url=REDDIT_URL, stats=None, rate=DEFAULT_RATE, cache=None):
+        self.url = url.rstrip("/")
+        self.connections = connections
+        self.more_limit = more_limit
+        self.stats = stats
+        self.cache = cache
+        self.pool = ConnectionPool(self.url, size=connections,
+                                   headers={"User-Agent": user_agent})
+        self.bucket = TokenBucket(rate)
+        self.loop = None
+        self.thread = None
+
+    def get_subreddit(self, name):
+        return AsyncSubreddit(self, name)
+
+    def get_redditor(self, name):
+        return AsyncRedditor(self, name)
+
+    def close(self):
+        """Close the connections and stop the event loop thread."""
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self.pool.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = self.thread = None
+
+    def _start(self):
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self._run_loop)
+            self.thread.daemon = True
+            self.thread.start()
+        return self.loop
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def stream(self, crawl, *args):
+        """Yield the items a crawl coroutine puts, in the calling thread.
+
+        The crawl runs in the event loop as ``crawl(put, *args)``, and is
+        cancelled when the generator is closed.
+
+        """
+        loop = self._start()
+        channel = _Channel(loop, PREFETCH)
+        task = asyncio.run_coroutine_threadsafe(
+            _start_task(self._feed(channel, crawl, *args)), loop).result()
+        try:
+            while True:
+                item = channel.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+        finally:
+            asyncio.run_coroutine_threadsafe(_cancel_task(task), loop).result()
+
+    async def _feed(self, channel, crawl, *args):
+        try:
+            await crawl(channel.put, *args)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            await channel.put(_Failure(exc))
+        else:
+            await channel.put(_DONE)
+
+    async def get_json(self, path, params):
+        """Return the JSON of an API path, within the rate limit.
+
+        Raises an HTTPError for error statuses, after retrying the 429 and
+        5xx ones.
+
+        """
+        params = dict((name, value) for name, value in params.items()
+                      if value is not None)
+        for attempt in range(MAX_RETRIES + 1):
+            await self.bucket.acquire()
+            try:
+                response = await self.pool.get(path, params)
+            finally:
+                self.bucket.done()
+            if self.stats is not None:
+                self.stats.count("requests")
+
+            remaining = response.headers.get("x-ratelimit-remaining")
+            reset = response.headers.get("x-ratelimit-reset")
+            if remaining is not None and reset is not None:
+                self.bucket.update(float(remaining), float(reset))
+
+            if response.status == 200:
+                return response.json()
+            if attempt < MAX_RETRIES and (response.status == 429 or
+                                          response.status >= 500):
+                if remaining is None:  # the bucket cannot tell when to retry
+                    await asyncio.sleep(2 ** attempt)
+                continue
+            break
+        raise http_error(self.url + path, response.status)
+
+    async def listing(self, path, params, limit, put_thing):
+        """Page through a listing, passing its things to a coroutine."""
+        after = None
+        count = 0
+        while limit is None or count < limit:
+            page = await self.get_json(path, dict(
+                params, after=after, raw_json=1,
+                limit=LISTING_PAGE if limit is None else
+                min(LISTING_PAGE, limit - count)))
+            children = page["data"]["children"]
+            for thing in children:
+                count += 1
+                await put_thing(thing)
+            after = page["data"]["after"]
+            if not after or not children:
+                break
+
+    async def submission(self, data):
+        """Return the FetchedSubmission of a listed submission, with its comments.
+
+        The errors fetching the comments are raised by the ``iter_comments``
+        of the submission, so only that submission is skipped. The comments
+        of the submissions whose comments are cached are not fetched.
+
+        """
+        from requests.exceptions import HTTPError
+
+        id = data["id"]
+        if self.cache is not None and self.cache.has_comments(id, self.more_limit):
+            return self._submission(data)
+        comments = []
+        error = None
+        try:
+            page = await self.get_json("/comments/{0}.json".format(id),
+                                       {"limit": COMMENT_LIMIT, "raw_json": 1})
+            more = []
+            _walk_comments(page[1]["data"]["children"], comments, more)
+
+            # expand the hidden comments, many requests at a time
+            requests = 0
+            while more and (self.more_limit is None or requests < self.more_limit):
+                batches = []
+                while more and (self.more_limit is None or
+                                requests + len(batches) < self.more_limit):
+                    batches.append(more[:MORE_CHILDREN])
+                    del more[:MORE_CHILDREN]
+                requests += len(batches)
+                results = await asyncio.gather(*[
+                    self.get_json("/api/morechildren.json", {
+                        "api_type": "json", "link_id": "t3_{0}".format(id),
+                        "children": ",".join(batch), "raw_json": 1})
+                    for batch in batches])
+                for result in results:
+                    _walk_comments(result["json"]["data"]["things"], comments,
+                                   more)
+        except (HTTPError, ValueError) as exc:
+            error = exc
+        except (asyncio.TimeoutError, OSError) as exc:
+            # skipped like the empty responses
+            error = ValueError("no response fetching the comments of {0}: {1!r}"
+                               .format(id, exc))
+        return self._submission(data, comments, error)
+
+    def _submission(self, data, comments=(), error=None):
+        selftext = data.get("selftext", "") if data.get("is_self") else ""
+        return FetchedSubmission(data["id"], data["title"], selftext,
+                                 self.url + data["permalink"],
+                                 data.get("created_utc"), comments, error)
+
+
+class AsyncSubreddit(object):
+
+    def __init__(self, reddit, name):
+        self.reddit = reddit
+        self.display_name = name
+
+    def get_top(self, limit=None, params=None):
+        """Yield the top submissions, with their comments fetched ahead."""
+        period = (params or {}).get("t", "day")
+        return self.reddit.stream(self._crawl, limit, period)
+
+    async def _crawl(self, put, limit, period):
+        reddit = self.reddit
+        pending = deque()
+
+        async def put_thing(thing):
+            pending.append(asyncio.ensure_future(reddit.submission(thing["data"])))
+            # hand over the submissions fetched so far, in listing order
+            while pending and (pending[0].done() or
+                               len(pending) > 2 * reddit.connections):
+                await put(await pending.popleft())
+
+        try:
+            await reddit.listing("/r/{0}/top.json".format(self.display_name),
+                                 {"t": period}, limit, put_thing)
+            while pending:
+                await put(await pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+class AsyncRedditor(object):
+
+    def __init__(self, reddit, name):
+        self.reddit = reddit
+        self.name = name
+
+    def get_overview(self, limit=None):
+        """Yield the comments and submissions of the redditor."""
+        return self.reddit.stream(self._crawl, limit)
+
+    async def _crawl(self, put, limit):
+        reddit = self.reddit
+
+        async def put_thing(thing):
+            data = thing["data"]
+            if thing["kind"] == "t1":
+                await put(CachedComment(data["id"], data["body"],
+                                        data.get("created_utc")))
+            else:
+                await put(reddit._submission(data))
+
+        await reddit.listing("/user/{0}/overview.json".format(self.name), {},
+                             limit, put_thing)
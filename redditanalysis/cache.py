@@ -0,0 +1,452 @@
+"""
+    On-disk cache of the text fetched from Reddit.
+
+    The title, selftext and comment bodies of every submission, the comments
+    of redditors and the listings they came from are stored in an SQLite
+    database, so re-running an analysis with different settings does not
+    download everything again. Entries expire after a time to live, and the
+    oldest entries are evicted when the cache grows past its maximum size.
+    Listings and comment trees record the ``--limit`` and ``--more-limit``
+    they were fetched with, and are only used by runs asking for as many
+    items.
+
+    The cached objects stand in for the PRAW objects the process_* functions
+    use, so an analysis can also be replayed entirely from the cache.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_FILE_NAME = "responses.sqlite3"
+
+# the entries of caches of other versions are dropped when they are opened
+SCHEMA_VERSION = 2
+
+# number of entries stored between two evictions
+EVICT_INTERVAL = 256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    key TEXT PRIMARY KEY,
+    fetched REAL NOT NULL,
+    items TEXT NOT NULL,
+    item_limit INTEGER
+);
+CREATE TABLE IF NOT EXISTS submissions (
+    id TEXT PRIMARY KEY,
+    fetched REAL NOT NULL,
+    size INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    selftext TEXT NOT NULL,
+    permalink TEXT NOT NULL,
+    created_utc REAL,
+    comments TEXT,
+    more_limit INTEGER
+);
+CREATE TABLE IF NOT EXISTS comments (
+    id TEXT PRIMARY KEY,
+    fetched REAL NOT NULL,
+    size INTEGER NOT NULL,
+    body TEXT NOT NULL,
+    created_utc REAL
+);
+CREATE INDEX IF NOT EXISTS submissions_fetched ON submissions (fetched);
+CREATE INDEX IF NOT EXISTS comments_fetched ON comments (fetched);
+"""
+
+DROP_SCHEMA = """
+DROP TABLE IF EXISTS listings;
+DROP TABLE IF EXISTS submissions;
+DROP TABLE IF EXISTS comments;
+"""
+
+
+def covers(stored, wanted):
+    """Return True if entries fetched with a limit hold those of another one.
+
+    The limits are numbers of items or requests, None for no limit.
+
+    """
+    return stored is None or (wanted is not None and stored >= wanted)
+
+
+class CacheMiss(Exception):
+
+    """Raised in offline mode when a listing or comment tree was never cached,
+    or with a lower limit."""
+
+
+class CachedComment(object):
+
+    """A comment read from the cache."""
+
+    __slots__ = ("id", "body", "created_utc", "replies")
+
+    def __init__(self, id, body, created_utc=None):
+        self.id = id
+        self.body = body
+        self.created_utc = created_utc
+        self.replies = ()
+
+
+class CachedSubmission(object):
+
+    """A submission read from the cache.
+
+    ``comments`` holds the already expanded and flattened comments of the
+    submission, and ``more_limit`` the limit they were expanded with (None
+    for no limit). ``comments_fetched`` is False for the submissions cached
+    without their comments (e.g. from the overview of a redditor), whose
+    ``comments`` are empty.
+
+    """
+
+    def __init__(self, id, title, selftext, permalink, created_utc=None,
+                 comments=None, more_limit=None):
+        self.id = id
+        self.title = title
+        self.selftext = selftext
+        self.is_self = bool(selftext)
+        self.permalink = permalink
+        self.created_utc = created_utc
+        self.comments_fetched = comments is not None
+        self.comments = list(comments or ())
+        self.more_limit = more_limit
+
+
+class ResponseCache(object):
+
+    """SQLite cache of the text of submissions, comments and listings.
+
+    :param path: the SQLite database file
+
+    :param ttl: the number of seconds after which entries expire, None for
+        no expiry
+
+    :param max_size: the maximum number of characters of text to keep, the
+        entries fetched the longest ago are evicted past it. None for no limit
+
+    """
+
+    def __init__(self, path, ttl=24 * 60 * 60, max_size=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.puts = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            version = self.db.execute("PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                self.db.executescript(DROP_SCHEMA)
+            self.db.executescript(SCHEMA)
+            self.db.execute("PRAGMA user_version = {0}".format(SCHEMA_VERSION))
+
+    @classmethod
+    def open_dir(cls, cache_dir, **kwargs):
+        """Open the cache kept in the given directory, creating it if needed."""
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        return cls(os.path.join(cache_dir, CACHE_FILE_NAME), **kwargs)
+
+    def close(self):
+        self.evict()
+        with self.lock:
+            self.db.close()
+
+    def _fresh_after(self, offline):
+        """Return the time entries must have been fetched after to be used."""
+        if offline or self.ttl is None:
+            return 0
+        return time.time() - self.ttl
+
+    def get_listing(self, key, limit=None, offline=False):
+        """Return the (kind, id) pairs of a cached listing, or None.
+
+        :param limit: the number of items wanted, None for all; a listing
+            cached with a lower limit is not returned
+
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT items, item_limit FROM listings"
+                " WHERE key = ? AND fetched >= ?",
+                (key, self._fresh_after(offline))).fetchone()
+        if row is None or not covers(row[1], limit):
+            return None
+        return [tuple(item) for item in json.loads(row[0])]
+
+    def put_listing(self, key, items, limit=None):
+        """Store the (kind, id) pairs of a listing fetched with a limit."""
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)",
+                (key, time.time(), json.dumps(items), limit))
+
+    def get_submission(self, id, offline=False):
+        """Return the CachedSubmission with the given id, or None."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT id, title, selftext, permalink, created_utc, comments,"
+                " more_limit FROM submissions WHERE id = ? AND fetched >= ?",
+                (id, self._fresh_after(offline))).fetchone()
+        if row is None:
+            return None
+        comments = None
+        if row[5] is not None:
+            comments = [CachedComment(*comment) for comment in json.loads(row[5])]
+        return CachedSubmission(*row[:5], comments=comments, more_limit=row[6])
+
+    def has_comments(self, id, more_limit=0, offline=False):
+        """Return True if the comments of the submission are cached.
+
+        :param more_limit: the number of MoreComments objects that must have
+            been expanded, None for all of them
+
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT more_limit FROM submissions WHERE id = ? AND fetched >= ?"
+                " AND comments IS NOT NULL",
+                (id, self._fresh_after(offline))).fetchone()
+        return row is not None and covers(row[0], more_limit)
+
+    def put_submission(self, submission, comments=None, more_limit=None):
+        """Store the text of a submission and its flattened comments.
+
+        Pass ``comments=None`` when the comments of the submission were not
+        fetched.
+
+        :param more_limit: the maximum number of MoreComments objects expanded
+            fetching the comments, None for no limit
+
+        """
+        if comments is not None:
+            comments = json.dumps([
+                (comment.id, comment.body, getattr(comment, "created_utc", None))
+                for comment in comments])
+        title = submission.title
+        selftext = submission.selftext if submission.is_self else ""
+        size = len(title) + len(selftext) + len(comments or "")
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO submissions"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (submission.id, time.time(), size, title, selftext,
+                 submission.permalink, getattr(submission, "created_utc", None),
+                 comments, more_limit))
+        self._stored()
+
+    def get_comment(self, id, offline=False):
+        """Return the CachedComment with the given id, or None."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT id, body, created_utc FROM comments"
+                " WHERE id = ? AND fetched >= ?",
+                (id, self._fresh_after(offline))).fetchone()
+        return None if row is None else CachedComment(*row)
+
+    def put_comment(self, comment):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO comments VALUES (?, ?, ?, ?, ?)",
+                (comment.id, time.time(), len(comment.body), comment.body,
+                 getattr(comment, "created_utc", None)))
+        self._stored()
+
+    def _stored(self):
+        """Evict entries every EVICT_INTERVAL entries stored."""
+        self.puts += 1
+        if self.puts % EVICT_INTERVAL == 0:
+            self.evict()
+
+    def _size(self):
+        return self.db.execute(
+            "SELECT (SELECT IFNULL(SUM(size), 0) FROM submissions) +"
+            " (SELECT IFNULL(SUM(size), 0) FROM comments)").fetchone()[0]
+
+    def size(self):
+        """Return the number of characters of text in the cache."""
+        with self.lock:
+            return self._size()
+
+    def evict(self):
+        """Remove the expired entries and the oldest entries past max_size."""
+        with self.lock, self.db:
+            if self.ttl is not None:
+                expired = time.time() - self.ttl
+                for table in ("listings", "submissions", "comments"):
+                    self.db.execute(
+                        "DELETE FROM {0} WHERE fetched < ?".format(table),
+                        (expired,))
+
+            if self.max_size is None:
+                return
+            size = self._size()
+            if size <= self.max_size:
+                return
+
+            # walk the entries from the oldest until enough text was removed
+            oldest = self.db.execute(
+                "SELECT 'submissions', id, size, fetched FROM submissions"
+                " UNION ALL SELECT 'comments', id, size, fetched FROM comments"
+                " ORDER BY fetched").fetchall()
+            for table, id, entry_size, _ in oldest:
+                if size <= self.max_size:
+                    break
+                self.db.execute(
+                    "DELETE FROM {0} WHERE id = ?".format(table), (id,))
+                size -= entry_size
+
+    def subreddit(self, name, subreddit=None, more_limit=32):
+        """Return a stand-in for a subreddit that goes through the cache.
+
+        :param subreddit: the praw Subreddit to fetch missing entries from,
+            None to replay the subreddit from the cache only
+
+        :param more_limit: the maximum number of MoreComments objects the
+            comment trees are expanded with, None for no limit
+
+        """
+        return CachingSubreddit(self, name, subreddit, more_limit)
+
+    def redditor(self, name, redditor=None):
+        """Return a stand-in for a redditor that goes through the cache.
+
+        :param redditor: the praw Redditor to fetch the overview from, None to
+            replay the overview from the cache only
+
+        """
+        return CachingRedditor(self, name, redditor)
+
+
+class _CachingSubmission(object):
+
+    """Proxy of a praw Submission storing its comments once they were read."""
+
+    def __init__(self, cache, submission):
+        self._cache = cache
+        self._submission = submission
+
+    def __getattr__(self, attr):
+        return getattr(self._submission, attr)
+
+    def iter_comments(self, more_limit=32):
+        """Yield the comments of the submission, storing them once all were read."""
+        from . import iter_comments
+
+        comments = []
+        for comment in iter_comments(self._submission, more_limit):
+            comments.append(CachedComment(comment.id, comment.body,
+                                          getattr(comment, "created_utc", None)))
+            yield comment
+        self._cache.put_submission(self._submission, comments, more_limit)
+
+
+class _CachingListing(object):
+
+    def __init__(self, cache, name, thing=None, more_limit=32):
+        self.cache = cache
+        self.name = name
+        self.thing = thing
+        self.offline = thing is None
+        self.more_limit = more_limit
+
+    def _replay(self, key, limit, with_comments=False):
+        """Yield the cached items of a listing.
+
+        Raises CacheMiss if one of the items was evicted, as the counts of
+        the listing would be incomplete.
+
+        :param with_comments: raise CacheMiss for the submissions whose
+            comments were not cached, or with a lower more_limit
+
+        """
+        items = self.cache.get_listing(key, limit, offline=True)
+        if items is None:
+            raise CacheMiss("{0} is not in the cache{1}".format(
+                key, "" if limit is None else " with {0} items".format(limit)))
+        for kind, id in items[:limit]:
+            if kind == "t1":
+                item = self.cache.get_comment(id, offline=True)
+            else:
+                item = self.cache.get_submission(id, offline=True)
+                if (item is not None and with_comments and
+                        not (item.comments_fetched and
+                             covers(item.more_limit, self.more_limit))):
+                    raise CacheMiss("the comments of {0} are not in the cache"
+                                    " with a more limit of {1}".format(
+                                        id, self.more_limit))
+            if item is None:
+                raise CacheMiss("{0} of {1} was evicted from the cache".format(
+                    id, key))
+            yield item
+
+    def _store(self, key, items, limit, complete):
+        """Store the items of a listing read up to the end or interrupted."""
+        if not complete:
+            limit = len(items)
+        elif limit is not None and len(items) < limit:
+            limit = None  # the listing has no more items
+        self.cache.put_listing(key, items, limit)
+
+
+class CachingSubreddit(_CachingListing):
+
+    """Stand-in for a praw Subreddit whose submissions go through the cache."""
+
+    def get_top(self, limit=None, params=None):
+        key = "top:/r/{0}:{1}".format(self.name.lower(),
+                                      (params or {}).get("t", "day"))
+        if self.offline:
+            for submission in self._replay(key, limit, with_comments=True):
+                yield submission
+            return
+
+        items = []
+        complete = False
+        try:
+            for submission in self.thing.get_top(limit=limit, params=params):
+                items.append(("t3", submission.id))
+                cached = None
+                if self.cache.has_comments(submission.id, self.more_limit):
+                    cached = self.cache.get_submission(submission.id)
+                yield cached or _CachingSubmission(self.cache, submission)
+            complete = True
+        finally:
+            if items:
+                self._store(key, items, limit, complete)
+
+
+class CachingRedditor(_CachingListing):
+
+    """Stand-in for a praw Redditor whose overview goes through the cache."""
+
+    def get_overview(self, limit=None):
+        key = "overview:/u/{0}".format(self.name.lower())
+        if self.offline:
+            for entry in self._replay(key, limit):
+                yield entry
+            return
+
+        import praw
+
+        items = []
+        complete = False
+        try:
+            for entry in self.thing.get_overview(limit=limit):
+                if isinstance(entry, (praw.objects.Comment, CachedComment)):
+                    items.append(("t1", entry.id))
+                    self.cache.put_comment(entry)
+                else:
+                    items.append(("t3", entry.id))
+                    if not self.cache.has_comments(entry.id):
+                        self.cache.put_submission(entry)
+                yield entry
+            complete = True
+        finally:
+            if items:
+                self._store(key, items, limit, complete)
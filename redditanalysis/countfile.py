@@ -0,0 +1,181 @@
+"""
+    Memory-mapped word count files.
+
+    With ``--binary``, the word counts of an analysis are also written to
+    ``.counts`` files next to the csv files. Loading them does not parse
+    anything: the file is memory-mapped, the count of a word is found by
+    probing a hash table in place, and the most used words come first, so
+    reading the top k words only touches k entries.
+
+    File layout (little endian):
+
+    * header: magic ``RAWC``, version, number of words, number of slots,
+      length of the metadata
+    * metadata: the settings and totals of the analysis, as UTF-8 JSON
+    * counts: the 64-bit counts of the words, highest first
+    * offsets: the 32-bit offsets of the words in the strings, and the length
+      of the strings last
+    * slots: (crc32 of the word, 1 + rank of the word) pairs of 32-bit
+      integers, 0 ranks marking the empty slots
+    * strings: the UTF-8 words, one after the other
+"""
+
+import json
+import mmap
+import os
+import struct
+import sys
+
+from .hashslots import SLOT, build_slots, pack_slots, probe
+
+try:
+    from os import replace as replace_file
+except ImportError:  # Python 2, where rename replaces files on POSIX
+    from os import rename as replace_file
+
+MAGIC = b"RAWC"
+VERSION = 1
+
+COUNTS_SUFFIX = ".counts"
+
+_HEADER = struct.Struct("<4sIIII")
+_COUNT = struct.Struct("<q")
+_OFFSET = struct.Struct("<I")
+# the offsets of a word and of the next one
+_SPAN = struct.Struct("<II")
+
+
+def write_count_file(path, word_counts, metadata=None):
+    """Write (word, count) pairs to a count file, in the order given.
+
+    The file is written next to path first and moved in place, so readers
+    never see a partial file.
+
+    :param word_counts: (word, count) pairs, the highest counts first
+
+    :param metadata: a JSON object describing the counts
+
+    """
+    encoded = [(word.encode("utf-8"), count) for word, count in word_counts]
+    strings = [data for data, _ in encoded]
+    num_slots, slots = build_slots((data, rank) for rank, data in enumerate(strings))
+    offsets = []
+    offset = 0
+    for data in strings:
+        offsets.append(offset)
+        offset += len(data)
+    offsets.append(offset)
+    if offset > 0xffffffff:
+        raise ValueError("too many words for a count file")
+
+    metadata = json.dumps(metadata or {}, sort_keys=True).encode("utf-8")
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as out_file:
+        out_file.write(_HEADER.pack(MAGIC, VERSION, len(encoded), num_slots,
+                                    len(metadata)))
+        out_file.write(metadata)
+        out_file.write(struct.pack("<{0}q".format(len(encoded)),
+                                   *[count for data, count in encoded]))
+        out_file.write(struct.pack("<{0}I".format(len(offsets)), *offsets))
+        out_file.write(pack_slots(slots))
+        out_file.write(b"".join(strings))
+    replace_file(tmp_path, path)
+
+
+class CountFile(object):
+
+    """A read-only, memory-mapped count file.
+
+    Supports ``in``, ``len``, ``[word]`` (KeyError for the words not counted)
+    and iterating over the words, the most used first. Pickling a CountFile
+    only pickles its path, the unpickled copy maps the same file.
+
+    :param path: the file written by write_count_file
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as in_file:
+            self.map = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.num_words, self.num_slots,
+         metadata_length) = _HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            self.map.close()
+            raise ValueError("{0} is not a version {1} count file".format(
+                path, VERSION))
+        start = _HEADER.size
+        self.metadata = json.loads(self.map[start:start + metadata_length]
+                                   .decode("utf-8"))
+        self.counts_at = start + metadata_length
+        self.offsets_at = self.counts_at + self.num_words * _COUNT.size
+        self.slots_at = self.offsets_at + (self.num_words + 1) * _OFFSET.size
+        self.strings_at = self.slots_at + self.num_slots * SLOT.size
+
+    def count(self, rank):
+        """Return the count of the word of a rank, 0 for the most used."""
+        return _COUNT.unpack_from(self.map, self.counts_at + rank * _COUNT.size)[0]
+
+    def _data(self, rank):
+        start, end = _SPAN.unpack_from(self.map,
+                                       self.offsets_at + rank * _OFFSET.size)
+        return self.map[self.strings_at + start:self.strings_at + end]
+
+    def word(self, rank):
+        """Return the word of a rank, 0 for the most used."""
+        return self._data(rank).decode("utf-8")
+
+    def rank(self, word):
+        """Return the rank of a word, None if it was not counted."""
+        data = word.encode("utf-8")
+        for rank in probe(self.map, self.slots_at, self.num_slots, data):
+            if self._data(rank) == data:
+                return rank
+        return None
+
+    def get(self, word, default=None):
+        rank = self.rank(word)
+        return default if rank is None else self.count(rank)
+
+    def __getitem__(self, word):
+        rank = self.rank(word)
+        if rank is None:
+            raise KeyError(word)
+        return self.count(rank)
+
+    def __contains__(self, word):
+        return self.rank(word) is not None
+
+    def top(self, n=None):
+        """Return the (word, count) pairs of the n most used words."""
+        if n is None or n > self.num_words:
+            n = self.num_words
+        return [(self.word(rank), self.count(rank)) for rank in range(n)]
+
+    def items(self):
+        return iter(self.top())
+
+    def __iter__(self):
+        return (self.word(rank) for rank in range(self.num_words))
+
+    def __len__(self):
+        return self.num_words
+
+    def __reduce__(self):
+        return (self.__class__, (self.path,))
+
+    def close(self):
+        self.map.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python -m redditanalysis.countfile FILE [WORD ...]")
+    count_file = CountFile(sys.argv[1])
+    if len(sys.argv) == 2:
+        print(json.dumps(count_file.metadata, indent=2, sort_keys=True))
+        pairs = count_file.top(10)
+    else:
+        pairs = [(word, count_file.get(word, 0)) for word in sys.argv[2:]]
+    for word, count in pairs:
+        print(u"{0}:{1}".format(word, count))
@@ -0,0 +1,163 @@
+"""
+    Reading local dumps of reddit submissions and comments.
+
+    Dumps like the Pushshift monthly archives hold one JSON object per line,
+    a submission (with a title) or a comment (with a body). They are streamed
+    line by line with large buffered reads, plain or compressed with gzip,
+    bz2, xz or zstd (which requires the zstandard package), so files of any
+    size are read in constant memory.
+"""
+
+import bz2
+import gzip
+import io
+import json
+import zlib
+
+# bytes read from the disk at once
+READ_BUFFER = 1 << 20
+
+# zstd window of the Pushshift dumps, larger than the default maximum
+ZSTD_WINDOW = 1 << 31
+
+# the texts of deleted and removed items
+PLACEHOLDERS = frozenset([u"[deleted]", u"[removed]"])
+
+
+def open_dump(path):
+    """Open a dump file as a binary stream, decompressing it by its extension."""
+    raw = io.open(path, "rb", buffering=READ_BUFFER)
+    try:
+        if path.endswith(".gz"):
+            return gzip.GzipFile(fileobj=raw)
+        if path.endswith(".bz2"):
+            return bz2.BZ2File(raw)
+        if path.endswith(".xz"):
+            import lzma
+            return lzma.LZMAFile(raw)
+        if path.endswith(".zst"):
+            try:
+                import zstandard
+            except ImportError:
+                raise IOError("reading .zst dumps requires the zstandard"
+                              " package (pip install zstandard)")
+            reader = zstandard.ZstdDecompressor(
+                max_window_size=ZSTD_WINDOW).stream_reader(raw, read_size=READ_BUFFER)
+            return io.BufferedReader(reader, READ_BUFFER)
+    except Exception:
+        raw.close()
+        raise
+    return raw
+
+
+def dump_errors():
+    """Return the exception types raised reading a truncated or corrupt dump.
+
+    Besides IOError and EOFError, each decompressor raises errors of its own,
+    and lzma and zstandard are only imported when they are installed.
+
+    """
+    errors = [IOError, OSError, EOFError, ValueError, zlib.error]
+    try:
+        import lzma
+        errors.append(lzma.LZMAError)
+    except ImportError:  # Python 2
+        pass
+    try:
+        import zstandard
+        errors.append(zstandard.ZstdError)
+    except ImportError:
+        pass
+    return tuple(errors)
+
+
+class DumpFilter(object):
+
+    """Selects the records of a dump by subreddit, author and creation time.
+
+    A record is selected if it was posted in one of the subreddits or by one
+    of the authors (any record when neither is given), and created in the
+    time window.
+
+    :param after: the UTC timestamp the records must be created at or after,
+        None for no limit
+
+    :param before: the UTC timestamp the records must be created before,
+        None for no limit
+
+    """
+
+    def __init__(self, subreddits=(), authors=(), after=None, before=None):
+        self.subreddits = frozenset(name.lower() for name in subreddits)
+        self.authors = frozenset(name.lower() for name in authors)
+        self.after = after
+        self.before = before
+        # one of the quoted names appears in the line of a selected record,
+        # which is much faster to check than decoding the line
+        self.needles = [json.dumps(name).encode("utf-8")
+                        for name in self.subreddits | self.authors]
+
+    def may_match(self, line):
+        """Return False if the record of a line cannot be selected."""
+        if not self.needles:
+            return True
+        line = line.lower()
+        return any(needle in line for needle in self.needles)
+
+    def matches(self, record):
+        if self.needles:
+            subreddit = (record.get("subreddit") or "").lower()
+            author = (record.get("author") or "").lower()
+            if subreddit not in self.subreddits and author not in self.authors:
+                return False
+        if self.after is not None or self.before is not None:
+            created_utc = record.get("created_utc")
+            if created_utc is None:
+                return False
+            created_utc = float(created_utc)  # a string in some dumps
+            if self.after is not None and created_utc < self.after:
+                return False
+            if self.before is not None and created_utc >= self.before:
+                return False
+        return True
+
+
+def read_records(stream, dump_filter=None):
+    """Yield the records of a dump stream selected by a DumpFilter.
+
+    Lines that are not valid JSON objects (e.g. a truncated last line) are
+    skipped.
+
+    """
+    for line in stream:
+        if dump_filter is not None and not dump_filter.may_match(line):
+            continue
+        try:
+            record = json.loads(line.decode("utf-8"))
+        except ValueError:
+            continue
+        if not isinstance(record, dict):
+            continue
+        if dump_filter is None or dump_filter.matches(record):
+            yield record
+
+
+def record_texts(record):
+    """Return the (text, is_markdown) pairs of a comment or submission record.
+
+    Like process_submission, the selftext of a submission is only used for
+    self posts. The placeholders of deleted and removed texts are skipped.
+
+    """
+    if "body" in record:
+        body = record["body"]
+        return [] if not body or body in PLACEHOLDERS else [(body, True)]
+
+    texts = []
+    title = record.get("title")
+    if title:
+        texts.append((title, False))
+    selftext = record.get("selftext")
+    if record.get("is_self") and selftext and selftext not in PLACEHOLDERS:
+        texts.append((selftext, True))
+    return texts
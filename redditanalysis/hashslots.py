@@ -0,0 +1,78 @@
+"""
+    Open addressing hash tables of words, probed in place in mapped files.
+
+    The word indexes (wordindex.py) and the count files (countfile.py) find a
+    word through a table of slots, each the crc32 of a word and 1 + a value
+    locating the word in the file, 0 values marking the empty slots. There
+    are at least LOAD_FACTOR times as many slots as words, and a word is in
+    the first slot from its crc32 (modulo the number of slots) that is empty
+    or holds it, wrapping around. Older files sized the tables to powers of
+    two, which probe the same way.
+"""
+
+import struct
+import zlib
+
+SLOT = struct.Struct("<II")
+
+# the number of slots of an empty table
+MIN_SLOTS = 8
+
+# slots per word: 2/3 of the slots used keeps probe runs short
+LOAD_FACTOR = 1.5
+
+
+def crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+def build_slots(entries):
+    """Return the slots of a table of (UTF-8 word, value) pairs.
+
+    :returns: the number of slots, and the slots as a flat list of 32-bit
+        integers, the crc32 and 1 + value of each slot in turn
+
+    """
+    entries = list(entries)
+    num_slots = max(MIN_SLOTS, int(LOAD_FACTOR * len(entries)) + 1)
+
+    slots = [0] * (2 * num_slots)
+    for data, value in entries:
+        crc = crc32(data)
+        slot = crc % num_slots
+        while slots[2 * slot + 1]:
+            slot += 1
+            if slot == num_slots:
+                slot = 0
+        slots[2 * slot] = crc
+        slots[2 * slot + 1] = value + 1
+    return num_slots, slots
+
+
+def pack_slots(slots):
+    """Return the slots of build_slots as the bytes of the table."""
+    return struct.pack("<{0}I".format(len(slots)), *slots)
+
+
+def probe(buffer, slots_at, num_slots, data):
+    """Yield the values of the slots of a table whose crc32 is the one of a
+    word, in probing order.
+
+    The word is in the table if it is the word of one of the values.
+
+    :param buffer: the mapped file holding the table
+
+    :param slots_at: the offset of the table in the buffer
+
+    """
+    crc = crc32(data)
+    slot = crc % num_slots
+    while True:
+        slot_crc, value = SLOT.unpack_from(buffer, slots_at + slot * SLOT.size)
+        if not value:
+            return
+        if slot_crc == crc:
+            yield value - 1
+        slot += 1
+        if slot == num_slots:
+            slot = 0
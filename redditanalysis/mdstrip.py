@@ -0,0 +1,672 @@
+"""
+    Fast extraction of the visible text from Reddit markdown.
+
+    Rendering a comment with ``markdown()`` and collecting the text nodes of
+    the resulting HTML with BeautifulSoup is by far the most expensive step of
+    a crawl. ``strip_markdown`` produces the same visible text -- link text,
+    code spans, quotes, headers and list items, without URLs, image sources
+    or list markers -- by walking the markdown block by block and applying
+    the inline rules with regular expressions, without ever building an HTML
+    document.
+
+    The block and inline rules follow those of Python-Markdown, which is what
+    ``parse_text`` used to render comments with.
+"""
+
+import re
+
+try:
+    from html import unescape
+except ImportError:  # Python 2
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+
+TAB_LENGTH = 4
+
+# Quotes and lists nested deeper than this are parsed as flat text, so that a
+# comment of hundreds of "> " does not exhaust the stack
+MAX_NESTING = 32
+
+# Stashed inline text is replaced by a placeholder so that later inline rules
+# cannot match inside it (same placeholder format as Python-Markdown).
+STX = "\x02"
+ETX = "\x03"
+PLACEHOLDER = STX + "klzzwxh:{0}" + ETX
+PLACEHOLDER_RE = re.compile(STX + r"klzzwxh:(\d+)" + ETX)
+
+# Characters that can be backslash escaped
+ESCAPED_CHARS = set("\\`*_{}[]()>#+-.!")
+
+# Tags that start a raw HTML block when found at the start of a block
+BLOCK_TAGS = set([
+    "address", "article", "aside", "blockquote", "body", "canvas", "center",
+    "dd", "details", "dialog", "dir", "div", "dl", "dt", "fieldset",
+    "figcaption", "figure", "footer", "form", "frameset", "h1", "h2", "h3",
+    "h4", "h5", "h6", "header", "hgroup", "hr", "html", "iframe", "legend",
+    "li", "main", "map", "menu", "nav", "noscript", "object", "ol", "p",
+    "pre", "script", "section", "style", "summary", "table", "tbody", "td",
+    "tfoot", "th", "thead", "tr", "ul", "video"])
+
+#
+# Block level rules
+#
+EMPTY_LINE_RE = re.compile(r"(?<=\n) +\n")
+CODE_INDENT = " " * TAB_LENGTH
+HASH_HEADER_RE = re.compile(
+    r"(?:^|\n)(?P<level>#{1,6})(?P<header>(?:\\.|[^\\])*?)#*(?:\n|$)")
+SETEXT_HEADER_RE = re.compile(r"^.*?\n(?:=+|-+)[ ]*(\n|$)", re.MULTILINE)
+HR_RE = re.compile(r"^[ ]{0,3}(?=(?P<atomicgroup>(-+[ ]{0,2}){3,}|"
+                   r"(_+[ ]{0,2}){3,}|(\*+[ ]{0,2}){3,}))"
+                   r"(?P=atomicgroup)[ ]*$", re.MULTILINE)
+OLIST_RE = re.compile(r"^[ ]{0,3}\d+\.[ ]+(.*)")
+ULIST_RE = re.compile(r"^[ ]{0,3}[*+-][ ]+(.*)")
+LIST_CHILD_RE = re.compile(r"^[ ]{0,3}((\d+\.)|[*+-])[ ]+(.*)")
+LIST_INDENT_RE = re.compile(r"^[ ]{4,7}((\d+\.)|[*+-])[ ]+.*")
+QUOTE_RE = re.compile(r"(^|\n)[ ]{0,3}>[ ]?(.*)")
+REFERENCE_RE = re.compile(
+    r"^[ ]{0,3}\[([^\[\]]*)\]:[ ]*(?:\n[ ]*)?([^\s]+)[ ]*(?:\n[ ]*)?"
+    r"((['\"])(.*)\4[ ]*|\((.*)\)[ ]*)?$", re.MULTILINE)
+HTML_BLOCK_RE = re.compile(r"^<([a-zA-Z][a-zA-Z0-9]*)[\s/>]")
+
+#
+# Inline rules
+#
+BACKTICK_RE = re.compile(r"(?:(?<!\\)((?:\\{2})+)(?=`+)|(?<!\\)`)")
+ESCAPE_RE = re.compile(r"\\(.)")
+LINK_START_RE = re.compile(r"(?<!\!)\[")
+IMAGE_START_RE = re.compile(r"\!\[")
+LINK_HREF_RE = re.compile(r"\(\s*(?:(<[^<>]*>)\s*(?:('[^']*'|\"[^\"]*\")\s*)?\))?",
+                          re.DOTALL | re.UNICODE)
+REFERENCE_ID_RE = re.compile(r"\s?\[([^\]]*)\]", re.DOTALL | re.UNICODE)
+NEWLINE_CLEANUP_RE = re.compile(r"\s+", re.MULTILINE)
+AUTOLINK_RE = re.compile(r"<((?:[Ff]|[Hh][Tt])[Tt][Pp][Ss]?://[^<>]*)>")
+AUTOMAIL_RE = re.compile(r"<([^<> !]+@[^@<> ]+)>")
+LINE_BREAK_RE = re.compile(r"  \n")
+HTML_RE = re.compile(r"(<(\/?[a-zA-Z][^<>@ ]*( [^<>]*)?|"
+                     r"!--(?:(?!<!--|-->).)*--|"
+                     r"[?](?:(?!<[?]|[?]>).)*[?]|"
+                     r"!\[CDATA\[(?:(?!<!\[CDATA\[|\]\]>).)*\]\])>)")
+ENTITY_RE = re.compile(r"(&(?:\#[0-9]+|\#x[0-9a-fA-F]+|[a-zA-Z0-9]+);)")
+NOT_STRONG_RE = re.compile(r"((^|(?<=\s))(\*{1,3}|_{1,3})(?=\s|$))")
+
+# Emphasis rules, tried in order at every '*' or '_'. The second item is the
+# list of groups holding visible text.
+ASTERISK_RULES = [
+    (re.compile(r"(\*)\1{2}(.+?)\1(.*?)\1{2}", re.DOTALL | re.UNICODE), (2, 3)),
+    (re.compile(r"(\*)\1{2}(.+?)\1{2}(.*?)\1", re.DOTALL | re.UNICODE), (2, 3)),
+    (re.compile(r"(\*)\1(?!\1)([^*]+?)\1(?!\1)(.+?)\1{3}",
+                re.DOTALL | re.UNICODE), (2, 3)),
+    (re.compile(r"(\*{2})(.+?)\1", re.DOTALL | re.UNICODE), (2,)),
+    (re.compile(r"(\*)([^\*]+)\1", re.DOTALL | re.UNICODE), (2,)),
+]
+UNDERSCORE_RULES = [
+    (re.compile(r"(_)\1{2}(.+?)\1(.*?)\1{2}", re.DOTALL | re.UNICODE), (2, 3)),
+    (re.compile(r"(_)\1{2}(.+?)\1{2}(.*?)\1", re.DOTALL | re.UNICODE), (2, 3)),
+    (re.compile(r"(?<!\w)(\_)\1(?!\1)(.+?)(?<!\w)\1(?!\1)(.+?)\1{3}(?!\w)",
+                re.DOTALL | re.UNICODE), (2, 3)),
+    (re.compile(r"(?<!\w)(_{2})(?!_)(.+?)(?<!_)\1(?!\w)",
+                re.DOTALL | re.UNICODE), (2,)),
+    (re.compile(r"(?<!\w)(_)(?!_)(.+?)(?<!_)\1(?!\w)",
+                re.DOTALL | re.UNICODE), (2,)),
+]
+ASTERISK_START_RE = re.compile(r"\*")
+UNDERSCORE_START_RE = re.compile(r"_")
+
+
+def strip_markdown(text):
+    """Return the visible text of the given markdown text.
+
+    The result matches the text nodes of the HTML that ``markdown()`` renders
+    for ``text``, with one newline between consecutive blocks.
+
+    """
+    return "\n".join(iter_markdown_text(text))
+
+
+def iter_markdown_text(text):
+    """Yield the visible text of each block of the given markdown text."""
+    if not text:
+        return
+
+    # Normalize whitespace the same way Python-Markdown does
+    text = text.replace(STX, "").replace(ETX, "")
+    text = text.replace("\r\n", "\n").replace("\r", "\n") + "\n\n"
+    text = text.expandtabs(TAB_LENGTH)
+    text = EMPTY_LINE_RE.sub("\n", text)
+
+    references = set()
+    if "]:" in text:
+        for match in REFERENCE_RE.finditer(text):
+            references.add(match.group(1).strip().lower())
+
+    parser = _BlockParser(references)
+    for chunk in parser.parse_blocks(parser.split_raw_html(text), _ROOT):
+        yield chunk
+
+
+# Parent element kinds
+_ROOT = "root"
+_ITEM = "li"
+_QUOTE = "blockquote"
+
+
+class _BlockParser(object):
+
+    """Walk the blocks of a markdown document, yielding their visible text.
+
+    Rather than building a tree, only what influences how the next block is
+    parsed is tracked: the kind of the previous block (an indented block
+    following a list continues the list instead of starting a code block)
+    and whether the current block was already dedented.
+
+    """
+
+    def __init__(self, references):
+        self.references = references
+        self.previous = None
+        self.detabbed = False
+        self.depth = 0
+
+    def split_raw_html(self, text):
+        """Split text into blocks, keeping raw HTML blocks as is."""
+        blocks = text.split("\n\n")
+        if "<" not in text:
+            return blocks
+
+        result = []
+        while blocks:
+            block = blocks.pop(0)
+            match = HTML_BLOCK_RE.match(block)
+            if match and match.group(1).lower() in BLOCK_TAGS:
+                closing = "</{0}>".format(match.group(1).lower())
+                raw = [block]
+                while closing not in raw[-1].lower() and blocks:
+                    raw.append(blocks.pop(0))
+                result.append(_RawHtml("\n\n".join(raw)))
+            else:
+                result.append(block)
+        return result
+
+    def parse_blocks(self, blocks, parent):
+        """Yield the visible text of each block in the list ``blocks``."""
+        previous = self.previous
+        self.previous = None
+        self.depth += 1
+        try:
+            while blocks:
+                for chunk in self.parse_block(blocks, parent):
+                    yield chunk
+        finally:
+            self.previous = previous
+            self.depth -= 1
+
+    def parse_block(self, blocks, parent):
+        """Consume the first block of ``blocks`` and yield its text."""
+        block = blocks.pop(0)
+
+        if isinstance(block, _RawHtml):
+            self.previous = None
+            yield _html_text(block)
+            return
+
+        # Empty block, or block starting with an empty line
+        if not block or block.startswith("\n"):
+            if block[1:]:
+                blocks.insert(0, block[1:])
+            return
+
+        if block.startswith(CODE_INDENT):
+            if not self.detabbed and (parent == _ITEM or self.previous == "list"):
+                # Indented continuation of the previous list item
+                self.detabbed = True
+                try:
+                    for chunk in self.parse_blocks([_loose_detab(block)], _ITEM):
+                        yield chunk
+                finally:
+                    self.detabbed = False
+                self.previous = "list"
+                return
+
+            code, rest = _detab(block)
+            if rest:
+                blocks.insert(0, rest)
+            self.previous = "code"
+            yield code.rstrip()
+            return
+
+        match = HASH_HEADER_RE.search(block)
+        if match:
+            before, after = block[:match.start()], block[match.end():]
+            if before:
+                for chunk in self.parse_blocks([before], parent):
+                    yield chunk
+            if after:
+                blocks.insert(0, after)
+            self.previous = None
+            yield self.inline(match.group("header").strip())
+            return
+
+        if SETEXT_HEADER_RE.match(block):
+            lines = block.split("\n")
+            if len(lines) > 2:
+                blocks.insert(0, "\n".join(lines[2:]))
+            self.previous = None
+            yield self.inline(lines[0].strip())
+            return
+
+        match = HR_RE.search(block)
+        if match:
+            before = block[:match.start()].rstrip("\n")
+            after = block[match.end():].lstrip("\n")
+            if before:
+                for chunk in self.parse_blocks([before], parent):
+                    yield chunk
+            if after:
+                blocks.insert(0, after)
+            self.previous = None
+            return
+
+        if OLIST_RE.match(block) or ULIST_RE.match(block):
+            if self.depth >= MAX_NESTING:
+                # the markers left in the text are not words
+                self.previous = None
+                yield self.inline(block)
+                return
+            for item in _list_items(block):
+                if item.startswith(CODE_INDENT):
+                    # Nested list, parsed as a child of the previous item
+                    item = _loose_detab(item)
+                for chunk in self.parse_blocks([item], _ITEM):
+                    yield chunk
+            self.previous = "list"
+            return
+
+        match = QUOTE_RE.search(block)
+        if match:
+            before = block[:match.start()]
+            if before:
+                for chunk in self.parse_blocks([before], parent):
+                    yield chunk
+            clean = _clean_quote_line
+            if self.depth >= MAX_NESTING:
+                clean = _clean_quote_levels
+            quote = "\n".join(clean(line) for line in block[match.start():].split("\n"))
+            for chunk in self.parse_blocks(quote.split("\n\n"), _QUOTE):
+                yield chunk
+            self.previous = None
+            return
+
+        match = REFERENCE_RE.search(block)
+        if match:
+            before = block[:match.start()]
+            after = block[match.end():]
+            if after.strip():
+                blocks.insert(0, after.lstrip("\n"))
+            if before.strip():
+                blocks.insert(0, before.rstrip("\n"))
+            return
+
+        # Paragraph
+        if block.strip():
+            self.previous = None
+            yield self.inline(block.lstrip() if parent == _ITEM else block)
+
+    def inline(self, text):
+        """Apply the inline rules to ``text`` and return its visible text."""
+        stash = []
+        text = _apply_inline(text, 0, stash, self.references)
+        return _unstash(text, stash)
+
+
+class _RawHtml(str):
+
+    """A block of raw HTML, which is not parsed as markdown."""
+
+
+def _html_text(html):
+    """Return the text of a fragment of raw HTML."""
+    return unescape(HTML_RE.sub(_html_match_text, html))
+
+
+def _html_match_text(match):
+    """Return the visible text of a single HTML tag or comment."""
+    tag = match.group(1)
+    if tag.startswith("<!--"):
+        return tag[4:-3]
+    return ""
+
+
+def _detab(text):
+    """Remove one level of indentation from the leading indented lines.
+
+    Returns the dedented lines and the remaining unindented lines.
+
+    """
+    new_lines = []
+    lines = text.split("\n")
+    for line in lines:
+        if line.startswith(CODE_INDENT):
+            new_lines.append(line[TAB_LENGTH:])
+        elif not line.strip():
+            new_lines.append("")
+        else:
+            break
+    return "\n".join(new_lines), "\n".join(lines[len(new_lines):])
+
+
+def _loose_detab(text):
+    """Remove one level of indentation from all indented lines."""
+    lines = text.split("\n")
+    for i, line in enumerate(lines):
+        if line.startswith(CODE_INDENT):
+            lines[i] = line[TAB_LENGTH:]
+    return "\n".join(lines)
+
+
+def _list_items(block):
+    """Split a list block into the text of its items."""
+    items = []
+    for line in block.split("\n"):
+        match = LIST_CHILD_RE.match(line)
+        if match:
+            items.append(match.group(3))
+        elif LIST_INDENT_RE.match(line):
+            if items[-1].startswith(CODE_INDENT):
+                items[-1] = "{0}\n{1}".format(items[-1], line)
+            else:
+                items.append(line)
+        else:
+            items[-1] = "{0}\n{1}".format(items[-1], line)
+    return items
+
+
+def _clean_quote_line(line):
+    """Remove the '>' from the beginning of a quoted line."""
+    if line.strip() == ">":
+        return ""
+    match = QUOTE_RE.match(line)
+    if match:
+        return match.group(2)
+    return line
+
+
+def _clean_quote_levels(line):
+    """Remove all the nested '>' from the beginning of a quoted line."""
+    cleaned = _clean_quote_line(line)
+    while cleaned != line:
+        line = cleaned
+        cleaned = _clean_quote_line(line)
+    return line
+
+
+def _stash(stash, text):
+    """Store ``text`` in the stash and return its placeholder."""
+    stash.append(text)
+    return PLACEHOLDER.format(len(stash) - 1)
+
+
+def _unstash(text, stash):
+    """Replace all placeholders in ``text`` by the stashed text."""
+    if STX not in text:
+        return text
+    return PLACEHOLDER_RE.sub(
+        lambda match: _unstash(stash[int(match.group(1))], stash), text)
+
+
+def _apply_inline(text, start, stash, references):
+    """Apply the inline rules from index ``start`` onwards to ``text``."""
+    for index in range(start, len(INLINE_RULES)):
+        trigger, handler = INLINE_RULES[index]
+        if trigger is not None and trigger not in text:
+            continue
+        text = handler(text, index, stash, references)
+    return text
+
+
+def _substitute(regex, text, replace):
+    """Replace each match of ``regex`` for which ``replace`` returns a value.
+
+    ``replace`` is called with the match and returns a ``(replacement, end)``
+    tuple, or ``None`` when the match is rejected.
+
+    """
+    pieces = []
+    position = 0
+    search_from = 0
+    while True:
+        match = regex.search(text, search_from)
+        if match is None:
+            break
+        result = replace(match)
+        if result is None:
+            search_from = match.end(0) or match.start(0) + 1
+            continue
+        replacement, end = result
+        pieces.append(text[position:match.start(0)])
+        pieces.append(replacement)
+        position = search_from = end
+    if not pieces:
+        return text
+    pieces.append(text[position:])
+    return "".join(pieces)
+
+
+def _find_code_span(text, start):
+    """Find the code span opened by the backticks at ``start``."""
+    last = len(text)
+    max_ticks = 0
+    while start < last and text[start] == "`":
+        max_ticks += 1
+        start += 1
+
+    longest_span = 0
+    end = 0
+    i = start
+    while i < last:
+        span_length = 0
+        while i < last and text[i] == "`":
+            span_length += 1
+            i += 1
+        if not span_length:
+            i += 1
+            continue
+        if span_length == max_ticks:
+            return start, i - span_length
+        if span_length > longest_span:
+            longest_span = span_length
+            end = i
+
+    if longest_span:
+        return start - (max_ticks - longest_span), end - longest_span
+    return None
+
+
+def _code_spans(text, index, stash, references):
+    def replace(match):
+        if match.group(1):
+            return (_stash(stash, match.group(1).replace("\\\\", "\\")),
+                    match.end(0))
+        span = _find_code_span(text, match.start(0))
+        if span is None:
+            return None
+        start, end = span
+        return (_stash(stash, text[start:end].strip()),
+                end + (start - match.start(0)))
+    return _substitute(BACKTICK_RE, text, replace)
+
+
+def _escapes(text, index, stash, references):
+    def replace(match):
+        if match.group(1) not in ESCAPED_CHARS:
+            return None
+        return _stash(stash, match.group(1)), match.end(0)
+    return _substitute(ESCAPE_RE, text, replace)
+
+
+def _bracket_text(text, index):
+    """Return the text up to the matching ']' and the index following it."""
+    depth = 1
+    for pos in range(index, len(text)):
+        char = text[pos]
+        if char == "]":
+            depth -= 1
+            if not depth:
+                return text[index:pos], pos + 1
+        elif char == "[":
+            depth += 1
+    return None, None
+
+
+def _link_end(text, index):
+    """Return the index following the '(...)' target of a link, if any."""
+    match = LINK_HREF_RE.match(text, index)
+    if not match:
+        return None
+    if match.group(1):
+        return match.end(0)
+
+    # Find the parenthesis matching the opening one, ignoring those in a
+    # quoted title.
+    depth = 1
+    quote = None
+    for pos in range(match.end(0), len(text)):
+        char = text[pos]
+        if quote:
+            if char == quote:
+                quote = None
+            elif char == ")" and text[pos - 1:pos] in ("'", '"'):
+                return pos + 1
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if not depth:
+                return pos + 1
+        elif char in ("'", '"') and text[pos - 1:pos].isspace():
+            quote = char
+    return None
+
+
+def _links(text, index, stash, references):
+    def replace(match):
+        link_text, end = _bracket_text(text, match.end(0))
+        if end is None:
+            return None
+        end = _link_end(text, end)
+        if end is None:
+            return None
+        inner = _apply_inline(link_text, index + 1, stash, references)
+        return _stash(stash, inner), end
+    return _substitute(LINK_START_RE, text, replace)
+
+
+def _images(text, index, stash, references):
+    def replace(match):
+        end = _bracket_text(text, match.end(0))[1]
+        if end is None:
+            return None
+        end = _link_end(text, end)
+        if end is None:
+            return None
+        return _stash(stash, ""), end
+    return _substitute(IMAGE_START_RE, text, replace)
+
+
+def _reference_links(start_re, short, image):
+    """Return an inline rule for (short) links and images by reference."""
+    def rule(text, index, stash, references):
+        if not references:
+            return text
+
+        def replace(match):
+            link_text, end = _bracket_text(text, match.end(0))
+            if end is None:
+                return None
+            if short:
+                ref_id = link_text.lower()
+            else:
+                id_match = REFERENCE_ID_RE.match(text, end)
+                if not id_match:
+                    return None
+                ref_id = id_match.group(1).lower() or link_text.lower()
+                end = id_match.end(0)
+            if NEWLINE_CLEANUP_RE.sub(" ", ref_id) not in references:
+                return None
+            if image:
+                return _stash(stash, ""), end
+            inner = _apply_inline(link_text, index + 1, stash, references)
+            return _stash(stash, inner), end
+        return _substitute(start_re, text, replace)
+    return rule
+
+
+def _autolinks(text, index, stash, references):
+    return AUTOLINK_RE.sub(lambda match: _stash(stash, match.group(1)), text)
+
+
+def _automails(text, index, stash, references):
+    def replace(match):
+        email = unescape(match.group(1))
+        if email.startswith("mailto:"):
+            email = email[len("mailto:"):]
+        return _stash(stash, email)
+    return AUTOMAIL_RE.sub(replace, text)
+
+
+def _line_breaks(text, index, stash, references):
+    return LINE_BREAK_RE.sub(lambda match: _stash(stash, "\n"), text)
+
+
+def _html(text, index, stash, references):
+    return HTML_RE.sub(
+        lambda match: _stash(stash, _html_match_text(match)), text)
+
+
+def _entities(text, index, stash, references):
+    return ENTITY_RE.sub(
+        lambda match: _stash(stash, unescape(match.group(1))), text)
+
+
+def _not_strong(text, index, stash, references):
+    if "*" not in text and "_" not in text:
+        return text
+    return NOT_STRONG_RE.sub(lambda match: _stash(stash, match.group(1)), text)
+
+
+def _emphasis(start_re, rules):
+    """Return an inline rule for '*' or '_' emphasis."""
+    def rule(text, index, stash, references):
+        def replace(match):
+            for regex, groups in rules:
+                emphasis = regex.match(text, match.start(0))
+                if emphasis:
+                    inner = "".join(
+                        _apply_inline(emphasis.group(group), index, stash,
+                                      references)
+                        for group in groups if emphasis.group(group))
+                    return _stash(stash, inner), emphasis.end(0)
+            return None
+        return _substitute(start_re, text, replace)
+    return rule
+
+
+# Inline rules in the order they are applied, each with a substring that must
+# be present for the rule to apply.
+INLINE_RULES = [
+    ("`", _code_spans),
+    ("\\", _escapes),
+    ("[", _reference_links(LINK_START_RE, short=False, image=False)),
+    ("[", _links),
+    ("![", _images),
+    ("![", _reference_links(IMAGE_START_RE, short=False, image=True)),
+    ("[", _reference_links(LINK_START_RE, short=True, image=False)),
+    ("![", _reference_links(IMAGE_START_RE, short=True, image=True)),
+    ("<", _autolinks),
+    ("<", _automails),
+    ("  \n", _line_breaks),
+    ("<", _html),
+    ("&", _entities),
+    (None, _not_strong),
+    ("*", _emphasis(ASTERISK_START_RE, ASTERISK_RULES)),
+    ("_", _emphasis(UNDERSCORE_START_RE, UNDERSCORE_RULES)),
+]
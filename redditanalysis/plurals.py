@@ -0,0 +1,71 @@
+"""
+    Combine the singular and plural forms of words into single counts.
+
+    A word ending with "ies" or "s" is the plural of the word without the
+    ending ("furries" of "furry", "pictures" of "picture") when that word was
+    counted too. The counts of the forms of a word are added up under the
+    form used most, in one pass over the counts and without modifying them,
+    so the result does not depend on the order of the counts.
+"""
+
+
+def singular_forms(word):
+    """Return the words that a word may be the plural of, most specific first."""
+    forms = ()
+    if word.endswith("ies"):
+        forms = ("{0}y".format(word[:-3]),)
+    if word.endswith("s"):
+        forms += (word[:-1],)
+    return forms
+
+
+def plural_roots(words):
+    """Map each word of a collection to the singular it is a plural of.
+
+    Plurals of plurals map to the last singular. Words that are not the
+    plural of another word of the collection map to themselves.
+
+    :param words: a collection supporting ``in``, like the keys of a dict
+
+    """
+    parents = {}
+    for word in words:
+        for form in singular_forms(word):
+            if form in words:
+                parents[word] = form
+                break
+
+    # the forms are shorter than their word, so the chains have no cycles
+    roots = {}
+    for word in words:
+        chain = []
+        while word in parents and word not in roots:
+            chain.append(word)
+            word = parents[word]
+        root = roots.get(word, word)
+        for link in chain:
+            roots[link] = root
+        roots.setdefault(word, root)
+    return roots
+
+
+def merge_plurals(counts):
+    """Return the {word: count} counts with the plural forms of words combined.
+
+    The counts of the forms of a word are added up under its most used form,
+    the longest one on ties (e.g. "pictures" when "picture" is used as much).
+
+    :param counts: the counts to combine, anything with an ``items`` method
+        returning (word, count) pairs: a dict, CountTable or SpaceSaving
+
+    """
+    counts = dict((word, count) for word, count in counts.items() if count > 0)
+    totals = {}
+    forms = {}
+    for word, root in plural_roots(counts).items():
+        count = counts[word]
+        totals[root] = totals.get(root, 0) + count
+        form = forms.get(root)
+        if form is None or (count, len(word), word) > (counts[form], len(form), form):
+            forms[root] = word
+    return dict((forms[root], total) for root, total in totals.items())
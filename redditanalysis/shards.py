@@ -0,0 +1,333 @@
+"""
+    Split an analysis across machines and merge the partial counts.
+
+    With ``--shard I/N``, an analysis only counts the submissions whose id
+    falls in the I-th of N shards (the comments of a submission are in the
+    shard of the submission, and the items of a redditor are sharded by their
+    own id), and with ``--after``/``--before`` the ones created in a time
+    window. With ``--partial DIR``, it writes its counts to a shard file in DIR
+    instead of the output files (an analysis of dumps with ``--partial``
+    writes the counts of its dumps), and
+
+        word_freqs_merge DIR/*.shard
+
+    adds up the shard files of each target into the same output files as an
+    analysis of the whole target.
+
+    Layout of a shard file (little endian): magic ``RASH``, version, length of
+    the metadata, the metadata as UTF-8 JSON (target, settings, shard), then
+    the WordCounts of the shard as UTF-8 JSON, zlib compressed. Shard files
+    are exchanged between machines, so they only hold data: reading one
+    never runs code from it, unlike unpickling.
+"""
+
+import json
+import os
+import struct
+import sys
+import zlib
+from array import array
+from collections import OrderedDict
+from optparse import OptionParser
+
+from .spacesaving import SpaceSaving
+from .timeline import DayCounts
+from .vocabulary import CountTable, PhraseTable
+
+try:
+    from os import replace as replace_file
+except ImportError:  # Python 2, where rename replaces files on POSIX
+    from os import rename as replace_file
+
+MAGIC = b"RASH"
+VERSION = 2
+
+SHARD_SUFFIX = ".shard"
+
+_HEADER = struct.Struct("<4sII")
+
+# the tables of a WordCounts, by the names saved in the shard files; no other
+# class is ever built from a shard file
+_TABLES = dict((cls.__name__, cls) for cls in (CountTable, PhraseTable, SpaceSaving))
+
+
+class Shard(object):
+
+    """Selects the submissions and comments of one shard of an analysis.
+
+    :param index: the number of the shard, from 1 to count
+
+    :param count: the number of shards the items are split into
+
+    :param after: the UTC timestamp the items must be created at or after,
+        None for no limit
+
+    :param before: the UTC timestamp the items must be created before, None
+        for no limit
+
+    """
+
+    def __init__(self, index=1, count=1, after=None, before=None):
+        if not 1 <= index <= count:
+            raise ValueError("the shard must be between 1 and {0}".format(count))
+        self.index = index
+        self.count = count
+        self.after = after
+        self.before = before
+
+    @classmethod
+    def parse(cls, value, after=None, before=None):
+        """Return the Shard of an I/N command-line value."""
+        index, sep, count = value.partition("/")
+        if not sep:
+            raise ValueError("{0} is not of the form I/N".format(value))
+        return cls(int(index), int(count), after, before)
+
+    def selects(self, item):
+        """Return True if a submission or comment is in the shard."""
+        if self.count > 1 and int(item.id, 36) % self.count != self.index - 1:
+            return False
+        if self.after is not None or self.before is not None:
+            created_utc = getattr(item, "created_utc", None)
+            if created_utc is None:
+                return False
+            if self.after is not None and created_utc < self.after:
+                return False
+            if self.before is not None and created_utc >= self.before:
+                return False
+        return True
+
+    def label(self):
+        """Return the part of the names of the shard files naming the shard."""
+        parts = ["{0}of{1}".format(self.index, self.count)]
+        for limit in (self.after, self.before):
+            parts.append("" if limit is None else str(int(limit)))
+        return "-".join(parts).rstrip("-")
+
+    def to_json(self):
+        return {"index": self.index, "count": self.count,
+                "after": self.after, "before": self.before}
+
+
+def shard_path(directory, target_name, label):
+    """Return the path of a shard file of a target."""
+    return os.path.join(directory, "{0}-{1}{2}".format(target_name, label,
+                                                       SHARD_SUFFIX))
+
+
+def _dump_table(table):
+    if table is None:
+        return None
+    state = [list(field) if isinstance(field, array) else field
+             for field in table.__getstate__()]
+    return [type(table).__name__, state]
+
+
+def _load_table(data):
+    if data is None:
+        return None
+    name, state = data
+    table = _TABLES[name].__new__(_TABLES[name])
+    table.__setstate__(tuple(state))
+    return table
+
+
+def dump_counts(counts):
+    """Return the WordCounts of a shard as a JSON object."""
+    days = None
+    if counts.days is not None:
+        days = [[day, counts.days.words(day)] for day in sorted(counts.days.days)]
+    return {"ngrams": counts.ngrams, "all_words": _dump_table(counts.all_words),
+            "popular_words": _dump_table(counts.popular_words),
+            "phrases": _dump_table(counts.phrases), "days": days}
+
+
+def load_counts(data):
+    """Return the WordCounts of a JSON object made by dump_counts.
+
+    Raises ValueError if the object does not hold word counts.
+
+    """
+    from . import WordCounts
+
+    try:
+        days = None
+        if data["days"] is not None:
+            days = DayCounts()
+            days.__setstate__(dict((int(day), word_counts)
+                                   for day, word_counts in data["days"]))
+        tables = [_load_table(data[name])
+                  for name in ("all_words", "popular_words", "phrases")]
+        counts = WordCounts.__new__(WordCounts)
+        counts.__setstate__((tables[0], tables[1], int(data["ngrams"]), tables[2], days))
+    except (KeyError, TypeError, ValueError, AttributeError) as exc:
+        raise ValueError("invalid word counts: {0!r}".format(exc))
+    return counts
+
+
+def write_shard(path, target_name, settings, counts, items):
+    """Atomically write the counts of a shard of an analysis.
+
+    :param target_name: the name of the output files of the target, e.g.
+        subreddit-SUBREDDIT
+
+    :param settings: the options the counts depend on; only shards with the
+        same settings can be merged
+
+    :param counts: the WordCounts of the shard
+
+    :param items: describes the items counted (e.g. Shard.to_json()), as a
+        JSON object; two shards of a target describing the same items are
+        not merged
+
+    """
+    metadata = {"target": target_name, "settings": settings, "items": items}
+    metadata = json.dumps(metadata, sort_keys=True).encode("utf-8")
+    data = zlib.compress(json.dumps(dump_counts(counts)).encode("utf-8"))
+
+    tmp_path = "{0}.tmp".format(path)
+    with open(tmp_path, "wb") as out_file:
+        out_file.write(_HEADER.pack(MAGIC, VERSION, len(metadata)))
+        out_file.write(metadata)
+        out_file.write(data)
+    replace_file(tmp_path, path)
+
+
+def read_shard(path):
+    """Return the metadata and the WordCounts of a shard file.
+
+    Raises ValueError if the file is not a shard file.
+
+    """
+    with open(path, "rb") as in_file:
+        header = in_file.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError("{0} is not a shard file".format(path))
+        magic, version, length = _HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError("{0} is not a shard file".format(path))
+        if version != VERSION:
+            raise ValueError("{0} was written by another version of"
+                             " word_freqs".format(path))
+        metadata = json.loads(in_file.read(length).decode("utf-8"))
+        try:
+            data = json.loads(zlib.decompress(in_file.read()).decode("utf-8"))
+        except (zlib.error, ValueError) as exc:
+            raise ValueError("{0} is truncated: {1}".format(path, exc))
+    try:
+        return metadata, load_counts(data)
+    except ValueError as exc:
+        raise ValueError("{0} is not a shard file: {1}".format(path, exc))
+
+
+def _windows_overlap(first, second):
+    """Return True if the after/before windows of two shards overlap."""
+    afters = [items["after"] for items in (first, second)
+              if items.get("after") is not None]
+    befores = [items["before"] for items in (first, second)
+               if items.get("before") is not None]
+    return not afters or not befores or max(afters) < min(befores)
+
+
+def items_overlap(first, second):
+    """Return True if two shards of a target may count the same items.
+
+    :param first: the items of a shard, as passed to write_shard
+
+    """
+    if not _windows_overlap(first, second):
+        return False
+    if "dumps" in first and "dumps" in second:
+        return not set(first["dumps"]).isdisjoint(second["dumps"])
+    if ("index" in first and "index" in second
+            and first.get("count") == second.get("count")):
+        return first["index"] == second["index"]
+    # the whole target, or items selected another way
+    return True
+
+
+def merge_shards(paths, settings=None):
+    """Add up the counts of the shard files of each target.
+
+    Returns an OrderedDict of the WordCounts of each target name, in the
+    order the targets are first found. Raises ValueError if the shards of a
+    target were counted with different settings, split the submissions
+    into different numbers of shards, or may count the same items.
+
+    :param settings: a dict to fill with the settings of each target name
+
+    """
+    merged = OrderedDict()
+    if settings is None:
+        settings = {}
+    seen = {}
+    for path in paths:
+        metadata, counts = read_shard(path)
+        target = metadata["target"]
+        items = metadata["items"]
+        for other in seen.setdefault(target, []):
+            if ("count" in items and "count" in other
+                    and items["count"] != other["count"]):
+                raise ValueError("{0} splits {1} into {2} shards, another shard"
+                                 " into {3}".format(path, target, items["count"],
+                                                    other["count"]))
+            if items_overlap(items, other):
+                raise ValueError("{0} may count the same items as another shard"
+                                 " of {1}".format(path, target))
+        seen[target].append(items)
+        if target not in merged:
+            merged[target] = counts
+            settings[target] = metadata["settings"]
+        elif metadata["settings"] != settings[target]:
+            raise ValueError("{0} was counted with other settings: {1}".format(
+                path, metadata["settings"]))
+        else:
+            merged[target].merge(counts)
+    return merged
+
+
+def main(args=None):
+    """Merge shard files into the output files of their targets."""
+    from . import STATS, write_output, write_timeline
+
+    parser = OptionParser(usage=("usage: %prog [options] SHARD [SHARD ...]"
+                                 "\n\nSHARD is a shard file written by an"
+                                 " analysis with --partial"))
+    parser.add_option("-t", "--top", type="int", metavar="N",
+                      help="only output the N most used words [default: all]")
+    parser.add_option("-r", "--no-raw-data", action="store_true", default=False,
+                      help="disable raw word count output file [default: false]")
+    parser.add_option("--binary", action="store_true", default=False,
+                      help=("also write each output file as a memory-mappable"
+                            " .counts file [default: false]"))
+    parser.add_option("--timeline", metavar="DIR",
+                      help=("also add the word counts per day of the shards"
+                            " counted with --timeline to DIR [default: off]"))
+    parser.add_option("-v", "--verbose", action="store_true", default=False,
+                      help=("print all program output to the terminal"
+                            " [default: false]"))
+    options, args = parser.parse_args(args)
+    if not args:
+        parser.error("Invalid number of arguments provided.")
+    if options.top is not None and options.top < 1:
+        parser.error("Invalid number of top words.")
+
+    settings = {}
+    try:
+        merged = merge_shards(args, settings)
+    except (IOError, OSError, ValueError) as exc:
+        sys.stderr.write("Cannot merge the shards. {0}\n".format(exc))
+        return 1
+
+    for target_name, counts in merged.items():
+        sys.stderr.write("Writing {0}\n".format(target_name))
+        with STATS.timer("output"):
+            metadata = dict(settings[target_name], target=target_name,
+                            merged=True)
+            write_output(counts, "{0}.csv".format(target_name), options, metadata)
+            write_timeline(counts, target_name, options)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""
+    Approximate word counts in bounded memory.
+
+    SpaceSaving implements the Space-Saving algorithm (Metwally, Agrawal and El
+    Abbadi, "Efficient Computation of Frequent and Top-k Elements in Data
+    Streams", 2005). It keeps at most ``capacity`` counters: a word that is
+    not counted yet takes over the counter of the least counted word, and
+    inherits its count as the possible overestimation of its own.
+
+    With N words counted, every count is at most N / capacity too high, and
+    every word used more than N / capacity times has a counter.
+"""
+
+import heapq
+import math
+
+
+def capacity_for_error(epsilon):
+    """Return the number of counters bounding the errors to epsilon * N."""
+    if not 0 < epsilon < 1:
+        raise ValueError("the error bound must be between 0 and 1")
+    return int(math.ceil(1 / epsilon))
+
+
+class SpaceSaving(object):
+
+    """Approximate counts of the most used words.
+
+    Supports the operations of the defaultdict(int) used for exact counts
+    (``table[word] += n``, ``in``, ``len``, ``items``, ``del``), so it can
+    replace it in a WordCounts. Words without a counter count as 0.
+
+    :param capacity: the maximum number of words counted
+
+    """
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("the capacity must be at least 1")
+        self.capacity = capacity
+        self.total = 0
+        self.counts = {}
+        self.errors = {}
+        # the words of each count, and a heap of the counts to find the
+        # smallest one (counts whose words all moved on are skipped lazily)
+        self.buckets = {}
+        self.heap = []
+
+    def _unlink(self, word, count):
+        bucket = self.buckets[count]
+        bucket.discard(word)
+        if not bucket:
+            del self.buckets[count]
+
+    def _link(self, word, count):
+        bucket = self.buckets.get(count)
+        if bucket is None:
+            bucket = self.buckets[count] = set()
+            heapq.heappush(self.heap, count)
+            if len(self.heap) > 2 * len(self.buckets) + 64:
+                self.heap = list(self.buckets)
+                heapq.heapify(self.heap)
+        bucket.add(word)
+
+    def min_count(self):
+        """Return the smallest count, 0 while there are free counters."""
+        if len(self.counts) < self.capacity:
+            return 0
+        heap = self.heap
+        while heap[0] not in self.buckets:
+            heapq.heappop(heap)
+        return heap[0]
+
+    def add(self, word, n=1, error=0):
+        """Count n more uses of a word.
+
+        :param error: how much n may be too high, when adding counts that
+            are approximate themselves
+
+        """
+        if n <= 0:
+            return
+        self.total += n
+        count = self.counts.get(word)
+        if count is not None:
+            self._unlink(word, count)
+        elif len(self.counts) < self.capacity:
+            count = 0
+            self.errors[word] = 0
+        else:
+            # take over the counter of a least counted word
+            count = self.min_count()
+            evicted = self.buckets[count].pop()
+            if not self.buckets[count]:
+                del self.buckets[count]
+            del self.counts[evicted]
+            del self.errors[evicted]
+            self.errors[word] = count
+        self.errors[word] += error
+        self.counts[word] = count + n
+        self._link(word, count + n)
+
+    def error(self, word):
+        """Return how much the count of a word may be too high."""
+        return self.errors.get(word, self.min_count())
+
+    def max_error(self):
+        """Return how much any count may be too high.
+
+        Every word used more than this many times has a counter.
+
+        """
+        return self.min_count()
+
+    def update(self, other):
+        """Add the counts of a mapping or another SpaceSaving.
+
+        The counts of a mapping are exact. Two SpaceSaving tables are merged
+        like Agarwal et al. ("Mergeable Summaries", 2012) do: a word counted
+        by only one of the tables may have been used up to the smallest
+        count of the other one, which is added to its count and its error,
+        then the most counted words are kept. The merged counts are still
+        never too low, and at most their error too high.
+
+        """
+        if not isinstance(other, SpaceSaving):
+            for word, count in other.items():
+                self.add(word, count)
+            return
+
+        floor, other_floor = self.min_count(), other.min_count()
+        counts = {}
+        errors = {}
+        for word in set(self.counts).union(other.counts):
+            counts[word] = (self.counts.get(word, floor) +
+                            other.counts.get(word, other_floor))
+            errors[word] = (self.errors.get(word, floor) +
+                            other.errors.get(word, other_floor))
+        # sorted by word on ties, so the words kept do not depend on the
+        # order of the sets
+        kept = heapq.nlargest(self.capacity, counts,
+                              key=lambda word: (counts[word], word))
+        self.__setstate__((self.capacity, self.total + other.total,
+                           dict((word, counts[word]) for word in kept),
+                           dict((word, errors[word]) for word in kept)))
+
+    def __getitem__(self, word):
+        return self.counts.get(word, 0)
+
+    def __setitem__(self, word, value):
+        # table[word] += n reads the count then sets it n higher
+        self.add(word, value - self.counts.get(word, 0))
+
+    def __delitem__(self, word):
+        count = self.counts.pop(word)
+        self._unlink(word, count)
+        del self.errors[word]
+        self.total -= count
+
+    def get(self, word, default=None):
+        return self.counts.get(word, default)
+
+    def __contains__(self, word):
+        return word in self.counts
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __iter__(self):
+        return iter(self.counts)
+
+    def keys(self):
+        return self.counts.keys()
+
+    def items(self):
+        return self.counts.items()
+
+    def __eq__(self, other):
+        if not isinstance(other, SpaceSaving):
+            return NotImplemented
+        return (self.capacity == other.capacity and
+                self.counts == other.counts and self.errors == other.errors)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        return self.capacity, self.total, self.counts, self.errors
+
+    def __setstate__(self, state):
+        capacity, total, counts, errors = state
+        self.__init__(capacity)
+        self.total = total
+        self.counts = counts
+        self.errors = errors
+        for word, count in counts.items():
+            self._link(word, count)
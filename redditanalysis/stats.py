@@ -0,0 +1,103 @@
+"""
+    Timers and counters of the stages of an analysis.
+
+    The time spent in each stage (fetching listings, expanding comment trees,
+    extracting the text from markdown, tokenizing, counting and writing the
+    output) is accumulated in a Stats object, along with counters of the items
+    and tokens processed, so a slow run shows where its time went.
+"""
+
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    clock = time.perf_counter
+except AttributeError:  # Python 2
+    clock = time.time
+
+# the stages timed, in the order they happen
+STAGES = ("fetch", "expand", "markdown", "tokenize", "count", "output")
+
+
+class Stats(object):
+
+    """Cumulative timers and counters.
+
+    Timers add up the time spent in a stage by every thread, so stages run
+    by several threads (like the comment expansion) can add up to more than
+    the wall clock time.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.timers = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            self.timers[stage] += seconds
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+
+    @contextmanager
+    def timer(self, stage):
+        """Time the block of a with statement as part of a stage."""
+        start = clock()
+        try:
+            yield
+        finally:
+            self.add_time(stage, clock() - start)
+
+    def snapshot(self):
+        """Return the timers and counters, e.g. to merge them in another Stats."""
+        with self.lock:
+            return dict(self.timers), dict(self.counters)
+
+    def merge(self, snapshot):
+        """Add the timers and counters of a snapshot of another Stats."""
+        timers, counters = snapshot
+        with self.lock:
+            for stage, seconds in timers.items():
+                self.timers[stage] += seconds
+            for counter, n in counters.items():
+                self.counters[counter] += n
+
+    def rate(self, counter):
+        """Return the number of counter per second of wall clock time."""
+        elapsed = time.time() - self.started
+        return self.counters.get(counter, 0) / elapsed if elapsed > 0 else 0.0
+
+    def as_dict(self):
+        timers, counters = self.snapshot()
+        elapsed = time.time() - self.started
+        return {"elapsed": elapsed, "timers": timers, "counters": counters,
+                "rates": dict(("{0}_per_sec".format(counter), self.rate(counter))
+                              for counter in counters)}
+
+    def dump(self, path):
+        """Write the stats to a JSON file."""
+        with open(path, "w") as out_file:
+            json.dump(self.as_dict(), out_file, indent=2, sort_keys=True)
+
+    def report(self, out_file=sys.stderr):
+        """Write a summary of the stats."""
+        stats = self.as_dict()
+        out_file.write("{0:.1f}s elapsed\n".format(stats["elapsed"]))
+        timers = stats["timers"]
+        for stage in STAGES + tuple(sorted(set(timers) - set(STAGES))):
+            if stage in timers:
+                out_file.write("  {0:<10}{1:>10.2f}s\n".format(stage, timers[stage]))
+        for counter, n in sorted(stats["counters"].items()):
+            out_file.write("  {0:<10}{1:>10} ({2:.1f}/s)\n".format(
+                counter, n, stats["rates"]["{0}_per_sec".format(counter)]))
@@ -0,0 +1,330 @@
+"""
+    Word counts per day, to compare time windows without crawling again.
+
+    With ``--timeline DIR``, the popular word counts of the texts of each
+    analysis are also kept per day (UTC) of creation of their submission or
+    comment, in DIR/<target>/, and any window of days is counted by adding
+    up its days:
+
+        python -m redditanalysis.timeline --after 2016-01-25 --before 2016-02-01 \\
+            --baseline-after 2016-01-01 DIR/subreddit-SUBREDDIT
+
+    lists the words used much more in the last week of January than earlier
+    in the month.
+
+    Layout of the directory of a target:
+
+    * ``words.txt``: the words counted, one per line, in the order they were
+      first counted; the day files refer to them by line number
+    * ``YYYY-MM-DD.day`` files (little endian): magic ``RAWD``, version,
+      number of words, then the line numbers of the words of the day and
+      their counts, as two arrays of 32-bit integers
+
+    Each analysis replaces the days it counted texts of, so running the same
+    analysis again doesn't count its texts twice.
+"""
+
+import io
+import os
+import struct
+import sys
+from array import array
+from datetime import date, datetime, timedelta
+from optparse import OptionParser
+
+from .vocabulary import COUNT_TYPE
+
+try:
+    from os import replace as replace_file
+except ImportError:  # Python 2, where rename replaces files on POSIX
+    from os import rename as replace_file
+
+MAGIC = b"RAWD"
+VERSION = 1
+
+DAY = 24 * 60 * 60
+EPOCH = date(1970, 1, 1)
+
+WORDS_FILE = "words.txt"
+DAY_SUFFIX = ".day"
+
+_HEADER = struct.Struct("<4sII")
+
+# the type of the arrays of the day files, 32-bit on the usual platforms
+_ARRAY_TYPE = "I"
+
+
+def day_of(created_utc):
+    """Return the day number (since the epoch) of a UTC timestamp."""
+    return int(float(created_utc) // DAY)
+
+
+def day_name(day):
+    """Return the YYYY-MM-DD date of a day number."""
+    return (EPOCH + timedelta(days=day)).isoformat()
+
+
+def parse_day(value):
+    """Return the day number of a YYYY-MM-DD date."""
+    return (datetime.strptime(value, "%Y-%m-%d").date() - EPOCH).days
+
+
+class DayCounts(object):
+
+    """Word counts per day.
+
+    Only the popular words of the texts are counted per day, so the counts
+    are kept by word rather than by the ids of a Vocabulary, and the day
+    counts of worker processes are merged by word.
+
+    """
+
+    def __init__(self):
+        # day number -> {word: count}
+        self.days = {}
+
+    def add(self, created_utc, word_counts):
+        """Add the (word, count) pairs of a text created at a UTC timestamp."""
+        day = day_of(created_utc)
+        counts = self.days.get(day)
+        if counts is None:
+            counts = self.days[day] = {}
+        get = counts.get
+        for word, n in word_counts:
+            counts[word] = get(word, 0) + n
+
+    def update(self, other):
+        """Add the counts of another DayCounts."""
+        for day, other_counts in other.days.items():
+            counts = self.days.get(day)
+            if counts is None:
+                self.days[day] = dict(other_counts)
+                continue
+            get = counts.get
+            for word, n in other_counts.items():
+                counts[word] = get(word, 0) + n
+
+    def words(self, day):
+        """Return the (word, count) pairs of a day."""
+        return list(self.days.get(day, {}).items())
+
+    def __len__(self):
+        return len(self.days)
+
+    def __eq__(self, other):
+        if not isinstance(other, DayCounts):
+            return NotImplemented
+        return self.days == other.days
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        return dict((day, self.words(day)) for day in self.days)
+
+    def __setstate__(self, state):
+        self.__init__()
+        for day, word_counts in state.items():
+            self.days[day] = dict(word_counts)
+
+
+class Timeline(object):
+
+    """The word counts per day of a target, in a directory.
+
+    :param path: the directory, created when the first day is written
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.words = []
+        self.ids = {}
+        words_path = os.path.join(path, WORDS_FILE)
+        if os.path.exists(words_path):
+            with io.open(words_path, "r", encoding="utf-8") as in_file:
+                self.words = [line.rstrip(u"\n") for line in in_file]
+            self.ids = dict((word, word_id) for word_id, word in enumerate(self.words))
+
+    def days(self):
+        """Return the sorted day numbers of the days counted."""
+        if not os.path.isdir(self.path):
+            return []
+        days = []
+        for name in os.listdir(self.path):
+            if name.endswith(DAY_SUFFIX):
+                try:
+                    days.append(parse_day(name[:-len(DAY_SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(days)
+
+    def _day_path(self, day):
+        return os.path.join(self.path, day_name(day) + DAY_SUFFIX)
+
+    def write(self, day_counts):
+        """Replace the days of a DayCounts with its counts."""
+        if not day_counts:
+            return
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        new_words = []
+        days = []
+        for day in sorted(day_counts.days):
+            ids = array(_ARRAY_TYPE)
+            counts = array(_ARRAY_TYPE)
+            for word, count in sorted(day_counts.words(day)):
+                word_id = self.ids.get(word)
+                if word_id is None:
+                    word_id = self.ids[word] = len(self.words)
+                    self.words.append(word)
+                    new_words.append(word)
+                ids.append(word_id)
+                counts.append(count)
+            days.append((day, ids, counts))
+
+        # the words first, so the day files never refer to missing words
+        if new_words:
+            with io.open(os.path.join(self.path, WORDS_FILE), "a",
+                         encoding="utf-8") as out_file:
+                out_file.write(u"".join(u"{0}\n".format(word) for word in new_words))
+
+        for day, ids, counts in days:
+            path = self._day_path(day)
+            tmp_path = "{0}.tmp".format(path)
+            if sys.byteorder != "little":
+                ids.byteswap()
+                counts.byteswap()
+            with open(tmp_path, "wb") as out_file:
+                out_file.write(_HEADER.pack(MAGIC, VERSION, len(ids)))
+                ids.tofile(out_file)
+                counts.tofile(out_file)
+            replace_file(tmp_path, path)
+
+    def read_day(self, day):
+        """Return the word ids and counts of a day, two empty arrays if it
+        was not counted."""
+        ids = array(_ARRAY_TYPE)
+        counts = array(_ARRAY_TYPE)
+        path = self._day_path(day)
+        if not os.path.exists(path):
+            return ids, counts
+        with open(path, "rb") as in_file:
+            magic, version, length = _HEADER.unpack(in_file.read(_HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("{0} is not a day file".format(path))
+            ids.fromfile(in_file, length)
+            counts.fromfile(in_file, length)
+        if sys.byteorder != "little":
+            ids.byteswap()
+            counts.byteswap()
+        return ids, counts
+
+    def window(self, start=None, end=None):
+        """Return the {word: count} counts of the days from start to end.
+
+        :param start: the first day number of the window, None for the first
+            day counted
+
+        :param end: the day number after the window, None for no limit
+
+        """
+        totals = array(COUNT_TYPE, [0]) * len(self.words)
+        for day in self.days():
+            if (start is None or day >= start) and (end is None or day < end):
+                ids, counts = self.read_day(day)
+                for word_id, count in zip(ids, counts):
+                    totals[word_id] += count
+        return dict((self.words[word_id], count)
+                    for word_id, count in enumerate(totals) if count)
+
+
+def trend_scores(window, baseline, min_count=5):
+    """Score how much more each word is used in a window than in a baseline.
+
+    The score of a word is the ratio of its share of the words counted in
+    the window to its share in the baseline, with 1 added to its baseline
+    count so that new words get a finite score: 10 means used 10 times as
+    often.
+
+    :param window: the {word: count} counts of the window
+
+    :param baseline: the {word: count} counts of the baseline
+
+    :param min_count: the minimum count in the window of the words scored,
+        as the scores of rare words are mostly noise
+
+    :returns: (word, score) pairs, the highest scores first
+
+    """
+    window_total = float(sum(window.values()))
+    baseline_total = float(sum(baseline.values()))
+    scores = []
+    for word, count in window.items():
+        if count < min_count:
+            continue
+        share = count / window_total
+        baseline_share = (baseline.get(word, 0) + 1) / (baseline_total + 1)
+        scores.append((word, share / baseline_share))
+    scores.sort(key=lambda pair: (-pair[1], pair[0]))
+    return scores
+
+
+def main():
+    parser = OptionParser(usage=("usage: python -m redditanalysis.timeline"
+                                 " [options] DIR"))
+    parser.add_option("--after", metavar="DATE",
+                      help="start the window at this date (YYYY-MM-DD)"
+                           " [default: the first day counted]")
+    parser.add_option("--before", metavar="DATE",
+                      help="end the window before this date (YYYY-MM-DD)"
+                           " [default: after the last day counted]")
+    parser.add_option("--baseline-after", metavar="DATE",
+                      help=("score the words of the window against a baseline"
+                            " starting at this date"))
+    parser.add_option("--baseline-before", metavar="DATE",
+                      help=("score the words of the window against a baseline"
+                            " ending before this date [default: the start of"
+                            " the window]"))
+    parser.add_option("-t", "--top", type="int", default=50, metavar="N",
+                      help="only output the N first words [default: 50]")
+    parser.add_option("--min-count", type="int", default=5, metavar="M",
+                      help=("only score the words used at least M times in the"
+                            " window [default: 5]"))
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Invalid number of arguments provided.")
+
+    days = {}
+    for name in ("after", "before", "baseline_after", "baseline_before"):
+        value = getattr(options, name)
+        if value is not None:
+            try:
+                days[name] = parse_day(value)
+            except ValueError:
+                parser.error("Invalid date {0}.".format(value))
+
+    timeline = Timeline(args[0])
+    if not timeline.days():
+        parser.error("No days counted in {0}.".format(args[0]))
+    window = timeline.window(days.get("after"), days.get("before"))
+
+    if "baseline_after" in days or "baseline_before" in days:
+        baseline = timeline.window(days.get("baseline_after"),
+                                   days.get("baseline_before", days.get("after")))
+        lines = (u"{0}:{1:.2f}".format(word, score)
+                 for word, score in trend_scores(window, baseline, options.min_count))
+    else:
+        lines = (u"{0}:{1}".format(word, count) for word, count in
+                 sorted(window.items(), key=lambda pair: (-pair[1], pair[0])))
+
+    for i, line in enumerate(lines):
+        if i >= options.top:
+            break
+        print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,440 @@
+"""
+    Word counts over an interned vocabulary.
+
+    A Vocabulary gives each distinct word an integer id the first time it is
+    seen, and CountTable keeps the counts of the words in an array indexed by
+    those ids. The tables of an analysis share its vocabulary, so each word is
+    stored once however many tables count it, a count takes 8 bytes instead of
+    a dict entry and an int object, and tables are added to each other by id
+    without hashing their words. The vocabulary goes away with the tables of
+    the analysis.
+
+    PhraseTable counts the phrases of 2 or 3 consecutive words, each keyed by
+    the ids of its words packed into a single integer.
+"""
+
+from array import array
+
+try:
+    COUNT_TYPE = array("q").typecode
+except ValueError:  # Python 2, where long is 64 bits on the usual platforms
+    COUNT_TYPE = "l"
+
+# the type of the word ids listed by a CountTable
+ID_TYPE = "i"
+
+# the bits of each word id in the key of a phrase, so that the 3 ids of a
+# trigram fit in a 64-bit integer; phrases with words of larger ids are not
+# counted
+PHRASE_ID_BITS = 21
+PHRASE_ID_MASK = (1 << PHRASE_ID_BITS) - 1
+MAX_PHRASE_ID = PHRASE_ID_MASK - 1
+
+# the number of phrases a PhraseTable holds before it is first pruned
+PRUNE_SIZE = 1 << 20
+
+
+class Vocabulary(object):
+
+    """Interns words to consecutive integer ids.
+
+    Ids are only meaningful in the vocabulary that assigned them: CountTable
+    pickles its words, and interns them again when it is unpickled.
+
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.words = []
+
+    def intern(self, word):
+        """Return the id of a word, assigning it the next id if it is new."""
+        word_id = self.ids.get(word)
+        if word_id is None:
+            word_id = self.ids[word] = len(self.words)
+            self.words.append(word)
+        return word_id
+
+    def lookup(self, tokens):
+        """Return the ids of a sequence of tokens, interning the new ones."""
+        token_ids = list(map(self.ids.get, tokens))
+        if None in token_ids:
+            token_ids = [self.intern(token) for token in tokens]
+        return token_ids
+
+    def count(self, tokens):
+        """Count the tokens of a text by their ids.
+
+        :returns: a tuple of the (id, count) pairs of the distinct tokens
+
+        """
+        return count_ids(self.lookup(tokens))
+
+    def __len__(self):
+        return len(self.words)
+
+
+def count_ids(ids):
+    """Return the (id, count) pairs of the distinct ids of a sequence."""
+    counts = {}
+    for word_id in ids:
+        counts[word_id] = counts.get(word_id, 0) + 1
+    return tuple(counts.items())
+
+
+def phrase_counts(token_ids, ngrams):
+    """Count the phrases of 2 to ngrams consecutive words of a text.
+
+    :param token_ids: the ids of the tokens of the text, in order
+
+    :returns: a tuple of the (key, count) pairs of the distinct phrases, see
+        pack_phrase
+
+    """
+    # 0 stands for the words whose ids are too large to be packed
+    fields = [word_id + 1 if word_id <= MAX_PHRASE_ID else 0
+              for word_id in token_ids]
+    counts = {}
+    for first, second in zip(fields, fields[1:]):
+        if first and second:
+            key = first << PHRASE_ID_BITS | second
+            counts[key] = counts.get(key, 0) + 1
+    if ngrams >= 3:
+        for first, second, third in zip(fields, fields[1:], fields[2:]):
+            if first and second and third:
+                key = (first << PHRASE_ID_BITS | second) << PHRASE_ID_BITS | third
+                counts[key] = counts.get(key, 0) + 1
+    return tuple(counts.items())
+
+
+def word_phrase_counts(tokens, ngrams, common):
+    """Count the phrases of 2 to ngrams consecutive words of a text by their
+    words, like phrase_counts without interning them.
+
+    :param common: the words the phrases counted neither start nor end with
+
+    :returns: a tuple of the (phrase, count) pairs of the distinct phrases
+
+    """
+    counts = {}
+    for size in range(2, ngrams + 1):
+        for start in range(len(tokens) - size + 1):
+            if tokens[start] in common or tokens[start + size - 1] in common:
+                continue
+            phrase = u" ".join(tokens[start:start + size])
+            counts[phrase] = counts.get(phrase, 0) + 1
+    return tuple(counts.items())
+
+
+def pack_phrase(ids):
+    """Pack the ids of the 2 or 3 words of a phrase into an integer.
+
+    Each id takes PHRASE_ID_BITS bits, offset by 1 so that a bigram and a
+    trigram never share a key, and the key of a trigram fits in 64 bits.
+
+    """
+    key = 0
+    for word_id in ids:
+        key = key << PHRASE_ID_BITS | (word_id + 1)
+    return key
+
+
+def unpack_phrase(key):
+    """Return the ids of the words of a phrase packed by pack_phrase."""
+    ids = []
+    while key:
+        ids.append((key & PHRASE_ID_MASK) - 1)
+        key >>= PHRASE_ID_BITS
+    ids.reverse()
+    return ids
+
+
+def phrases_without(key_counts, ids):
+    """Return the (key, count) pairs of the phrases that neither start nor
+    end with one of a set of word ids."""
+    # the packed fields of the ids, see pack_phrase
+    fields = set(word_id + 1 for word_id in ids)
+    return [(key, count) for key, count in key_counts
+            if (key & PHRASE_ID_MASK) not in fields and
+            (key >> 2 * PHRASE_ID_BITS or key >> PHRASE_ID_BITS) not in fields]
+
+
+class CountTable(object):
+
+    """Exact word counts, in an array indexed by the ids of a Vocabulary.
+
+    Supports the operations of a defaultdict(int) (``table[word] += n``,
+    ``in``, ``len``, ``items``, ``del``), like SpaceSaving. Words that were
+    never counted, or were deleted, count as 0 and are not listed.
+
+    :param vocabulary: the Vocabulary of the words, a new one by default
+
+    """
+
+    def __init__(self, vocabulary=None):
+        self.vocabulary = Vocabulary() if vocabulary is None else vocabulary
+        self.counts = array(COUNT_TYPE)
+        # the ids of the counted words in the order they were first counted;
+        # once a count went back to 0, it may also hold ids that are not
+        # counted anymore, or twice, until the next _listed
+        self.listed = array(ID_TYPE)
+        self.stale = False
+
+    def _reserve(self, size):
+        counts = self.counts
+        if size > len(counts):
+            # grow geometrically so that adding new words stays cheap, but
+            # not past the vocabulary
+            size = max(size, min(2 * len(counts), len(self.vocabulary)))
+            counts.extend(array(COUNT_TYPE, [0]) * (size - len(counts)))
+
+    def _listed(self):
+        if self.stale:
+            # like a dict, a word counted again after it was deleted moves to
+            # the end
+            counts = self.counts
+            seen = set()
+            listed = []
+            for word_id in reversed(self.listed):
+                if counts[word_id] and word_id not in seen:
+                    seen.add(word_id)
+                    listed.append(word_id)
+            listed.reverse()
+            self.listed = array(ID_TYPE, listed)
+            self.stale = False
+        return self.listed
+
+    def add_ids(self, id_counts):
+        """Add the counts of a sequence of (id, count) pairs."""
+        if not id_counts:
+            return
+        # only the ids counted need a slot, the words of the other tables of
+        # the vocabulary do not
+        top = max(id_counts)[0]
+        if top >= len(self.counts):
+            self._reserve(top + 1)
+        table = self.counts
+        listed = self.listed
+        for word_id, n in id_counts:
+            if not table[word_id]:
+                listed.append(word_id)
+            table[word_id] += n
+
+    def add(self, word, n=1):
+        self[word] += n
+
+    def update(self, other):
+        """Add the counts of a mapping or another CountTable."""
+        if not isinstance(other, CountTable) or other.vocabulary is not self.vocabulary:
+            pairs = [(word, count) for word, count in other.items() if count]
+            ids = self.vocabulary.lookup([word for word, _ in pairs])
+            self.add_ids(list(zip(ids, [count for _, count in pairs])))
+            return
+        self._reserve(len(other.counts))
+        table = self.counts
+        listed = self.listed
+        counts = other.counts
+        for word_id in other._listed():
+            if not table[word_id]:
+                listed.append(word_id)
+            table[word_id] += counts[word_id]
+
+    def __getitem__(self, word):
+        word_id = self.vocabulary.ids.get(word)
+        if word_id is None or word_id >= len(self.counts):
+            return 0
+        return self.counts[word_id]
+
+    def __setitem__(self, word, value):
+        word_id = self.vocabulary.intern(word)
+        self._reserve(word_id + 1)
+        if not self.counts[word_id] and value:
+            self.listed.append(word_id)
+        elif not value:
+            self.stale = True
+        self.counts[word_id] = value
+
+    def __delitem__(self, word):
+        # like reading a word of a defaultdict then deleting it, deleting a
+        # word that is not counted is allowed
+        if self[word]:
+            self[word] = 0
+
+    def get(self, word, default=None):
+        return self[word] or default
+
+    def __contains__(self, word):
+        return self[word] != 0
+
+    def __len__(self):
+        return len(self._listed())
+
+    def __iter__(self):
+        words = self.vocabulary.words
+        return (words[word_id] for word_id in self._listed())
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        counts = self.counts
+        return [counts[word_id] for word_id in self._listed()]
+
+    def items(self):
+        words = self.vocabulary.words
+        counts = self.counts
+        return [(words[word_id], counts[word_id]) for word_id in self._listed()]
+
+    def __eq__(self, other):
+        if isinstance(other, CountTable):
+            other = dict(other.items())
+        elif not isinstance(other, dict):
+            return NotImplemented
+        return dict(self.items()) == dict((word, count) for word, count in other.items()
+                                          if count)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        # ids are local to a process, so the words are pickled
+        words = self.vocabulary.words
+        counts = self.counts
+        listed = self._listed()
+        return ([words[word_id] for word_id in listed],
+                array(COUNT_TYPE, [counts[word_id] for word_id in listed]))
+
+    def __setstate__(self, state):
+        words, counts = state
+        self.__init__()
+        ids = self.vocabulary.lookup(words)
+        self._reserve(len(ids))
+        table = self.counts
+        for word_id, count in zip(ids, counts):
+            table[word_id] = count
+        self.listed = array(ID_TYPE, ids)
+
+
+class PhraseTable(object):
+
+    """Counts of phrases of 2 or 3 words, keyed by their packed word ids.
+
+    Phrase tables grow much faster than word tables, so the phrases used
+    fewer than ``min_count`` times are dropped whenever the table grows past
+    twice its size after the last pruning (and at least ``prune_size``). A
+    phrase dropped early can be counted again, so each count is at most
+    ``max_error()`` too low.
+
+    Phrases are read and written as strings of space-separated words (e.g.
+    ``table["new york"]``), like the words of a CountTable.
+
+    :param min_count: the minimum count of the phrases kept when pruning, 1
+        to never prune
+
+    :param prune_size: the number of phrases held before the first pruning
+
+    :param vocabulary: the Vocabulary of the words, a new one by default
+
+    """
+
+    def __init__(self, min_count=1, prune_size=PRUNE_SIZE, vocabulary=None):
+        self.vocabulary = Vocabulary() if vocabulary is None else vocabulary
+        self.min_count = min_count
+        self.prune_size = prune_size
+        self.prune_at = prune_size
+        self.prunes = 0
+        self.counts = {}
+
+    def add_keys(self, key_counts):
+        """Add the counts of a sequence of (key, count) pairs."""
+        counts = self.counts
+        get = counts.get
+        for key, n in key_counts:
+            counts[key] = get(key, 0) + n
+        if len(counts) > self.prune_at:
+            self.prune()
+
+    def prune(self):
+        """Drop the phrases used fewer than min_count times."""
+        if self.min_count > 1:
+            min_count = self.min_count
+            self.counts = dict((key, count) for key, count in self.counts.items()
+                               if count >= min_count)
+            self.prunes += 1
+        self.prune_at = max(self.prune_size, 2 * len(self.counts))
+
+    def max_error(self):
+        """Return how much any count may be too low because of the pruning."""
+        return self.prunes * (self.min_count - 1)
+
+    def key(self, phrase):
+        """Return the key of a phrase, None if one of its words is unknown."""
+        ids = [self.vocabulary.ids.get(word) for word in phrase.split(" ")]
+        if None in ids or max(ids) > MAX_PHRASE_ID:
+            return None
+        return pack_phrase(ids)
+
+    def _intern(self, phrase):
+        ids = [self.vocabulary.intern(word) for word in phrase.split(" ")]
+        return None if max(ids) > MAX_PHRASE_ID else pack_phrase(ids)
+
+    def phrase(self, key):
+        words = self.vocabulary.words
+        return u" ".join(words[word_id] for word_id in unpack_phrase(key))
+
+    def update(self, other):
+        """Add the counts of another PhraseTable."""
+        if other.vocabulary is self.vocabulary:
+            self.add_keys(other.counts.items())
+        else:
+            key_counts = [(self._intern(phrase), count) for phrase, count in other.items()]
+            self.add_keys([(key, count) for key, count in key_counts if key is not None])
+        self.prunes += other.prunes
+
+    def __getitem__(self, phrase):
+        key = self.key(phrase)
+        return 0 if key is None else self.counts.get(key, 0)
+
+    def __contains__(self, phrase):
+        return self[phrase] != 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __iter__(self):
+        return (self.phrase(key) for key in self.counts)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(self.phrase(key), count) for key, count in self.counts.items()]
+
+    def __eq__(self, other):
+        if isinstance(other, PhraseTable):
+            other = dict(other.items())
+        elif not isinstance(other, dict):
+            return NotImplemented
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        # like CountTable, the words are pickled rather than their ids
+        phrases = []
+        counts = array(COUNT_TYPE)
+        for phrase, count in self.items():
+            phrases.append(phrase)
+            counts.append(count)
+        return self.min_count, self.prune_size, self.prunes, phrases, counts
+
+    def __setstate__(self, state):
+        min_count, prune_size, prunes, phrases, counts = state
+        self.__init__(min_count, prune_size)
+        for phrase, count in zip(phrases, counts):
+            key = self._intern(phrase)
+            if key is not None:
+                self.counts[key] = count
+        self.prune_at = max(prune_size, 2 * len(self.counts))
+        self.prunes = prunes
@@ -0,0 +1,242 @@
+"""
+    Memory-mapped word lists.
+
+    A word list (one word per line, like ``words/dict-words.txt``) is compiled
+    once into an index file holding an open addressing hash table of its
+    lowercased words. The index is memory-mapped and probed in place, so
+    checking a word neither reads the whole list nor builds a Python set of
+    it, and worker processes that reopen the same index share its pages
+    through the page cache. Indexes are kept in the user's cache directory,
+    never in the installed package.
+
+    Index file layout (little endian):
+
+    * header: magic ``RAWI``, version, number of slots, number of words
+    * slots: (crc32 of the word, 1 + offset of the word in the strings)
+      pairs, 0 offsets marking the empty slots
+    * strings: the UTF-8 words, each preceded by its 8-bit length
+"""
+
+import io
+import mmap
+import os
+import struct
+import sys
+
+from .hashslots import SLOT, build_slots, crc32, pack_slots, probe
+
+try:
+    from os import replace as replace_file
+except ImportError:  # Python 2, where rename replaces files on POSIX
+    from os import rename as replace_file
+
+MAGIC = b"RAWI"
+VERSION = 2
+
+INDEX_SUFFIX = ".idx"
+
+_HEADER = struct.Struct("<4sIII")
+_LENGTH = struct.Struct("<B")
+
+# number of index lookups remembered by a StopWords before starting over
+MEMO_SIZE = 1 << 16
+
+
+def read_word_list(path):
+    """Return the set of lowercased words of a word list file."""
+    with io.open(path, "r", encoding="utf-8") as in_file:
+        words = set(line.strip().lower() for line in in_file)
+    words.discard(u"")
+    return words
+
+
+def build_index(words, path):
+    """Write an index of the given words to path.
+
+    The file is written next to path first and moved in place, so concurrent
+    readers never see a partial index.
+
+    """
+    encoded = sorted(set(word.encode("utf-8") for word in words))
+    offsets = []
+    strings = bytearray()
+    for data in encoded:
+        if len(data) > 0xff:
+            raise ValueError("word too long for the index: {0!r}".format(data[:32]))
+        offsets.append(len(strings))
+        strings += _LENGTH.pack(len(data))
+        strings += data
+    num_slots, slots = build_slots(zip(encoded, offsets))
+
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as out_file:
+        out_file.write(_HEADER.pack(MAGIC, VERSION, num_slots, len(encoded)))
+        out_file.write(pack_slots(slots))
+        out_file.write(bytes(strings))
+    replace_file(tmp_path, path)
+
+
+def cache_dir():
+    """Return the directory indexes are kept in, creating it if needed.
+
+    This is ``$XDG_CACHE_HOME/redditanalysis``, ``~/.cache/redditanalysis``
+    by default.
+
+    """
+    root = (os.environ.get("XDG_CACHE_HOME") or
+            os.path.join(os.path.expanduser("~"), ".cache"))
+    path = os.path.join(root, "redditanalysis")
+    try:
+        os.makedirs(path)
+    except OSError:
+        # made by a concurrent first run
+        if not os.path.isdir(path):
+            raise
+    return path
+
+
+def _default_index_path(list_path):
+    """Return where the index of a word list is kept.
+
+    Each list gets its own index in the cache directory, named after its
+    absolute path, so the word lists of the package are never written to.
+
+    """
+    key = crc32(os.path.abspath(list_path).encode(sys.getfilesystemencoding()))
+    return os.path.join(cache_dir(), "{0}-{1:08x}{2}".format(
+        os.path.basename(os.path.splitext(list_path)[0]), key, INDEX_SUFFIX))
+
+
+def _is_current(index_path, list_path):
+    """Return True if the index exists, is newer than the list and readable."""
+    try:
+        if os.path.getmtime(index_path) < os.path.getmtime(list_path):
+            return False
+        with open(index_path, "rb") as in_file:
+            header = in_file.read(_HEADER.size)
+    except (IOError, OSError):
+        return False
+    return (len(header) == _HEADER.size and
+            _HEADER.unpack(header)[:2] == (MAGIC, VERSION))
+
+
+def compile_word_list(list_path, index_path=None):
+    """Build the index of a word list unless an up to date one exists.
+
+    Returns the path of the index.
+
+    """
+    if index_path is None:
+        index_path = _default_index_path(list_path)
+    if not _is_current(index_path, list_path):
+        build_index(read_word_list(list_path), index_path)
+    return index_path
+
+
+class WordIndex(object):
+
+    """A read-only, memory-mapped index of words.
+
+    Supports ``in`` and ``len``. Pickling a WordIndex only pickles its path,
+    the unpickled copy maps the same file.
+
+    :param path: the index file built by build_index
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as in_file:
+            self.map = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.num_slots, self.num_words = _HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            self.map.close()
+            raise ValueError("{0} is not a version {1} word index".format(
+                path, VERSION))
+        self.strings_at = _HEADER.size + self.num_slots * SLOT.size
+
+    @classmethod
+    def open_word_list(cls, path):
+        """Open the index of a word list file, building it if needed.
+
+        Paths ending in INDEX_SUFFIX are opened as already built indexes.
+
+        """
+        if path.endswith(INDEX_SUFFIX):
+            return cls(path)
+        return cls(compile_word_list(path))
+
+    def __contains__(self, word):
+        data = word.encode("utf-8")
+        for offset in probe(self.map, _HEADER.size, self.num_slots, data):
+            start = self.strings_at + offset
+            length = _LENGTH.unpack_from(self.map, start)[0]
+            start += _LENGTH.size
+            if length == len(data) and self.map[start:start + length] == data:
+                return True
+        return False
+
+    def __len__(self):
+        return self.num_words
+
+    def __reduce__(self):
+        return (self.__class__, (self.path,))
+
+    def close(self):
+        self.map.close()
+
+
+class StopWords(object):
+
+    """The words left out of the word counts.
+
+    Small lists (like the common words) are kept in a set, large ones (like
+    the dictionary) are added as memory-mapped WordIndex objects. Recent index
+    lookups are remembered, since the same tokens come up over and over.
+
+    """
+
+    def __init__(self, words=(), indexes=()):
+        self.words = set(words)
+        self.indexes = list(indexes)
+        self.memo = {}
+
+    def add(self, word):
+        self.words.add(word)
+        self.memo.clear()
+
+    def update(self, words):
+        self.words.update(words)
+        self.memo.clear()
+
+    def add_index(self, index):
+        self.indexes.append(index)
+        self.memo.clear()
+
+    def __contains__(self, word):
+        if word in self.words:
+            return True
+        if not self.indexes:
+            return False
+        try:
+            return self.memo[word]
+        except KeyError:
+            pass
+        if len(self.memo) >= MEMO_SIZE:
+            self.memo.clear()
+        found = any(word in index for index in self.indexes)
+        self.memo[word] = found
+        return found
+
+    def __getstate__(self):
+        return (self.words, self.indexes)
+
+    def __setstate__(self, state):
+        self.words, self.indexes = state
+        self.memo = {}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        sys.exit("Usage: python -m redditanalysis.wordindex WORD_LIST [INDEX]")
+    print(compile_word_list(*sys.argv[1:]))
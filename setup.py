@@ -38,13 +38,16 @@ setup(name=PACKAGE_NAME,
                    "Topic :: Internet"],
       description=("A tool to aid in the production of word clouds for "
                    "subreddits and users on reddit."),
-      entry_points={"console_scripts": ["word_freqs={0}:main".format(PACKAGE_NAME), ]},
-      install_requires=["beautifulsoup4", "markdown", "praw >=2.1, <4", "update_checker==0.11", "lxml"],
+      entry_points={"console_scripts": ["word_freqs={0}:main".format(PACKAGE_NAME),
+                                        "word_freqs_merge={0}.shards:main".format(PACKAGE_NAME)]},
+      install_requires=["praw >=2.1, <4", "update_checker==0.11"],
+      extras_require={"zstd": ["zstandard"]},
       license="GPLv3",
       long_description=get_long_description(),
       packages=[PACKAGE_NAME],
       package_data={PACKAGE_NAME: ["words/*.txt"]},
       test_suite="tests",
+      tests_require=["beautifulsoup4", "markdown", "lxml"],
       url="https://github.com/rhiever/reddit-analysis",
       version=VERSION,
       zip_safe=False)